@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""End-to-end load test of the bridge against fake services.
+
+The real signal handlers, `WaLayer` callbacks and Telegram command handlers
+are used, but:
+
+- A fake layer is placed below `WaLayer`. Incoming Whatsapp traffic is
+  injected as `TextMessageProtocolEntity` objects at a configurable rate and
+  outgoing entities are captured.
+- Telegram requests are sent to a local HTTP server that mimics the Bot API,
+  with optional latency and HTTP 429 errors. Messages from bound groups are
+  injected through `getUpdates`.
+
+The test reports messages per second, p50/p99 latency and lost messages for
+both directions.
+
+Usage:
+
+    python benchmarks/loadtest.py [--rate 50] [--duration 10] [--senders 20]
+        [--tg-latency 0.05] [--tg-429 0.01] [--set section.option=value ...]
+        [--output results.json]
+
+Rate limits are set to the defaults of the bridge unless overriden with
+`--set` (a rate of 0 disables the limit), e.g.
+`--set tg.chat_rate=0 --set wa.send_rate=0 --set wa.recipient_rate=0`.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer, configparser, socketserver
+from six.moves.urllib.parse import parse_qsl, urlparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Settings used for the fake services
+TOKEN = '123456:LOADTEST'
+OWNER = 1000
+GROUP_BASE = -2000000
+
+
+class FakeTelegramServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server mimicking the parts of the Bot API used by the bridge.
+
+    Args:
+        latency (float): Seconds to wait before answering each request.
+        error_ratio (float): Probability of answering a send with HTTP 429.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, error_ratio=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeTelegramHandler)
+
+        self.latency = latency
+        self.error_ratio = error_ratio
+
+        self.lock = threading.Condition()
+        self.updates = collections.deque()
+        self.next_update = 1
+        self.next_message = 1
+
+        # Callback for every message sent by the bot
+        self.on_message = None
+
+        self.counters = collections.Counter()
+
+    def push_message(self, chat_id, text):
+        """Queue a message from the owner to be returned by `getUpdates`."""
+        with self.lock:
+            self.updates.append({
+                'update_id': self.next_update,
+                'message': {
+                    'message_id': self.next_update,
+                    'date': int(time.time()),
+                    'from': {'id': OWNER, 'first_name': 'owner'},
+                    'chat': {'id': chat_id, 'type': 'group', 'title': 'load'},
+                    'text': text
+                }
+            })
+
+            self.next_update += 1
+            self.lock.notify_all()
+
+    def get_updates(self, offset, timeout):
+        with self.lock:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+
+            if not self.updates and timeout:
+                self.lock.wait(timeout)
+
+            return list(self.updates)[:100]
+
+    def send_message(self, params):
+        with self.lock:
+            message_id = self.next_message
+            self.next_message += 1
+
+        chat_id = int(params['chat_id'])
+
+        if self.on_message:
+            self.on_message(chat_id, params.get('text', ''))
+
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'},
+            'text': params.get('text', '')
+        }
+
+
+class FakeTelegramHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler of `FakeTelegramServer`."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        url = urlparse(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+
+            else:
+                params.update(parse_qsl(body))
+
+        server = self.server
+        server.counters[method] += 1
+
+        if method == 'getUpdates':
+            result = server.get_updates(
+                int(params.get('offset', 0)), float(params.get('timeout', 0)))
+            return self._reply(200, {'ok': True, 'result': result})
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if method == 'sendMessage':
+            if random.random() < server.error_ratio:
+                server.counters['429'] += 1
+                return self._reply(429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': 'Too Many Requests: retry after 1',
+                    'parameters': {'retry_after': 1}
+                })
+
+            return self._reply(200, {'ok': True, 'result': server.send_message(params)})
+
+        return self._reply(200, {'ok': True, 'result': True})
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeLowerLayer(object):
+    """Layer placed below `WaLayer` that captures outgoing entities."""
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self.counters = collections.Counter()
+
+    def send(self, entity):
+        tag = entity.getTag()
+        self.counters[tag] += 1
+
+        if tag == 'message':
+            self.on_message(entity.getTo(False), entity.getBody())
+
+    def receive(self, entity):
+        pass
+
+
+class Tracker(object):
+    """Record the send and delivery time of each message of a direction."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.latencies = []
+        self.first = None
+        self.last = None
+
+    def send(self, token):
+        with self.lock:
+            self.sent[token] = time.time()
+
+    def deliver(self, text):
+        now = time.time()
+
+        with self.lock:
+            for token in text.split():
+                start = self.sent.pop(token, None)
+
+                if start is None:
+                    continue
+
+                self.latencies.append(now - start)
+                self.first = self.first or now
+                self.last = now
+
+    def report(self, injected):
+        latencies = sorted(self.latencies)
+        delivered = len(latencies)
+        elapsed = (self.last - self.first) if delivered > 1 else 0
+
+        def percentile(p):
+            if not latencies:
+                return None
+
+            return latencies[min(delivered - 1, int(delivered * p))]
+
+        return {
+            'injected': injected,
+            'delivered': delivered,
+            'lost': injected - delivered,
+            'messages_per_s': delivered / elapsed if elapsed else None,
+            'p50_s': percentile(0.5),
+            'p99_s': percentile(0.99),
+            'max_s': latencies[-1] if latencies else None
+        }
+
+
+def write_config(workdir, overrides):
+    """Write the configuration file used by the bridge."""
+    parser = configparser.ConfigParser()
+
+    sections = {
+        'tg': {'owner': str(OWNER), 'token': TOKEN},
+        'wa': {'phone': '490000000000', 'password': 'loadtest', 'poll_interval': '0.01'},
+        'db': {'path': os.path.join(workdir, 'db.sqlite'), 'backend': 'sqlite'},
+        'relay': {'outbox_path': os.path.join(workdir, 'outbox')}
+    }
+
+    for override in overrides:
+        key, value = override.split('=', 1)
+        section, option = key.split('.', 1)
+        sections.setdefault(section, {})[option] = value
+
+    for section, options in sections.items():
+        parser.add_section(section)
+
+        for option, value in options.items():
+            parser.set(section, option, value)
+
+    path = os.path.join(workdir, 'bridge.conf')
+
+    with open(path, 'w') as f:
+        parser.write(f)
+
+    return path
+
+
+def phone(i):
+    return '49%09d' % i
+
+
+def run(args, workdir):
+    os.environ['WAT_CONF'] = write_config(workdir, args.set or [])
+
+    from wat_bridge.static import SIGNAL_TG, SIGNAL_WA, init_bridge
+    init_bridge()
+
+    from telebot import apihelper
+
+    server = FakeTelegramServer(args.tg_latency, args.tg_429)
+    fake_url = 'http://127.0.0.1:%d/bot{0}/{1}' % server.server_address[1]
+
+    apihelper.API_URL = fake_url
+    _make_request = apihelper._make_request
+    apihelper._make_request = lambda *a, **kw: _make_request(*a, **dict(kw, base_url=fake_url))
+
+    from wat_bridge.helper import db_add_contact, db_set_group
+    from wat_bridge.listeners import tg_listener
+    from wat_bridge.relay import OUTBOX, TG_COALESCER, TG_QUEUE
+    from wat_bridge.signals import to_tg_handler, to_wa_handler
+    from wat_bridge.wa import WA_QUEUE, wabot
+
+    from yowsup.layers.protocol_messages.protocolentities import TextMessageProtocolEntity
+
+    # Contacts, each bound to its own group
+    for i in range(args.senders):
+        db_add_contact('load%d' % i, phone(i))
+        db_set_group('load%d' % i, GROUP_BASE - i)
+
+    to_tg = Tracker()
+    to_wa = Tracker()
+
+    server.on_message = lambda chat_id, text: to_tg.deliver(text)
+
+    lower = FakeLowerLayer(lambda to, text: to_wa.deliver(text))
+    wabot.setLayers(None, lower)
+
+    SIGNAL_TG.connect(to_tg_handler)
+    SIGNAL_WA.connect(to_wa_handler)
+
+    TG_QUEUE.start()
+    TG_COALESCER.start()
+    OUTBOX.start()
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    tg_thread = threading.Thread(target=tg_listener)
+    tg_thread.daemon = True
+    tg_thread.start()
+
+    total = int(args.rate * args.duration)
+    interval = 1.0 / args.rate
+    start = time.time()
+
+    # Emulate the Whatsapp listener: inject incoming messages and drain the
+    # send queue from the same thread
+    for n in range(total):
+        sender = n % args.senders
+
+        while time.time() < start + n * interval:
+            WA_QUEUE.drain(wabot)
+            time.sleep(min(0.001, interval))
+
+        token = 'wa-%d' % n
+        to_tg.send(token)
+
+        wabot.receive(TextMessageProtocolEntity(
+            token,
+            _id='LOAD%d' % n,
+            _from='%s@s.whatsapp.net' % phone(sender),
+            timestamp=int(time.time())
+        ))
+
+        token = 'tg-%d' % n
+        to_wa.send(token)
+        server.push_message(GROUP_BASE - sender, token)
+
+    # Wait for the pending messages
+    deadline = time.time() + args.grace
+
+    while time.time() < deadline and (to_tg.sent or to_wa.sent):
+        WA_QUEUE.drain(wabot)
+        time.sleep(0.01)
+
+    return {
+        'settings': vars(args),
+        'wa_to_tg': to_tg.report(total),
+        'tg_to_wa': to_wa.report(total),
+        'telegram_requests': dict(server.counters),
+        'whatsapp_entities': dict(lower.counters)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the bridge against fake services.')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='messages per second injected in each direction')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to inject messages for')
+    parser.add_argument('--senders', type=int, default=20,
+                        help='number of Whatsapp contacts (each bound to a group)')
+    parser.add_argument('--tg-latency', type=float, default=0.05,
+                        help='latency of the fake Telegram API, in seconds')
+    parser.add_argument('--tg-429', type=float, default=0,
+                        help='ratio of Telegram sends answered with HTTP 429')
+    parser.add_argument('--grace', type=float, default=30,
+                        help='seconds to wait for pending messages')
+    parser.add_argument('--set', action='append', metavar='SECTION.OPTION=VALUE',
+                        help='override a setting of the bridge')
+    parser.add_argument('--output', help='file to write the results to')
+
+    args = parser.parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='watbridge-load-')
+
+    try:
+        report = run(args, workdir)
+
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Micro-benchmarks for the contact and blacklist lookup functions.
+
+Synthetic databases are generated in a temporary directory, so no Whatsapp
+or Telegram credentials are needed. Results are written as JSON so that runs
+on different commits can be compared.
+
+Usage:
+
+    python benchmarks/lookup.py [--sizes 100,10000,100000]
+        [--backends tinydb,sqlite] [--repeat 1000] [--output results.json]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from wat_bridge import helper
+from wat_bridge.helper import ContactRegistry
+from wat_bridge.storage import open_storage
+
+# Fraction of the contacts that are bound to a group
+GROUP_RATIO = 10
+
+# Fraction of writes in the mixed workload
+WRITE_RATIO = 0.1
+
+
+def phone(i):
+    return '49%09d' % i
+
+def blacklisted_phone(i):
+    return '1%010d' % i
+
+def name(i):
+    return 'contact%d' % i
+
+def group(i):
+    return -1000000 - i
+
+
+def generate(backend, path, size):
+    """Create a database with `size` contacts and `size` blacklisted phones."""
+    storage = open_storage(backend, path)
+
+    elements = []
+    for i in range(size):
+        elements.append({
+            'name': name(i),
+            'phone': phone(i),
+            'blacklisted': False,
+            'group': group(i) if i % GROUP_RATIO == 0 else None
+        })
+        elements.append({
+            'name': None,
+            'phone': blacklisted_phone(i),
+            'blacklisted': True,
+            'group': None
+        })
+
+    storage.insert_many(elements)
+    storage.close()
+
+
+def summary(samples):
+    """Obtain statistics of a list of timings."""
+    samples = sorted(samples)
+    count = len(samples)
+
+    return {
+        'ops': count,
+        'mean_s': sum(samples) / count,
+        'p50_s': samples[count // 2],
+        'p99_s': samples[min(count - 1, int(count * 0.99))],
+        'max_s': samples[-1]
+    }
+
+
+def workloads(size):
+    """Obtain the lookups to benchmark.
+
+    Returns:
+        List of (name, function) tuples, where each function performs a
+        single lookup on a random key.
+    """
+    grouped = max(size // GROUP_RATIO, 1)
+
+    return [
+        ('get_contact', lambda: helper.get_contact(phone(random.randrange(size)))),
+        ('get_phone', lambda: helper.get_phone(name(random.randrange(size)))),
+        ('is_blacklisted', lambda: helper.is_blacklisted(blacklisted_phone(random.randrange(size)))),
+        ('is_blacklisted_miss', lambda: helper.is_blacklisted(phone(random.randrange(size)))),
+        ('db_get_group', lambda: helper.db_get_group(name(random.randrange(size)))),
+        ('db_get_contact_by_group', lambda: helper.db_get_contact_by_group(
+            group(random.randrange(grouped) * GROUP_RATIO))),
+        ('db_list_contacts', helper.db_list_contacts),
+    ]
+
+
+def time_call(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def bench_lookups(backend, path, size, repeat):
+    """Time each lookup function cold (first call) and warm."""
+    results = []
+
+    for label, func in workloads(size):
+        storage = open_storage(backend, path)
+        helper.REGISTRY = ContactRegistry(storage)
+
+        # The first call includes loading the table
+        cold = time_call(func)
+
+        # db_list_contacts is linear, do not repeat it as much
+        count = repeat if label != 'db_list_contacts' else max(repeat // 100, 5)
+        warm = [time_call(func) for _ in range(count)]
+
+        storage.close()
+
+        results.append(dict(function=label, mode='cold', **summary([cold])))
+        results.append(dict(function=label, mode='warm', **summary(warm)))
+
+    return results
+
+
+def bench_mixed(backend, path, size, repeat):
+    """Time a workload mixing lookups with contact additions and removals."""
+    storage = open_storage(backend, path)
+    helper.REGISTRY = ContactRegistry(storage)
+    helper.REGISTRY.load()
+
+    reads = [f for label, f in workloads(size) if label != 'db_list_contacts']
+    reads_samples = []
+    writes_samples = []
+    added = []
+
+    for i in range(repeat):
+        if random.random() < WRITE_RATIO:
+            if added and random.random() < 0.5:
+                contact = added.pop()
+                writes_samples.append(time_call(lambda: helper.db_rm_contact(contact)))
+
+            else:
+                contact = 'new%d' % i
+                added.append(contact)
+                writes_samples.append(time_call(
+                    lambda: helper.db_add_contact(contact, '7%010d' % i)))
+
+        else:
+            reads_samples.append(time_call(random.choice(reads)))
+
+    storage.close()
+
+    results = [dict(function='mixed_read', mode='warm', **summary(reads_samples))]
+
+    if writes_samples:
+        results.append(dict(function='mixed_write', mode='warm', **summary(writes_samples)))
+
+    return results
+
+
+def commit():
+    """Obtain the current git commit, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT
+        ).decode('utf-8').strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the lookup functions.')
+    parser.add_argument('--sizes', default='100,10000,100000',
+                        help='comma separated number of contacts')
+    parser.add_argument('--backends', default='tinydb,sqlite',
+                        help='comma separated storage backends')
+    parser.add_argument('--repeat', type=int, default=1000,
+                        help='number of warm calls per function')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='file to write the results to')
+
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': []
+    }
+
+    workdir = tempfile.mkdtemp(prefix='watbridge-bench-')
+
+    try:
+        for backend in args.backends.split(','):
+            for size in [int(s) for s in args.sizes.split(',')]:
+                path = os.path.join(workdir, '%s-%d.db' % (backend, size))
+
+                start = time.time()
+                generate(backend, path, size)
+                print('%s %d: generated in %.2f s' % (backend, size, time.time() - start),
+                      file=sys.stderr)
+
+                results = bench_lookups(backend, path, size, args.repeat)
+                results += bench_mixed(backend, path, size, args.repeat)
+
+                for result in results:
+                    result.update(backend=backend, size=size)
+                    print('%(backend)s %(size)d %(function)s %(mode)s: '
+                          'mean %(mean_s).2e s, p99 %(p99_s).2e s' % result,
+                          file=sys.stderr)
+
+                report['results'] += results
+
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests of the bridge.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+from six.moves import configparser
+
+from wat_bridge import static
+
+# Directory holding the configuration and files of the bridge under test
+WORKDIR = None
+
+
+def init_bridge():
+    """Load the settings of the bridge from a temporary configuration.
+
+    Modules that read the settings when they are imported (such as
+    `wat_bridge.relay`) must be imported after calling this. The settings
+    are only loaded once.
+
+    Returns:
+        Path to the temporary directory used by the bridge.
+    """
+    global WORKDIR
+
+    if WORKDIR is not None:
+        return WORKDIR
+
+    WORKDIR = tempfile.mkdtemp(prefix='watbridge-tests-')
+    atexit.register(shutil.rmtree, WORKDIR, True)
+
+    parser = configparser.ConfigParser()
+
+    for section, options in (
+            ('tg', {'owner': '1', 'token': 'TOKEN'}),
+            ('wa', {'phone': '1', 'password': 'PASSWORD'}),
+            ('db', {'path': os.path.join(WORKDIR, 'db.json')})):
+        parser.add_section(section)
+
+        for option, value in options.items():
+            parser.set(section, option, value)
+
+    conf_path = os.path.join(WORKDIR, 'bridge.conf')
+
+    with open(conf_path, 'w') as f:
+        parser.write(f)
+
+    os.environ['WAT_CONF'] = conf_path
+    os.environ.pop('WAT_INSTANCE', None)
+    os.environ.pop('WAT_ROLE', None)
+
+    static.init_bridge()
+
+    return WORKDIR
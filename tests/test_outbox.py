@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the outbox log."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from wat_bridge.outbox import Outbox
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='watbridge-tests-')
+        self.path = os.path.join(self.workdir, 'outbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, True)
+
+    def reopen(self, outbox):
+        outbox.log.close()
+        return Outbox(self.path)
+
+    def test_pending_entries_are_replayed(self):
+        outbox = Outbox(self.path)
+        first = outbox.append('tg', phone='49151', message='one')
+        second = outbox.append('wa', phone='49152', message='two')
+        outbox.done(first)
+
+        outbox = self.reopen(outbox)
+
+        self.assertEqual(
+            outbox.pending(),
+            [(second, 'wa', {'phone': '49152', 'message': 'two'})]
+        )
+
+    def test_truncated_record_is_ignored(self):
+        outbox = Outbox(self.path)
+        first = outbox.append('tg', phone='49151', message='one')
+        outbox.log.close()
+
+        # The process died while writing the second record
+        with open(self.path, 'a') as f:
+            f.write('+2 tg {"phone": "491')
+
+        outbox = Outbox(self.path)
+
+        self.assertEqual(
+            outbox.pending(),
+            [(first, 'tg', {'phone': '49151', 'message': 'one'})]
+        )
+
+        # The log is rewritten without the truncated record, so new records
+        # are not appended to it
+        third = outbox.append('tg', phone='49153', message='three')
+        outbox = self.reopen(outbox)
+
+        self.assertEqual([e[0] for e in outbox.pending()], [first, third])
+
+    def test_invalid_record_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('+1 tg {"phone": "49151"}\n')
+            f.write('+x tg {}\n')
+            f.write('+2 tg not json\n')
+            f.write('+3 wa {"phone": "49153"}\n')
+
+        outbox = Outbox(self.path)
+
+        self.assertEqual([e[0] for e in outbox.pending()], [1, 3])
+
+    def test_ids_are_not_reused_while_pending(self):
+        outbox = Outbox(self.path)
+        outbox.append('tg', phone='49151')
+        last = outbox.append('tg', phone='49152')
+
+        outbox = self.reopen(outbox)
+
+        self.assertGreater(outbox.append('tg', phone='49153'), last)
+
+    def test_compaction_keeps_pending_entries(self):
+        outbox = Outbox(self.path, compact_every=2)
+        eids = [outbox.append('tg', phone=str(i)) for i in range(4)]
+        outbox.done(eids[0], eids[2])
+
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        outbox = self.reopen(outbox)
+
+        self.assertEqual([e[0] for e in outbox.pending()], [eids[1], eids[3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
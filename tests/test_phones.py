@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for phone normalisation and blacklist rules."""
+
+import unittest
+
+from wat_bridge.phones import PhoneTrie, compile_rule, normalize, parse_rule, \
+        range_prefixes
+
+
+class ParseRuleTest(unittest.TestCase):
+
+    def test_exact_phone(self):
+        self.assertEqual(parse_rule('+49 151 1234-567'), '491511234567')
+        self.assertEqual(parse_rule('0049151'), '49151')
+
+    def test_prefix(self):
+        self.assertEqual(parse_rule('+49 151*'), '49151*')
+        self.assertEqual(parse_rule(' 4915* '), '4915*')
+
+    def test_range(self):
+        self.assertEqual(parse_rule('+49 160..0049 169'), '49160..49169')
+        self.assertEqual(parse_rule('120..120'), '120..120')
+
+    def test_invalid(self):
+        for rule in (None, '', '*', 'abc', '49a*', '..', '120..', '..139',
+                     '139..120', '120..1399', '12x..139'):
+            self.assertIsNone(parse_rule(rule), rule)
+
+    def test_canonical_rules_are_stable(self):
+        for rule in ('49151', '49151*', '49160..49169'):
+            self.assertEqual(parse_rule(rule), rule)
+
+
+class RangePrefixesTest(unittest.TestCase):
+
+    def test_examples(self):
+        self.assertEqual(range_prefixes('120', '139'), ['12', '13'])
+        self.assertEqual(range_prefixes('120', '120'), ['120'])
+        self.assertEqual(range_prefixes('125', '131'), ['125', '126', '127', '128', '129', '130', '131'])
+
+    def test_complete_digit_sets_are_merged(self):
+        self.assertEqual(range_prefixes('4915100', '4915199'), ['49151'])
+        self.assertEqual(range_prefixes('4915000', '4915999'), ['4915'])
+        self.assertEqual(range_prefixes('100', '299'), ['1', '2'])
+        self.assertEqual(range_prefixes('1000', '2999'), ['1', '2'])
+
+    def test_every_range_is_covered_exactly(self):
+        numbers = ['%02d' % i for i in range(100)]
+
+        for lo in range(100):
+            for hi in range(lo, 100):
+                prefixes = range_prefixes(numbers[lo], numbers[hi])
+                covered = [n for n in numbers if any(n.startswith(p) for p in prefixes)]
+
+                self.assertEqual(covered, numbers[lo:hi + 1], prefixes)
+
+                # No prefix is listed with its nine siblings
+                parents = set(p[:-1] for p in prefixes if len(p) > 1)
+                for parent in parents:
+                    siblings = [parent + str(d) for d in range(10)]
+                    self.assertFalse(all(s in prefixes for s in siblings), prefixes)
+
+    def test_compiled_range(self):
+        self.assertEqual(compile_rule('4915100..4915199'), [('49151', True)])
+
+
+class PhoneTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = PhoneTrie()
+
+    def add(self, *rules):
+        for rule in rules:
+            self.trie.add(parse_rule(rule))
+
+    def remove(self, *rules):
+        for rule in rules:
+            self.trie.remove(parse_rule(rule))
+
+    def test_exact_and_prefix(self):
+        self.add('49151', '4916*')
+
+        self.assertTrue(self.trie.match('49151'))
+        self.assertFalse(self.trie.match('491512'))
+        self.assertTrue(self.trie.match('4916'))
+        self.assertTrue(self.trie.match('491600'))
+        self.assertFalse(self.trie.match('4917'))
+
+    def test_range(self):
+        self.add('49160..49169')
+
+        self.assertTrue(self.trie.match('49160123'))
+        self.assertTrue(self.trie.match('49169'))
+        self.assertFalse(self.trie.match('49170'))
+        self.assertFalse(self.trie.match('49159999'))
+
+    def test_overlapping_remove(self):
+        self.add('49*', '4915*', '49151')
+
+        self.remove('4915*')
+        self.assertTrue(self.trie.match('491520'))
+        self.assertTrue(self.trie.match('49151'))
+
+        self.remove('49*')
+        self.assertFalse(self.trie.match('491520'))
+        self.assertTrue(self.trie.match('49151'))
+
+        self.remove('49151')
+        self.assertFalse(self.trie.match('49151'))
+
+    def test_overlapping_ranges(self):
+        self.add('49150..49159', '49155..49164')
+
+        self.remove('49150..49159')
+        self.assertFalse(self.trie.match('49152'))
+        self.assertTrue(self.trie.match('49157'))
+        self.assertTrue(self.trie.match('49160'))
+
+        self.remove('49155..49164')
+        self.assertFalse(self.trie.match('49157'))
+
+    def test_same_rule_twice(self):
+        self.add('4915*', '4915*')
+
+        self.remove('4915*')
+        self.assertTrue(self.trie.match('49151'))
+
+        self.remove('4915*')
+        self.assertFalse(self.trie.match('49151'))
+
+    def test_clear(self):
+        self.add('49*')
+        self.trie.clear()
+
+        self.assertFalse(self.trie.match('49151'))
+
+    def test_match_normalized_phone(self):
+        self.add('4915*')
+
+        self.assertTrue(self.trie.match(normalize('+49 151 123')))
+
+
+if __name__ == '__main__':
+    unittest.main()
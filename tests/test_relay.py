@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the delivery queues of the relay."""
+
+import threading
+import time
+import unittest
+
+import tests
+
+tests.init_bridge()
+
+from wat_bridge import relay
+from wat_bridge.relay import DeliveryQueue, OVERFLOW_DROP_OLDEST
+from wat_bridge.static import SIGNAL_TG
+
+
+class Failure(Exception):
+    pass
+
+
+class TransientFailure(Exception):
+    transient = True
+
+
+def _run(queue, item_count, timeout=5):
+    """Start the queue and wait until `item_count` items are finished.
+
+    Returns:
+        `True` if the items were delivered or given up before the timeout.
+    """
+    queue.start()
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        finished = sum(s['delivered'] + s['failed'] for s in queue.stats())
+
+        if finished >= item_count:
+            return True
+
+        time.sleep(0.01)
+
+    return False
+
+
+class OverflowTest(unittest.TestCase):
+
+    def test_drop_oldest_discards_the_oldest_item(self):
+        dropped = []
+        queue = DeliveryQueue(
+            'test',
+            lambda **kw: None,
+            maxsize=2,
+            overflow=OVERFLOW_DROP_OLDEST,
+            on_drop=lambda **kw: dropped.append(kw['n'])
+        )
+
+        for n in range(4):
+            queue.put('key', n=n)
+
+        self.assertEqual(dropped, [0, 1])
+        self.assertEqual(queue.depth(), 2)
+        self.assertEqual(queue.stats()[0]['dropped'], 2)
+        self.assertEqual(list(queue.shards[0].items), [{'n': 2}, {'n': 3}])
+
+    def test_dropped_messages_are_done_in_the_outbox(self):
+        entry = relay.OUTBOX.append('tg', phone='49151', message='dropped')
+        kept = relay.OUTBOX.append('tg', phone='49152', message='kept')
+
+        relay._drop_tg(phone='49151', message='dropped', entries=[entry])
+
+        pending = [e[0] for e in relay.OUTBOX.pending()]
+        self.assertNotIn(entry, pending)
+        self.assertIn(kept, pending)
+
+        relay.OUTBOX.done(kept)
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_failed_item_is_given_up_after_the_retries(self):
+        attempts = []
+        failures = []
+        given_up = threading.Event()
+
+        def handler(**kwargs):
+            attempts.append(kwargs['n'])
+            raise Failure('down')
+
+        def on_fail(error, **kwargs):
+            failures.append((error, kwargs))
+            given_up.set()
+
+        queue = DeliveryQueue(
+            'test',
+            handler,
+            retries=2,
+            retry_base=0,
+            on_fail=on_fail
+        )
+        queue.put('key', n=1)
+        queue.start()
+
+        self.assertTrue(given_up.wait(5))
+        self.assertEqual(attempts, [1, 1, 1])
+        self.assertEqual(len(failures), 1)
+        self.assertIsInstance(failures[0][0], Failure)
+        self.assertEqual(failures[0][1], {'n': 1})
+        self.assertEqual(queue.stats()[0]['failed'], 1)
+        self.assertEqual(queue.stats()[0]['delivered'], 0)
+
+    def test_item_is_delivered_when_a_retry_succeeds(self):
+        attempts = []
+        failures = []
+
+        def handler(**kwargs):
+            attempts.append(kwargs['n'])
+
+            if len(attempts) < 2:
+                raise Failure('down')
+
+        queue = DeliveryQueue(
+            'test',
+            handler,
+            retries=2,
+            retry_base=0,
+            on_fail=lambda error, **kw: failures.append(error)
+        )
+        queue.put('key', n=1)
+        queue.put('key', n=2)
+
+        self.assertTrue(_run(queue, 2))
+        self.assertEqual(attempts, [1, 1, 2])
+        self.assertEqual(failures, [])
+        self.assertEqual(queue.stats()[0]['delivered'], 2)
+
+    def test_transient_errors_are_retried_past_the_retries(self):
+        queue = DeliveryQueue(
+            'test', None, retries=1, retry_base=0.5, retry_cap=3)
+
+        self.assertEqual(queue.retry_delay(Failure(), 0), 0.5)
+        self.assertIsNone(queue.retry_delay(Failure(), 1))
+        self.assertEqual(queue.retry_delay(TransientFailure(), 1), 1)
+        self.assertEqual(queue.retry_delay(TransientFailure(), 100), 3)
+
+    def test_failed_messages_are_done_and_notified(self):
+        notices = []
+
+        def receiver(sender, **kwargs):
+            notices.append(kwargs.get('notice'))
+
+        entry = relay.OUTBOX.append('tg', phone='49151', message='failed')
+
+        SIGNAL_TG.connect(receiver)
+
+        try:
+            relay._fail_tg(
+                Failure('down'),
+                phone='49151',
+                message='failed',
+                entries=[entry]
+            )
+
+        finally:
+            SIGNAL_TG.disconnect(receiver)
+
+        self.assertNotIn(entry, [e[0] for e in relay.OUTBOX.pending()])
+        self.assertEqual(len(notices), 1)
+        self.assertIn('49151', notices[0])
+        self.assertIn('down', notices[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Tests for the webhook server, posting fake updates with a local client."""
+
+import json
+import threading
+import unittest
+
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+
+try:
+    from wat_bridge import webhook
+
+except Exception:
+    # pyTelegramBotAPI is missing or does not support this Python version
+    webhook = None
+
+SECRET = 'secret-token'
+
+
+class FakeBot(object):
+    """Collects the updates instead of calling handlers."""
+
+    def __init__(self):
+        self.updates = []
+
+    def process_new_updates(self, updates):
+        self.updates.extend(updates)
+
+
+@unittest.skipIf(webhook is None, 'pyTelegramBotAPI is not available')
+class WebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = FakeBot()
+        self.server = webhook.make_server(
+            self.bot, '127.0.0.1', 0, path='/hook', secret=SECRET)
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, body, path='/hook', secret=SECRET):
+        """Post a request and obtain its HTTP status."""
+        url = 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+        request = Request(url, data=body, headers={'Content-Type': 'application/json'})
+
+        if secret is not None:
+            request.add_header(webhook.SECRET_HEADER, secret)
+
+        try:
+            return urlopen(request, timeout=5).getcode()
+
+        except HTTPError as e:
+            return e.code
+
+    def update(self, update_id):
+        return json.dumps({'update_id': update_id}).encode('utf-8')
+
+    def test_update_is_processed(self):
+        self.assertEqual(self.post(self.update(1)), 200)
+        self.assertEqual(self.post(self.update(2)), 200)
+
+        self.assertEqual([u.update_id for u in self.bot.updates], [1, 2])
+
+    def test_wrong_secret_is_rejected(self):
+        self.assertEqual(self.post(self.update(1), secret='wrong'), 403)
+        self.assertEqual(self.post(self.update(1), secret=None), 403)
+
+        self.assertEqual(self.bot.updates, [])
+
+    def test_wrong_path_is_rejected(self):
+        self.assertEqual(self.post(self.update(1), path='/other'), 404)
+
+        self.assertEqual(self.bot.updates, [])
+
+    def test_invalid_update_is_rejected(self):
+        self.assertEqual(self.post(b'not json'), 400)
+
+        self.assertEqual(self.bot.updates, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
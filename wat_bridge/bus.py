@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Local message bus between the processes of the split mode.
+
+In split mode the Whatsapp side and the Telegram side of the bridge run in
+separate processes. The signals that cross from one side to the other are
+sent as envelopes over a Unix domain socket: each envelope is a JSON object
+preceded by its length as a 4 byte big-endian integer.
+
+Envelopes have a `type`:
+
+- `request`: a signal that expects an `ack` envelope with the same `id`,
+  carrying the `result` of the handler in the other process (or an `error`)
+- `event`: a signal that does not expect an answer
+- `ack`: the answer to a request
+
+A request may carry a `key`: the other process handles each key only once,
+so that a request sent again after losing the connection (or its `ack`) is
+not handled twice.
+
+The Whatsapp process listens on the socket and the Telegram process
+connects to it, reconnecting whenever the other process restarts.
+"""
+
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from wat_bridge.helper import REGISTRY
+from wat_bridge.metrics import METRICS
+from wat_bridge.static import SETTINGS, SIGNAL_DB, SIGNAL_QUEUES, SIGNAL_TG, \
+        SIGNAL_WA, get_logger
+from wat_bridge.tg import tgsender
+
+logger = get_logger('bus')
+
+BUS_ENVELOPES = METRICS.counter(
+    'watbridge_bus_envelopes_total',
+    'Envelopes exchanged through the bus, by direction and type.',
+    ('direction', 'type')
+)
+
+# Length prefix of the envelopes
+HEADER = struct.Struct('!I')
+
+# Largest envelope accepted
+MAX_ENVELOPE = 16 * 1024 * 1024
+
+# Number of handled request keys remembered
+MAX_KEYS = 10000
+
+
+class BusError(Exception):
+    """The other process could not be reached or failed to handle a signal."""
+    pass
+
+
+class BusUnavailable(BusError):
+    """The other process could not be reached (e.g. while it restarts).
+
+    The signal may be sent again later: its `transient` attribute tells the
+    delivery queues to retry it for as long as needed.
+    """
+    transient = True
+
+
+def send_envelope(sock, envelope):
+    """Write an envelope to a socket."""
+    data = json.dumps(envelope, separators=(',', ':')).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    """Read exactly `size` bytes, or `None` if the connection was closed."""
+    data = b''
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+
+        if not chunk:
+            return None
+
+        data += chunk
+
+    return data
+
+
+def recv_envelope(sock):
+    """Read an envelope from a socket.
+
+    Returns:
+        Envelope dict, or `None` if the connection was closed.
+
+    Raises:
+        ValueError: if the envelope is not valid.
+    """
+    header = _recv_exact(sock, HEADER.size)
+
+    if header is None:
+        return None
+
+    size = HEADER.unpack(header)[0]
+
+    if size > MAX_ENVELOPE:
+        raise ValueError('envelope too large: %d bytes' % size)
+
+    data = _recv_exact(sock, size)
+
+    if data is None:
+        return None
+
+    return json.loads(data.decode('utf-8'))
+
+
+class Bus(object):
+    """Endpoint of the bus in one of the processes.
+
+    Incoming envelopes are handled in their own thread, so that a slow
+    handler does not delay the others. Senders wait for the `ack` of a
+    request before sending the next one, which keeps the order of messages.
+
+    Args:
+        path (str): Path of the Unix domain socket.
+        listen (bool): Whether to listen on the socket or connect to it.
+        timeout (float): Seconds to wait for the other process to connect.
+        reply_timeout (float): Seconds to wait for the answer to a request.
+        retry (float): Seconds between connection attempts.
+
+    The owner may set `on_connect` to a function without arguments that is
+    called whenever the connection to the other process is (re)established.
+    """
+
+    def __init__(self, path, listen=False, timeout=30.0, reply_timeout=300.0, retry=1.0):
+        self.path = path
+        self.listen = listen
+        self.timeout = timeout
+        self.reply_timeout = reply_timeout
+        self.retry = retry
+
+        self.handlers = {}
+        self.conn = None
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()
+
+        self.pending = {}
+        self.next_id = 1
+        self.on_connect = None
+
+        # Request keys being handled, and the last ones already handled
+        self.handling = set()
+        self.handled = collections.OrderedDict()
+
+    def handle(self, name, func):
+        """Handle the envelopes of a signal received from the other process.
+
+        Args:
+            name (str): Name of the signal.
+            func: Function called with the keyword arguments of the signal,
+                its result is sent back to the other process.
+        """
+        self.handlers[name] = func
+
+    def serve(self, signal):
+        """Send the signals received from the other process to local receivers.
+
+        The first result other than `None` is sent back.
+        """
+        def dispatch(**kwargs):
+            for _, result in signal.send('bus', **kwargs):
+                if result is not None:
+                    return result
+
+        self.handle(signal.name, dispatch)
+
+    def forward(self, signal, wait=True, fallback=None):
+        """Send a local signal to the other process.
+
+        Args:
+            signal: Blinker signal to forward.
+            wait (bool): Whether to wait for the result of the handler in
+                the other process.
+            fallback: Function called with the `BusError` and the keyword
+                arguments of the signal when it cannot be delivered; its
+                result is returned to the sender. Without it, the error is
+                raised.
+
+        A `key` keyword argument of the signal is not forwarded, but used as
+        the key of the request (see `request()`).
+        """
+        def receiver(sender, **kwargs):
+            key = kwargs.pop('key', None)
+
+            if not wait:
+                self.notify(signal.name, **kwargs)
+                return None
+
+            try:
+                return self.request(signal.name, key=key, **kwargs)
+
+            except BusError as e:
+                if fallback is None:
+                    raise
+
+                return fallback(e, **kwargs)
+
+        signal.connect(receiver, weak=False)
+
+    def start(self):
+        """Start listening (or connecting) in the background."""
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        if self.listen:
+            self._run_server()
+
+        else:
+            self._run_client()
+
+    def _run_server(self):
+        if os.path.exists(self.path):
+            # Left over by a previous run
+            os.remove(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen(1)
+
+        logger.info('listening on %s' % self.path)
+
+        while True:
+            conn, _ = server.accept()
+            self._attach(conn)
+
+    def _run_client(self):
+        while True:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                conn.connect(self.path)
+
+            except socket.error as e:
+                logger.debug('could not connect to %s: %s' % (self.path, e))
+                conn.close()
+
+            else:
+                self._attach(conn)
+
+            time.sleep(self.retry)
+
+    def _attach(self, conn):
+        """Use a connection until it is closed."""
+        logger.info('connected to the other process')
+
+        with self.cond:
+            self.conn = conn
+            self.cond.notify_all()
+
+        if self.on_connect:
+            try:
+                self.on_connect()
+
+            except Exception as e:
+                logger.error('bus connection hook failed: %s' % e)
+
+        try:
+            while True:
+                envelope = recv_envelope(conn)
+
+                if envelope is None:
+                    break
+
+                self._receive(envelope)
+
+        except (socket.error, ValueError) as e:
+            logger.error('bus connection failed: %s' % e)
+
+        finally:
+            self._detach(conn)
+
+    def _detach(self, conn):
+        """Forget a closed connection and fail the requests waiting on it."""
+        logger.info('disconnected from the other process')
+
+        with self.cond:
+            if self.conn is conn:
+                self.conn = None
+
+            pending, self.pending = self.pending, {}
+
+        for request in pending.values():
+            request['error'] = 'connection lost'
+            request['lost'] = True
+            request['event'].set()
+
+        conn.close()
+
+    def _receive(self, envelope):
+        kind = envelope.get('type')
+        BUS_ENVELOPES.inc(direction='received', type=kind)
+
+        if kind == 'ack':
+            with self.cond:
+                request = self.pending.pop(envelope.get('id'), None)
+
+            if request:
+                request['result'] = envelope.get('result')
+                request['error'] = envelope.get('error')
+                request['busy'] = envelope.get('busy', False)
+                request['event'].set()
+
+        elif kind in ('request', 'event'):
+            thread = threading.Thread(target=self._dispatch, args=(envelope,))
+            thread.daemon = True
+            thread.start()
+
+        else:
+            logger.warning('ignoring unknown envelope type: %s' % kind)
+
+    def _dispatch(self, envelope):
+        """Call the handler of a signal received from the other process."""
+        name = envelope.get('name')
+        key = envelope.get('key')
+        handler = self.handlers.get(name)
+        result = None
+        error = None
+        busy = False
+
+        if handler is None:
+            error = 'no handler for %s' % name
+
+        elif key is not None:
+            with self.cond:
+                if key in self.handled:
+                    # Sent again after losing the ack, do not handle twice
+                    logger.debug('%s already handled: %s' % (name, key))
+                    handler = None
+
+                elif key in self.handling:
+                    # Still being handled, the sender should try again later
+                    error = '%s is already being handled' % name
+                    busy = True
+                    handler = None
+
+                else:
+                    self.handling.add(key)
+
+        if handler is not None:
+            try:
+                result = handler(**envelope.get('kwargs', {}))
+
+            except Exception as e:
+                logger.error('%s handler failed: %s' % (name, e))
+                error = str(e)
+
+            if key is not None:
+                with self.cond:
+                    self.handling.discard(key)
+
+                    if error is None:
+                        self.handled[key] = True
+
+                        while len(self.handled) > MAX_KEYS:
+                            self.handled.popitem(last=False)
+
+        if envelope['type'] != 'request':
+            return
+
+        try:
+            self._send({
+                'type': 'ack',
+                'id': envelope['id'],
+                'result': result,
+                'error': error,
+                'busy': busy
+            })
+
+        except BusError as e:
+            logger.warning('could not acknowledge %s: %s' % (name, e))
+
+    def _send(self, envelope, timeout=0):
+        """Send an envelope, waiting up to `timeout` seconds for a connection."""
+        deadline = time.time() + timeout
+
+        with self.cond:
+            while self.conn is None:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    raise BusUnavailable('not connected to the other process')
+
+                self.cond.wait(remaining)
+
+            conn = self.conn
+
+        try:
+            with self.send_lock:
+                send_envelope(conn, envelope)
+
+        except socket.error as e:
+            raise BusUnavailable('could not send to the other process: %s' % e)
+
+        BUS_ENVELOPES.inc(direction='sent', type=envelope['type'])
+
+    def request(self, name, key=None, **kwargs):
+        """Send a signal to the other process and wait for its result.
+
+        Args:
+            name (str): Name of the signal.
+            key (str): Unique key of the request. A request whose key was
+                already handled by the other process is acknowledged
+                without handling it again.
+            **kwargs: JSON serializable arguments of the signal.
+
+        Returns:
+            Result of the handler in the other process.
+
+        Raises:
+            BusUnavailable: if the other process could not be reached, or
+                the outcome of the request is unknown.
+            BusError: if the signal could not be handled.
+        """
+        request = {
+            'event': threading.Event(),
+            'result': None,
+            'error': None,
+            'busy': False,
+            'lost': False
+        }
+        envelope = {'type': 'request', 'name': name, 'kwargs': kwargs}
+
+        if key is not None:
+            envelope['key'] = key
+
+        with self.cond:
+            rid = self.next_id
+            self.next_id += 1
+            self.pending[rid] = request
+
+        envelope['id'] = rid
+
+        try:
+            self._send(envelope, self.timeout)
+
+            if not request['event'].wait(self.reply_timeout):
+                raise BusUnavailable('timed out waiting for %s' % name)
+
+        finally:
+            with self.cond:
+                self.pending.pop(rid, None)
+
+        if request['busy'] or request['lost']:
+            raise BusUnavailable(request['error'])
+
+        if request['error']:
+            raise BusError(request['error'])
+
+        return request['result']
+
+    def notify(self, name, **kwargs):
+        """Send a signal to the other process without waiting for it.
+
+        The signal is dropped if the other process is not connected.
+        """
+        try:
+            self._send({'type': 'event', 'name': name, 'kwargs': kwargs})
+
+        except BusError as e:
+            logger.warning('dropped %s: %s' % (name, e))
+
+
+def _wa_unreachable(error, **kwargs):
+    """Tell the owner that a message could not be passed to Whatsapp."""
+    logger.error('could not reach the Whatsapp process: %s' % error)
+
+    tgsender.send_message(
+        SETTINGS['owner'],
+        'Whatsapp is not available, message to "%s" was not sent' % kwargs.get('contact')
+    )
+
+
+def start_bus(role):
+    """Connect the signals of one side of the bridge to the other process.
+
+    Args:
+        role (str): `wa` or `tg`, the side run by this process.
+
+    Returns:
+        The started `Bus`.
+    """
+    bus = Bus(
+        SETTINGS['bus_path'],
+        listen=role == 'wa',
+        timeout=SETTINGS['bus_timeout'],
+        reply_timeout=SETTINGS['bus_reply_timeout']
+    )
+
+    if role == 'wa':
+        bus.serve(SIGNAL_WA)
+        bus.serve(SIGNAL_QUEUES)
+        bus.forward(SIGNAL_TG)
+
+    else:
+        bus.serve(SIGNAL_TG)
+        bus.forward(SIGNAL_WA, fallback=_wa_unreachable)
+        bus.forward(SIGNAL_QUEUES, fallback=lambda error, **kwargs: None)
+
+    # Contacts are cached in memory, reload them when the other process
+    # changes them. Changes notified while disconnected are lost, so they
+    # are reloaded after connecting as well
+    bus.handle(SIGNAL_DB.name, lambda **kwargs: REGISTRY.invalidate())
+    bus.forward(SIGNAL_DB, wait=False)
+    bus.on_connect = REGISTRY.invalidate
+
+    bus.start()
+
+    return bus
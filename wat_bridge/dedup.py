@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Window of recently relayed message ids used to drop duplicates."""
+
+import collections
+import os
+import threading
+import time
+
+from wat_bridge.metrics import METRICS
+from wat_bridge.static import SETTINGS, get_logger
+
+logger = get_logger('dedup')
+
+DUPLICATES = METRICS.counter(
+    'watbridge_duplicates_total',
+    'Messages dropped because they had already been relayed.',
+    ('network',)
+)
+
+
+class DedupWindow(object):
+    """Bounded set of recently seen message keys.
+
+    Keys are forgotten after `ttl` seconds, and only the `max_size` most
+    recent keys are kept, so memory does not grow with traffic.
+
+    If a path is given, keys are also appended to a log file (one
+    ``<timestamp> <key>`` record per line) so that duplicates delivered
+    right after a restart are detected as well. The file is rewritten with
+    the keys still in the window once it holds twice as many records.
+
+    Args:
+        ttl (float): Seconds a key is remembered for.
+        max_size (int): Maximum number of keys remembered.
+        path (str): Path to the log file, `None` to keep keys in memory only.
+    """
+
+    def __init__(self, ttl=86400, max_size=10000, path=None):
+        self.ttl = ttl
+        self.max_size = max(max_size, 1)
+        self.path = path
+
+        self.lock = threading.Lock()
+
+        # key -> time seen, oldest first
+        self.keys = collections.OrderedDict()
+
+        self.records = 0
+        self.log = None
+
+        if self.path:
+            self._load()
+            self._rewrite()
+            self.log = open(self.path, 'a')
+
+    def _load(self):
+        """Read the keys from the log file."""
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # Incomplete write
+                    break
+
+                try:
+                    stamp, key = line[:-1].split(' ', 1)
+                    self.keys.pop(key, None)
+                    self.keys[key] = float(stamp)
+
+                except ValueError:
+                    logger.warning('ignoring invalid dedup record')
+
+        self._expire(time.time())
+
+    def _rewrite(self):
+        """Write the keys in the window to a new log file."""
+        tmp_path = self.path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            for key, stamp in self.keys.items():
+                f.write('%f %s\n' % (stamp, key))
+
+        os.rename(tmp_path, self.path)
+
+        self.records = len(self.keys)
+
+    def _expire(self, now):
+        while self.keys:
+            stamp = next(iter(self.keys.values()))
+
+            if now - stamp < self.ttl and len(self.keys) <= self.max_size:
+                break
+
+            self.keys.popitem(last=False)
+
+    def seen(self, key):
+        """Check whether a key was seen before, and remember it.
+
+        Args:
+            key (str): Key of the message, must not contain line breaks.
+
+        Returns:
+            True if the key is in the window (the message is a duplicate),
+            False otherwise.
+        """
+        with self.lock:
+            if self._contains(key):
+                return True
+
+            self._add(key)
+
+            return False
+
+    def contains(self, key):
+        """Check whether a key was seen before, without remembering it."""
+        with self.lock:
+            return self._contains(key)
+
+    def add(self, key):
+        """Remember a key, if it is not in the window already."""
+        with self.lock:
+            if not self._contains(key):
+                self._add(key)
+
+    def _contains(self, key):
+        self._expire(time.time())
+
+        return key in self.keys
+
+    def _add(self, key):
+        now = time.time()
+
+        self.keys[key] = now
+        self._expire(now)
+
+        if self.log:
+            self.log.write('%f %s\n' % (now, key))
+            self.log.flush()
+            self.records += 1
+
+            if self.records > 2 * self.max_size:
+                self.log.close()
+                self._rewrite()
+                self.log = open(self.path, 'a')
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def is_duplicate(network, *parts):
+    """Check whether a message was already relayed.
+
+    Args:
+        network (str): Network the message was received from.
+        *parts: Values identifying the message in that network.
+
+    Returns:
+        True if the message must be dropped.
+    """
+    if DEDUP is None:
+        return False
+
+    key = _key(network, parts)
+
+    if DEDUP.seen(key):
+        _dropped(network, key)
+        return True
+
+    return False
+
+def was_relayed(network, *parts):
+    """Check whether a message was already relayed, without remembering it.
+
+    Used when the message must only be remembered once it is stored (see
+    `mark_relayed()`), so that it is not lost if the bridge stops before.
+
+    Args:
+        network (str): Network the message was received from.
+        *parts: Values identifying the message in that network.
+
+    Returns:
+        True if the message must be dropped.
+    """
+    if DEDUP is None:
+        return False
+
+    key = _key(network, parts)
+
+    if DEDUP.contains(key):
+        _dropped(network, key)
+        return True
+
+    return False
+
+def mark_relayed(network, *parts):
+    """Remember a message checked with `was_relayed()`.
+
+    Args:
+        network (str): Network the message was received from.
+        *parts: Values identifying the message in that network.
+    """
+    if DEDUP is not None:
+        DEDUP.add(_key(network, parts))
+
+def _key(network, parts):
+    return '%s:%s' % (network, ':'.join(str(p) for p in parts))
+
+def _dropped(network, key):
+    logger.info('dropping duplicate message %s' % key)
+    DUPLICATES.inc(network=network)
+
+
+# Messages relayed by this process
+DEDUP = None
+
+if SETTINGS['dedup_enabled']:
+    DEDUP = DedupWindow(
+        ttl=SETTINGS['dedup_ttl'],
+        max_size=SETTINGS['dedup_size'],
+        path=SETTINGS['dedup_path']
+    )
@@ -27,18 +27,480 @@
 
 """Helper functions."""
 
-from wat_bridge.static import DB, CONTACT
+import bisect
+import csv
+import io
+import six
+import threading
 
-def db_add_blacklist(phone):
-    """Add a new blacklisted phone to the database.
+from wat_bridge.metrics import DB_LOOKUP
+from wat_bridge.phones import PhoneTrie, group_jid, is_group, normalize, parse_rule
+from wat_bridge.static import DB, SIGNAL_DB, get_logger
+
+logger = get_logger('helper')
+
+
+class ContactRegistry(object):
+    """In-memory indexes over the contacts table.
+
+    The table is read once (lazily, on first access) and lookups are then
+    served from dictionaries keyed by phone, lowercase name and group id.
+    Writers must go through the ``insert``, ``update`` and ``remove`` methods
+    so that the database and the indexes are kept in sync.
+
+    Each index maps a key to the list of element ids that have it, in
+    insertion order, so that lookups return the same element a TinyDB
+    ``get()`` would have returned.
+
+    Contacts and blacklisted phones are also kept in sorted lists of
+    ``(key, eid)`` tuples, so that listings can be paged from a cursor
+    without sorting the whole table on every request. Their search terms
+    (see `_search_terms()`) are kept sorted as well, so that the elements
+    matching a filter are found without scanning the whole listing.
+
+    Whatsapp groups are stored like contacts, with the group JID as phone,
+    and are indexed by JID apart from the contacts.
+
+    Blacklisted entries store a rule (see `wat_bridge.phones`) that is also
+    compiled into a trie, updated along with the other indexes. They are
+    indexed by their canonical rule, and rules stored in any other form
+    (e.g. by older versions) are rewritten when the table is loaded.
 
     Args:
-        phone (str): Phone of the contact.
+        db (Storage): Storage backend holding the elements.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.RLock()
+        self.loaded = False
+
+        # eid -> element
+        self.elements = {}
+
+        # Indexes
+        self.contacts = {}
+        self.names = {}
+        self.blacklist = {}
+        self.groups = {}
+        self.wa_groups = {}
+
+        # Compiled blacklist rules
+        self.rules = PhoneTrie()
+
+        # Sorted listings: kind -> [(key, eid)]
+        self.ordered = {'contacts': [], 'blacklist': []}
+
+        # Sorted search terms: kind -> [(term, eid)]
+        self.search = {'contacts': [], 'blacklist': []}
+
+    def load(self):
+        """Read the whole table and build the indexes."""
+        with self.lock:
+            # Cleared in place, callers may hold a reference to an index
+            self.elements.clear()
+            self.contacts.clear()
+            self.names.clear()
+            self.blacklist.clear()
+            self.groups.clear()
+            self.wa_groups.clear()
+
+            self.rules.clear()
+
+            for ordered in self.ordered.values():
+                del ordered[:]
+
+            for terms in self.search.values():
+                del terms[:]
+
+            rows = self.db.all()
+            self._normalize_rules(rows)
+
+            for eid, element in rows:
+                self._index(eid, element, keep_sorted=False)
+
+            self._sort()
+
+            self.loaded = True
+
+    def _normalize_rules(self, rows):
+        """Store the blacklist rules of the given rows in canonical form.
+
+        Rows are updated in place. A rule that is already stored in
+        canonical form by another row is removed instead.
+        """
+        blacklisted = [(eid, e, _rule(e)) for eid, e in rows if e.get('blacklisted')]
+        canonical = set(rule for _, e, rule in blacklisted if rule == e['phone'])
+        duplicates = set()
+
+        for eid, element, rule in blacklisted:
+            if rule == element['phone']:
+                continue
+
+            if rule in canonical:
+                duplicates.add(eid)
+                continue
+
+            logger.info('normalizing blacklist rule %s to %s' % (element['phone'], rule))
+
+            self.db.update({'phone': rule}, [eid])
+            element['phone'] = rule
+            canonical.add(rule)
+
+        if duplicates:
+            logger.info('removing %d duplicated blacklist rules' % len(duplicates))
+
+            self.db.remove(sorted(duplicates))
+            rows[:] = [(eid, e) for eid, e in rows if eid not in duplicates]
+
+    def invalidate(self):
+        """Read the table again on next access.
+
+        Used when another process changed the database.
+        """
+        with self.lock:
+            self.loaded = False
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def _sort(self):
+        """Sort the listings and search terms after adding several elements."""
+        for ordered in self.ordered.values():
+            ordered.sort()
+
+        for terms in self.search.values():
+            terms.sort()
+
+    def _index(self, eid, element, keep_sorted=True):
+        """Add an element to the indexes.
+
+        Args:
+            eid (int): ID of the element.
+            element (dict): Element to add.
+            keep_sorted (bool): Whether to insert the element in order in
+                the sorted lists. When adding many elements, it is faster to
+                append them and call `_sort()` once at the end.
+        """
+        self.elements[eid] = element
+
+        if element.get('blacklisted'):
+            rule = parse_rule(element['phone'])
+            self.blacklist.setdefault(rule or element['phone'], []).append(eid)
+
+            if rule:
+                self.rules.add(rule)
+
+        elif is_group(element['phone']):
+            self.wa_groups.setdefault(element['phone'], []).append(eid)
+
+        else:
+            self.contacts.setdefault(element['phone'], []).append(eid)
+
+        if element.get('name') is not None:
+            self.names.setdefault(element['name'], []).append(eid)
+
+        if element.get('group') is not None:
+            self.groups.setdefault(element['group'], []).append(eid)
+
+        kind = _kind(element)
+        add = bisect.insort if keep_sorted else list.append
+
+        add(self.ordered[kind], (_sort_key(element), eid))
+
+        for term in _search_terms(element):
+            add(self.search[kind], (term, eid))
+
+    def _unindex(self, eid):
+        """Remove an element from the indexes."""
+        element = self.elements.pop(eid)
+
+        if element.get('blacklisted'):
+            rule = parse_rule(element['phone'])
+            _drop(self.blacklist, rule or element['phone'], eid)
+
+            if rule:
+                self.rules.remove(rule)
+
+        elif is_group(element['phone']):
+            _drop(self.wa_groups, element['phone'], eid)
+
+        else:
+            _drop(self.contacts, element['phone'], eid)
+
+        _drop(self.names, element.get('name'), eid)
+        _drop(self.groups, element.get('group'), eid)
+
+        kind = _kind(element)
+        _remove_sorted(self.ordered[kind], (_sort_key(element), eid))
+
+        for term in _search_terms(element):
+            _remove_sorted(self.search[kind], (term, eid))
+
+        return element
+
+    def first(self, index, key):
+        """Obtain the first element found in an index for the given key.
+
+        Args:
+            index (dict): One of the registry indexes.
+            key: Key to look for.
+
+        Returns:
+            Element dict or `None` if not found.
+        """
+        with self.lock:
+            self._ensure_loaded()
+
+            eids = index.get(key)
+
+            if not eids:
+                return None
+
+            return self.elements[eids[0]]
+
+    def matches_rule(self, phone):
+        """Check whether a canonical phone matches a blacklist rule."""
+        with self.lock:
+            self._ensure_loaded()
+
+            return self.rules.match(phone)
+
+    def eids(self, index, key):
+        """Obtain a copy of the element ids stored in an index for a key."""
+        with self.lock:
+            self._ensure_loaded()
+
+            return list(index.get(key, ()))
+
+    def values(self):
+        """Obtain a snapshot of every element in insertion order."""
+        with self.lock:
+            self._ensure_loaded()
+
+            return [self.elements[eid] for eid in sorted(self.elements)]
+
+    def page(self, kind, size, cursor=None, backwards=False, prefix=None):
+        """Obtain a page of a sorted listing.
+
+        Args:
+            kind (str): Either ``'contacts'`` (sorted by name) or
+                ``'blacklist'`` (sorted by phone).
+            size (int): Maximum number of elements in the page.
+            cursor (int): ID of the element the page starts after (or ends
+                before, when going backwards). If `None` or no longer
+                stored, the first page is returned.
+            backwards (bool): Whether to return the elements before the
+                cursor instead of those after it.
+            prefix (str): Only include elements with a search term starting
+                with it. The matching elements are looked up in the sorted
+                search terms and sorted on every call, so the cost depends
+                on how many elements match rather than on the size of the
+                listing.
+
+        Returns:
+            Tuple with the list of (eid, element) tuples of the page and two
+            booleans telling whether there are matching elements before and
+            after it.
+        """
+        with self.lock:
+            self._ensure_loaded()
+
+            if prefix:
+                listing = self._matching(kind, prefix)
+            else:
+                listing = self.ordered[kind]
+
+            element = self.elements.get(cursor)
+
+            if element is None or _kind(element) != kind:
+                start = 0
+                end = size
+
+            else:
+                entry = (_sort_key(element), cursor)
+                pos = bisect.bisect_left(listing, entry)
+
+                if backwards:
+                    start = max(pos - size, 0)
+                    end = pos
+
+                else:
+                    if pos < len(listing) and listing[pos] == entry:
+                        # The cursor itself may not match the filter
+                        pos += 1
+
+                    start = pos
+                    end = pos + size
+
+            end = min(end, len(listing))
+
+            if start >= end:
+                return [], False, False
+
+            result = [(eid, dict(self.elements[eid])) for _, eid in listing[start:end]]
+
+            return result, start > 0, end < len(listing)
+
+    def _matching(self, kind, prefix):
+        """Obtain the sorted listing of the elements matching a prefix."""
+        terms = self.search[kind]
+        pos = bisect.bisect_left(terms, (prefix,))
+        eids = set()
+
+        while pos < len(terms) and terms[pos][0].startswith(prefix):
+            eids.add(terms[pos][1])
+            pos += 1
+
+        return sorted((_sort_key(self.elements[eid]), eid) for eid in eids)
+
+    def insert(self, element):
+        """Insert an element in the database and index it.
+
+        Returns:
+            ID of the inserted element.
+        """
+        with self.lock:
+            self._ensure_loaded()
+
+            eid = self.db.insert(element)
+            self._index(eid, dict(element))
+
+        SIGNAL_DB.send('registry')
+
+        return eid
+
+    def insert_many(self, elements):
+        """Insert several elements in a single write and index them.
+
+        Returns:
+            List with the IDs of the inserted elements.
+        """
+        if not elements:
+            return []
+
+        with self.lock:
+            self._ensure_loaded()
+
+            eids = self.db.insert_many(elements)
+
+            for eid, element in zip(eids, elements):
+                self._index(eid, dict(element), keep_sorted=False)
+
+            self._sort()
+
+        SIGNAL_DB.send('registry')
+
+        return eids
+
+    def update(self, fields, eids):
+        """Update the given elements in the database and reindex them."""
+        if not eids:
+            return
+
+        with self.lock:
+            self._ensure_loaded()
+
+            self.db.update(fields, eids)
+
+            for eid in eids:
+                element = self._unindex(eid)
+                element.update(fields)
+                self._index(eid, element)
+
+        SIGNAL_DB.send('registry')
+
+    def remove(self, eids):
+        """Remove the given elements from the database and the indexes."""
+        if not eids:
+            return
+
+        with self.lock:
+            self._ensure_loaded()
+
+            self.db.remove(eids)
+
+            for eid in eids:
+                self._unindex(eid)
+
+        SIGNAL_DB.send('registry')
+
+
+def _kind(element):
+    """Sorted listing an element belongs to."""
+    return 'blacklist' if element.get('blacklisted') else 'contacts'
+
+def _rule(element):
+    """Canonical form of the rule of a blacklisted element."""
+    return parse_rule(element['phone']) or element['phone']
+
+def _sort_key(element):
+    """Key an element is sorted by in its listing.
+
+    Blacklist rules in the registry are always in canonical form (see
+    `ContactRegistry.load()`), so they are not parsed again here.
+    """
+    if element.get('blacklisted'):
+        return element['phone']
+
+    return element.get('name') or ''
+
+def _search_terms(element):
+    """Terms an element can be found by in its listing.
+
+    Contacts are found by their lowercase name and by their phone,
+    blacklist entries by their rule.
+    """
+    if element.get('blacklisted'):
+        return [element['phone']]
+
+    terms = [element['phone']]
+
+    if element.get('name'):
+        terms.append(element['name'].lower())
+
+    return terms
+
+def _remove_sorted(ordered, entry):
+    """Remove an entry from a sorted list, if present."""
+    pos = bisect.bisect_left(ordered, entry)
+
+    if pos < len(ordered) and ordered[pos] == entry:
+        del ordered[pos]
+
+def _drop(index, key, eid):
+    """Remove an element id from an index, discarding empty keys."""
+    if key is None:
+        return
+
+    eids = index.get(key)
+
+    if not eids:
+        return
+
+    eids.remove(eid)
+
+    if not eids:
+        del index[key]
+
+
+# Registry used by the helper functions
+REGISTRY = ContactRegistry(DB)
+
+
+def db_add_blacklist(rule):
+    """Add a new blacklist rule to the database.
+
+    Args:
+        rule (str): Phone, prefix or range, see `wat_bridge.phones`.
 
     Returns:
         ID of the inserted element.
     """
-    return DB.insert({'name': None, 'phone': phone, 'blacklisted': True, 'group': None})
+    rule = parse_rule(rule) or rule
+
+    return REGISTRY.insert({'name': None, 'phone': rule, 'blacklisted': True, 'group': None})
 
 def db_add_contact(name, phone):
     """Add a new contact to the database.
@@ -50,7 +512,151 @@ def db_add_contact(name, phone):
     Returns:
         ID of the inserted element.
     """
-    return DB.insert({'name': name.lower(), 'phone': phone, 'blacklisted': False, 'group': None})
+    phone = normalize(phone) or phone
+
+    return REGISTRY.insert({'name': name.lower(), 'phone': phone, 'blacklisted': False, 'group': None})
+
+def db_add_wa_group(name, jid, group):
+    """Add a Whatsapp group to the database, bound to a Telegram group.
+
+    Args:
+        name (str): Name to use for the group.
+        jid (str): JID of the Whatsapp group.
+        group (int): ID of the Telegram group.
+
+    Returns:
+        ID of the inserted element.
+    """
+    return REGISTRY.insert({'name': name.lower(), 'phone': jid, 'blacklisted': False, 'group': group})
+
+def db_import_contacts(rows):
+    """Add several contacts to the database in a single write.
+
+    Rows are checked against the contacts already stored and the previous
+    rows, and those that conflict are skipped.
+
+    Whatsapp groups (exported with their JID as phone) are stored as groups
+    again, instead of normalizing their JID as a phone.
+
+    Args:
+        rows (list): Tuples with (line, name, phone, group) of each contact,
+            the group may be `None`.
+
+    Returns:
+        Tuple with the number of added contacts and a list of
+        (line, reason) tuples with the skipped rows.
+    """
+    elements = []
+    conflicts = []
+
+    names = set()
+    phones = set()
+    groups = set()
+
+    with REGISTRY.lock:
+        for line, name, phone, group in rows:
+            name = (name or '').strip().lower()
+
+            if is_group((phone or '').strip()):
+                phone = group_jid(phone)
+                stored = REGISTRY.wa_groups
+            else:
+                phone = normalize(phone)
+                stored = REGISTRY.contacts
+
+            if not name or len(name.split()) != 1:
+                reason = 'invalid name'
+
+            elif not phone:
+                reason = 'invalid phone'
+
+            elif name in names or REGISTRY.first(REGISTRY.names, name):
+                reason = 'name "%s" already exists' % name
+
+            elif phone in phones or REGISTRY.first(stored, phone):
+                reason = 'phone %s already exists' % phone
+
+            elif group is not None and (group in groups or REGISTRY.first(REGISTRY.groups, group)):
+                reason = 'group %s is already bound' % group
+
+            else:
+                reason = None
+
+            if reason:
+                conflicts.append((line, reason))
+                continue
+
+            names.add(name)
+            phones.add(phone)
+            if group is not None:
+                groups.add(group)
+
+            elements.append({'name': name, 'phone': phone, 'blacklisted': False, 'group': group})
+
+        REGISTRY.insert_many(elements)
+
+    return len(elements), conflicts
+
+def contacts_from_csv(data):
+    """Parse a CSV file with contacts.
+
+    Each row contains the name, phone and (optionally) group of a contact. A
+    header row with the `name` and `phone` columns is skipped.
+
+    Args:
+        data (bytes): Content of the file, encoded in UTF-8.
+
+    Returns:
+        List of (line, name, phone, group) tuples, the group being `None` if
+        not given or not valid.
+    """
+    text = data.decode('utf-8-sig')
+
+    if six.PY2:
+        lines = text.encode('utf-8').splitlines()
+        reader = ([c.decode('utf-8') for c in row] for row in csv.reader(lines))
+
+    else:
+        reader = csv.reader(text.splitlines())
+
+    rows = []
+
+    for line, row in enumerate(reader, 1):
+        if not row or not any(c.strip() for c in row):
+            continue
+
+        if line == 1 and [c.strip().lower() for c in row[:2]] == ['name', 'phone']:
+            # Header
+            continue
+
+        row = row + [''] * (3 - len(row))
+        rows.append((line, row[0], row[1], safe_cast(row[2].strip(), int)))
+
+    return rows
+
+def contacts_to_csv():
+    """Write the contacts to a CSV file.
+
+    Returns:
+        Content of the file (bytes), encoded in UTF-8 and with a header row.
+    """
+    rows = [('name', 'phone', 'group')]
+    rows += [(n, p, '' if g is None else g) for n, p, g in db_list_contacts()]
+
+    if six.PY2:
+        output = io.BytesIO()
+        writer = csv.writer(output)
+
+        for row in rows:
+            writer.writerow([six.text_type(c).encode('utf-8') for c in row])
+
+        return output.getvalue()
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerows(rows)
+
+    return output.getvalue().encode('utf-8')
 
 def db_list_contacts():
     """Obtain a list of contacts.
@@ -60,17 +666,45 @@ def db_list_contacts():
     Returns:
         List of tuples
     """
-    result = DB.search(CONTACT.blacklisted == False)
+    result = [a for a in REGISTRY.values() if not a['blacklisted']]
 
     return [(a['name'], a['phone'], a.get('group')) for a in result]
 
-def db_rm_blacklist(phone):
-    """Removes a blacklisted phone from the database.
+def db_page(kind, size, cursor=None, backwards=False, query=None):
+    """Obtain a page of contacts or blacklisted phones.
 
     Args:
-        phone (str): Phone of the contact.
+        kind (str): Either ``'contacts'`` or ``'blacklist'``.
+        size (int): Maximum number of entries in the page.
+        cursor (int): ID of the entry the page starts after (or ends before,
+            when going backwards).
+        backwards (bool): Whether to return the page before the cursor.
+        query (str): Only return entries whose name or phone start with it
+            (names are compared ignoring case).
+
+    Returns:
+        Tuple with the list of (eid, name, phone, group) tuples and two
+        booleans telling whether there are previous and next pages.
     """
-    DB.remove((CONTACT.phone == phone) & (CONTACT.blacklisted == True))
+    if query:
+        query = query.lower()
+
+    result, before, after = REGISTRY.page(
+        kind, size, cursor=cursor, backwards=backwards, prefix=query)
+
+    rows = [(eid, e.get('name'), e['phone'], e.get('group')) for eid, e in result]
+
+    return rows, before, after
+
+def db_rm_blacklist(rule):
+    """Removes a blacklist rule from the database.
+
+    Args:
+        rule (str): Phone, prefix or range, see `wat_bridge.phones`.
+    """
+    rule = parse_rule(rule) or rule
+
+    REGISTRY.remove(REGISTRY.eids(REGISTRY.blacklist, rule))
 
 def db_rm_contact(name):
     """Remove a contact from the the database.
@@ -78,7 +712,7 @@ def db_rm_contact(name):
     Args:
         name (str): Name of the contact to remove.
     """
-    DB.remove(CONTACT.name == name.lower())
+    REGISTRY.remove(REGISTRY.eids(REGISTRY.names, name.lower()))
 
 def get_blacklist():
     """Obtain a list of blacklisted phones.
@@ -86,13 +720,14 @@ def get_blacklist():
     Returns:
         List of strings.
     """
-    result = DB.search(CONTACT.blacklisted == True)
+    result = [a for a in REGISTRY.values() if a['blacklisted']]
 
     if not result:
         return []
 
     return [a['phone'] for a in result]
 
+@DB_LOOKUP.time(function='get_contact')
 def get_contact(phone):
     """Get contact name from a phone number.
 
@@ -102,13 +737,14 @@ def get_contact(phone):
     Returns:
         String with the contact name or `None` if not found.
     """
-    result = DB.get((CONTACT.phone == phone) & (CONTACT.blacklisted == False))
+    result = REGISTRY.first(REGISTRY.contacts, normalize(phone))
 
     if not result:
         return None
 
     return result['name']
 
+@DB_LOOKUP.time(function='get_phone')
 def get_phone(contact):
     """Get phone number from a contact name.
 
@@ -118,31 +754,49 @@ def get_phone(contact):
     Returns:
         String with the phone number or `None` if not found.
     """
-    result = DB.get((CONTACT.name == contact.lower()) & (CONTACT.blacklisted == False))
+    result = REGISTRY.first(REGISTRY.names, contact.lower())
 
-    if not result:
+    if not result or result['blacklisted']:
         return None
 
     return result['phone']
 
+@DB_LOOKUP.time(function='is_blacklisted')
 def is_blacklisted(phone):
     """Check if a phone number is blacklisted.
 
+    The phone is matched against every blacklist rule, including prefixes
+    and ranges.
+
     Args:
         phone (str): Phone to check
 
     Returns:
         True or False
     """
-    result = DB.get((CONTACT.phone == phone) & (CONTACT.blacklisted == True))
+    phone = normalize(phone)
 
-    if not result:
+    if not phone:
         return False
 
-    return True
+    return REGISTRY.matches_rule(phone)
 
+def is_blacklist_rule(rule):
+    """Check if a blacklist rule is stored in the database.
+
+    Args:
+        rule (str): Phone, prefix or range, see `wat_bridge.phones`.
+
+    Returns:
+        True or False
+    """
+    rule = parse_rule(rule) or rule
+
+    return REGISTRY.first(REGISTRY.blacklist, rule) is not None
+
+@DB_LOOKUP.time(function='db_get_group')
 def db_get_group(contact):
-    result = DB.get((CONTACT.name == contact.lower()))
+    result = REGISTRY.first(REGISTRY.names, contact.lower())
 
     if not result:
         return None
@@ -151,8 +805,9 @@ def db_get_group(contact):
     return result.get('group')
 
 def db_set_group(contact, group):
-    DB.update({'group': group}, (CONTACT.name == contact.lower()))
+    REGISTRY.update({'group': group}, REGISTRY.eids(REGISTRY.names, contact.lower()))
 
+@DB_LOOKUP.time(function='db_get_contact_by_group')
 def db_get_contact_by_group(group):
     """Get phone number from a group id.
 
@@ -162,13 +817,31 @@ def db_get_contact_by_group(group):
     Returns:
         String with the phone number or `None` if not found.
     """
-    result = DB.get((CONTACT.group == group))
+    result = REGISTRY.first(REGISTRY.groups, group)
 
     if not result:
         return None
 
     return result['name']
 
+@DB_LOOKUP.time(function='db_get_wa_group')
+def db_get_wa_group(jid):
+    """Get the name and Telegram group of a Whatsapp group.
+
+    Args:
+        jid (str): JID of the Whatsapp group.
+
+    Returns:
+        Tuple with the name and the Telegram group id (which may be `None`),
+        or `None` if the group is not stored.
+    """
+    result = REGISTRY.first(REGISTRY.wa_groups, jid)
+
+    if not result:
+        return None
+
+    return result['name'], result.get('group')
+
 def safe_cast(val, to_type, default=None):
     try:
         return to_type(val)
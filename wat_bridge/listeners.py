@@ -27,50 +27,104 @@
 
 """Listener functions."""
 
-import time
+import asyncore
 
-from wat_bridge.static import get_logger
+from wat_bridge.reconnect import ReconnectSupervisor
+from wat_bridge.static import SETTINGS, get_logger
 from wat_bridge.tg import tgbot
-from wat_bridge.wa import WA_STACK, _connect_signal
+from wat_bridge.webhook import serve_webhook
+from wat_bridge.wa import WA_STACK, WA_QUEUE, WA_RECEIPTS, wabot, _connect_signal
 
 logger = get_logger('listeners')
 
+# Reconnection policies
+TG_SUPERVISOR = ReconnectSupervisor(
+    'telegram',
+    base=SETTINGS['reconnect_base'],
+    cap=SETTINGS['reconnect_cap'],
+    stable=SETTINGS['reconnect_stable']
+)
+WA_SUPERVISOR = ReconnectSupervisor(
+    'whatsapp',
+    base=SETTINGS['reconnect_base'],
+    cap=SETTINGS['reconnect_cap'],
+    stable=SETTINGS['reconnect_stable']
+)
+
 def tg_listener():
-    """Poll for new messages in Telegram."""
+    """Poll for new messages in Telegram.
+
+    If the bridge is configured in webhook mode, updates are received through
+    an embedded HTTP server instead.
+    """
+    if SETTINGS['tg_mode'] == 'webhook':
+        return TG_SUPERVISOR.run(tg_webhook_connect)
+
+    TG_SUPERVISOR.run(tg_connect, connected_on_start=False)
+
+def tg_connect():
+    """Poll Telegram until an exception occurs.
+
+    `TeleBot.polling()` is not used because it retries failed requests on
+    its own: errors reach the supervisor instead, which classifies them and
+    waits accordingly. The connection is considered up once a request for
+    updates succeeds.
+    """
+    logger.info('Start Telegram polling')
+
     while True:
-        try:
-            # Continue even after an exception occurs
-            logger.info('Start Telegram polling')
-            tgbot.polling(none_stop=True)
+        updates = tgbot.get_updates(offset=tgbot.last_update_id + 1, timeout=20)
 
-        except Exception as e:
-            logger.error(e)
+        TG_SUPERVISOR.mark_connected()
 
-            logger.info('Start Telegram sleep')
-            time.sleep(10)
-            logger.info('Ended Telegram sleep')
+        if not updates:
+            continue
 
-            pass
+        tgbot.last_update_id = max(u.update_id for u in updates)
 
-        # Stop polling and restart it in next iteration
-        logger.info('Stop polling')
-        tgbot.stop_polling()
+        try:
+            tgbot.process_new_updates(updates)
+
+        except Exception as e:
+            # A failing handler is not a connection problem
+            logger.error('could not process Telegram updates: %s' % e)
+
+def tg_webhook_connect():
+    """Receive new messages in Telegram through a webhook."""
+    logger.info('Start Telegram webhook')
+    serve_webhook(tgbot)
 
 def wa_listener():
     """Poll for new messages in Whatsapp."""
-    while True:
-        try:
-            # Continue even after an exception occurs
-            logger.info('Start Whatsapp polling')
+    WA_SUPERVISOR.run(wa_connect, connected_on_start=False)
 
-            WA_STACK.broadcastEvent(_connect_signal)
-            WA_STACK.loop()
+def wa_connect():
+    """Connect to Whatsapp (if needed) and run the stack loop.
 
-        except Exception as e:
-            logger.error(e)
+    If the connection is still open (e.g. the loop was interrupted by an
+    exception in a callback), the loop is resumed without reconnecting.
+    """
+    if not asyncore.socket_map:
+        logger.info('Start Whatsapp connection')
+        WA_STACK.broadcastEvent(_connect_signal)
+
+    else:
+        logger.info('Resume Whatsapp polling')
+
+    wa_loop()
+
+def wa_loop():
+    """Run the yowsup stack loop until the connection is closed.
+
+    The loop is interrupted every `poll_interval` seconds in order to send
+    the messages queued in `WA_QUEUE` from this same thread.
+    """
+    while asyncore.socket_map:
+        WA_STACK.loop(timeout=SETTINGS['wa_poll_interval'], count=1)
 
-            logger.info('Start Whatsapp sleep')
-            time.sleep(10)
-            logger.info('Ended Whatsapp sleep')
+        if wabot.connected:
+            WA_SUPERVISOR.mark_connected()
 
-            pass
+        WA_QUEUE.drain(wabot)
+        WA_RECEIPTS.flush(wabot)
+        wabot.expire_uploads()
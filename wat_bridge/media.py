@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Streaming transfer of media files between Whatsapp and Telegram.
+
+Files are never loaded whole in memory: downloads are written in chunks to a
+spool that moves to disk once it grows past a configurable threshold, and
+uploads to Telegram stream the spool in chunks as well.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import io
+import mimetypes
+import os
+import tempfile
+import threading
+import uuid
+
+import requests
+from telebot import apihelper, types
+
+from wat_bridge.static import SETTINGS, get_logger
+from wat_bridge.tgsession import TG_SESSION
+
+logger = get_logger('media')
+
+# Telegram method and field used to send each type of media
+TG_METHODS = {
+    'image': ('sendPhoto', 'photo'),
+    'video': ('sendVideo', 'video'),
+    'audio': ('sendAudio', 'audio'),
+    'document': ('sendDocument', 'document')
+}
+
+# Info used to expand the key of encrypted Whatsapp media
+WA_MEDIA_INFO = {
+    'image': b'WhatsApp Image Keys',
+    'video': b'WhatsApp Video Keys',
+    'audio': b'WhatsApp Audio Keys',
+    'document': b'WhatsApp Document Keys'
+}
+
+# Maximum length of a Telegram caption
+CAPTION_LENGTH = 1024
+
+# Limits the number of concurrent transfers
+TRANSFERS = threading.BoundedSemaphore(SETTINGS['media_max_transfers'])
+
+
+class MediaTooLarge(Exception):
+    """The file exceeds the maximum size allowed."""
+    pass
+
+
+class Spool(object):
+    """Temporary file kept in memory until it grows past `threshold` bytes.
+
+    The SHA-256 digest of the content is computed as it is written.
+
+    Args:
+        threshold (int): Size in bytes after which the content is moved to
+            disk.
+        max_size (int): Maximum size of the content.
+    """
+
+    def __init__(self, threshold=None, max_size=None):
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=threshold or SETTINGS['media_spool_threshold'],
+            dir=SETTINGS['media_tmp_dir']
+        )
+        self.max_size = max_size or SETTINGS['media_max_size']
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+
+        if self.size > self.max_size:
+            raise MediaTooLarge('file is larger than %d bytes' % self.max_size)
+
+        self.hash.update(data)
+        self.file.write(data)
+
+    def digest(self):
+        """Obtain the hex digest of the content."""
+        return self.hash.hexdigest()
+
+    def rewind(self):
+        self.file.seek(0)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+
+class WaDecryptor(object):
+    """Decrypt Whatsapp media on the fly while writing it to another file.
+
+    Whatsapp media is encrypted with AES-256-CBC and followed by a 10 byte
+    MAC. The last bytes are held back until the end of the stream, where the
+    MAC is checked and the padding removed.
+
+    Args:
+        target: File-like object the decrypted content is written to.
+        media_key (bytes): Media key included in the message.
+        media_type (str): Type of the media.
+    """
+
+    MAC_LENGTH = 10
+
+    def __init__(self, target, media_key, media_type):
+        from axolotl.kdf.hkdfv3 import HKDFv3
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        expanded = HKDFv3().deriveSecrets(media_key, WA_MEDIA_INFO[media_type], 112)
+        iv, cipher_key, mac_key = expanded[:16], expanded[16:48], expanded[48:80]
+
+        self.target = target
+        self.mac = hmac.new(mac_key, iv, hashlib.sha256)
+        self.decryptor = Cipher(
+            algorithms.AES(cipher_key), modes.CBC(iv), backend=default_backend()
+        ).decryptor()
+
+        self.pending = b''
+        self.held = b''
+
+    def write(self, data):
+        data = self.pending + data
+
+        # Keep the MAC (and the last block, for unpadding) for the end
+        keep = self.MAC_LENGTH + 16
+        usable = max(len(data) - keep, 0)
+        usable -= usable % 16
+
+        chunk, self.pending = data[:usable], data[usable:]
+
+        if chunk:
+            self.mac.update(chunk)
+            self._output(self.decryptor.update(chunk))
+
+    def _output(self, plain):
+        # The last decrypted block contains the padding
+        plain = self.held + plain
+        self.held = plain[-16:]
+        self.target.write(plain[:-16])
+
+    def close(self):
+        """Check the MAC and write the last block.
+
+        Raises:
+            ValueError: if the content was tampered with.
+        """
+        chunk, mac = self.pending[:-self.MAC_LENGTH], self.pending[-self.MAC_LENGTH:]
+
+        self.mac.update(chunk)
+
+        if not hmac.compare_digest(self.mac.digest()[:self.MAC_LENGTH], mac):
+            raise ValueError('invalid media MAC')
+
+        plain = self.held + self.decryptor.update(chunk) + self.decryptor.finalize()
+        padding = bytearray(plain[-1:])[0] if plain else 0
+
+        self.target.write(plain[:len(plain) - padding])
+
+
+def download(url, target, timeout=None, session=None):
+    """Download a file in chunks.
+
+    Args:
+        url (str): URL of the file.
+        target: File-like object to write to.
+        timeout (float): Seconds to wait for the server.
+        session: `requests` session used for the download.
+    """
+    response = (session or requests).get(
+        url, stream=True, timeout=timeout or SETTINGS['media_timeout'])
+
+    try:
+        response.raise_for_status()
+
+        for chunk in response.iter_content(SETTINGS['media_chunk_size']):
+            target.write(chunk)
+
+    finally:
+        response.close()
+
+
+def wa_media_info(message):
+    """Extract the information needed to download a Whatsapp media message.
+
+    Args:
+        message: Received media message entity.
+
+    Returns:
+        JSON serializable dict, or `None` if the media type is not supported.
+    """
+    media_type = message.getMediaType()
+
+    if media_type not in TG_METHODS:
+        return None
+
+    media_key = getattr(message, 'mediaKey', None)
+    file_hash = getattr(message, 'fileHash', None)
+
+    return {
+        'type': media_type,
+        'url': message.getMediaUrl(),
+        'mimetype': message.getMimeType(),
+        'size': int(message.getMediaSize() or 0),
+        'filename': getattr(message, 'fileName', None),
+        'key': base64.b64encode(media_key).decode('ascii') if media_key else None,
+        'digest': _hex_digest(file_hash)
+    }
+
+
+def _hex_digest(file_hash):
+    """Convert the base64 SHA-256 hash sent by Whatsapp to hex."""
+    if not file_hash:
+        return None
+
+    try:
+        return binascii.hexlify(base64.b64decode(file_hash)).decode('ascii')
+
+    except (TypeError, ValueError):
+        return None
+
+
+def file_digest(path):
+    """Compute the hex SHA-256 digest of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SETTINGS['media_chunk_size']), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def download_wa(media):
+    """Download (and decrypt) Whatsapp media into a spool.
+
+    Args:
+        media (dict): Information returned by `wa_media_info()`.
+
+    Returns:
+        Spool with the content, positioned at the beginning.
+    """
+    if media.get('size', 0) > SETTINGS['media_max_size']:
+        raise MediaTooLarge('file is larger than %d bytes' % SETTINGS['media_max_size'])
+
+    spool = Spool()
+
+    try:
+        if media.get('key'):
+            decryptor = WaDecryptor(spool, base64.b64decode(media['key']), media['type'])
+            download(media['url'], decryptor)
+            decryptor.close()
+
+        else:
+            download(media['url'], spool)
+
+    except Exception:
+        spool.close()
+        raise
+
+    spool.rewind()
+
+    return spool
+
+
+class MultipartStream(object):
+    """File-like `multipart/form-data` body that streams a file.
+
+    The length of the body is known in advance, so that it can be sent with
+    a `Content-Length` header instead of loading it in memory.
+
+    Args:
+        fields (dict): Regular form fields.
+        name (str): Name of the file field.
+        filename (str): Name of the file.
+        mimetype (str): Content type of the file.
+        fileobj: File-like object with the content.
+        size (int): Size of the content.
+    """
+
+    def __init__(self, fields, name, filename, mimetype, fileobj, size):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+
+        head = b''
+        for key, value in fields.items():
+            head += ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                     % (self.boundary, key, value)).encode('utf-8')
+
+        head += ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                 'Content-Type: %s\r\n\r\n'
+                 % (self.boundary, name, filename.replace('"', ''), mimetype)).encode('utf-8')
+
+        self.parts = [head, fileobj, ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')]
+        self.len = len(head) + size + len(self.parts[2])
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+
+        result = b''
+
+        while self.parts and len(result) < size:
+            part = self.parts[0]
+
+            if isinstance(part, bytes):
+                taken, rest = part[:size - len(result)], part[size - len(result):]
+                result += taken
+
+                if rest:
+                    self.parts[0] = rest
+                else:
+                    self.parts.pop(0)
+
+            else:
+                data = part.read(size - len(result))
+
+                if not data:
+                    self.parts.pop(0)
+
+                result += data
+
+        return result
+
+
+def upload_tg(token, chat_id, spool, media, caption=None):
+    """Send a file to a Telegram chat, streaming its content.
+
+    Args:
+        token (str): Bot token.
+        chat_id (int): Chat to send the file to.
+        spool (Spool): Content of the file.
+        media (dict): Information of the media (see `wa_media_info()`).
+        caption (str): Caption of the file.
+
+    Returns:
+        The sent Telegram message.
+    """
+    method, field = TG_METHODS[media['type']]
+    mimetype = media.get('mimetype') or 'application/octet-stream'
+
+    filename = media.get('filename')
+    if not filename:
+        filename = field + (mimetypes.guess_extension(mimetype) or '')
+
+    fields = {'chat_id': chat_id}
+    if caption:
+        fields['caption'] = caption[:CAPTION_LENGTH]
+
+    body = MultipartStream(fields, field, filename, mimetype, spool, spool.size)
+
+    response = TG_SESSION.session.post(
+        apihelper.API_URL.format(token, method),
+        data=body,
+        headers={'Content-Type': body.content_type},
+        timeout=SETTINGS['media_timeout']
+    )
+
+    return types.Message.de_json(apihelper._check_result(method, response)['result'])
+
+
+def send_tg_ref(token, chat_id, file_id, media, caption=None):
+    """Send a file that is already stored in Telegram.
+
+    Args:
+        token (str): Bot token.
+        chat_id (int): Chat to send the file to.
+        file_id (str): Telegram ID of the file.
+        media (dict): Information of the media (see `wa_media_info()`).
+        caption (str): Caption of the file.
+
+    Returns:
+        The sent Telegram message.
+    """
+    method, field = TG_METHODS[media['type']]
+
+    params = {'chat_id': chat_id, field: file_id}
+    if caption:
+        params['caption'] = caption[:CAPTION_LENGTH]
+
+    return types.Message.de_json(apihelper._make_request(
+        token, method, params=params, method='post'))
+
+
+def tg_file_id(message, media_type):
+    """Obtain the ID of the file in a Telegram message.
+
+    Args:
+        message: Telegram message.
+        media_type (str): Type of the media.
+
+    Returns:
+        File ID or `None` if the message has no file of that type.
+    """
+    if media_type == 'image':
+        # Use the largest size available
+        photos = getattr(message, 'photo', None)
+        return photos[-1].file_id if photos else None
+
+    attachment = getattr(message, TG_METHODS[media_type][1], None)
+
+    return attachment.file_id if attachment else None
+
+
+def download_tg(bot, file_id, path):
+    """Download a file sent to the Telegram bot.
+
+    Args:
+        bot: Telegram bot.
+        file_id (str): ID of the file.
+        path (str): Path to write the file to.
+    """
+    info = bot.get_file(file_id)
+
+    if (info.file_size or 0) > SETTINGS['media_max_size']:
+        raise MediaTooLarge('file is larger than %d bytes' % SETTINGS['media_max_size'])
+
+    with open(path, 'wb') as f:
+        download(apihelper.FILE_URL.format(bot.token, info.file_path), f,
+                 session=TG_SESSION.session)
+
+
+def read_tg(bot, file_id, max_size):
+    """Download a small file sent to the Telegram bot into memory.
+
+    Args:
+        bot: Telegram bot.
+        file_id (str): ID of the file.
+        max_size (int): Maximum size of the file.
+
+    Returns:
+        Content of the file (bytes).
+    """
+    info = bot.get_file(file_id)
+
+    if (info.file_size or 0) > max_size:
+        raise MediaTooLarge('file is larger than %d bytes' % max_size)
+
+    buf = io.BytesIO()
+    download(apihelper.FILE_URL.format(bot.token, info.file_path), buf,
+             session=TG_SESSION.session)
+
+    return buf.getvalue()
+
+
+def temp_path(suffix=''):
+    """Obtain the path to a new temporary file."""
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=SETTINGS['media_tmp_dir'])
+    os.close(fd)
+
+    return path
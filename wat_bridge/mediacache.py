@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Content-addressed cache of uploaded media.
+
+Media files are identified by the SHA-256 digest of their content. Once a file
+has been uploaded to a network, the reference returned by the network (the
+Telegram `file_id` or the Whatsapp media URL) is stored, so that the same file
+can be sent again without uploading it.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from wat_bridge.metrics import METRICS
+from wat_bridge.static import SETTINGS, get_logger
+
+logger = get_logger('mediacache')
+
+MEDIA_CACHE_LOOKUPS = METRICS.counter(
+    'watbridge_media_cache_lookups_total',
+    'Media cache lookups, by network and result.',
+    ('network', 'result')
+)
+
+
+class MediaCache(object):
+    """Persistent LRU cache mapping content digests to media references.
+
+    Entries expire `ttl` seconds after being stored, and the least recently
+    used entries are evicted once there are more than `max_entries`.
+
+    Args:
+        path (str): Path to the SQLite database file.
+        max_entries (int): Maximum number of entries kept.
+        ttl (float): Seconds an entry is valid for (0 to never expire).
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS media ('
+        '    digest TEXT NOT NULL,'
+        '    network TEXT NOT NULL,'
+        '    ref TEXT NOT NULL,'
+        '    created REAL NOT NULL,'
+        '    used REAL NOT NULL,'
+        '    PRIMARY KEY (digest, network)'
+        ')',
+        'CREATE INDEX IF NOT EXISTS media_used ON media (used)',
+    )
+
+    def __init__(self, path, max_entries=10000, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.counters = {'hits': 0, 'misses': 0}
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+
+            with self.conn:
+                for statement in self.SCHEMA:
+                    self.conn.execute(statement)
+
+    def get(self, digest, network):
+        """Obtain the reference of an uploaded file.
+
+        Args:
+            digest (str): Hex SHA-256 digest of the content.
+            network (str): `tg` or `wa`.
+
+        Returns:
+            Reference stored with `put()`, or `None` if the file is not in
+            the cache (or the entry expired).
+        """
+        now = time.time()
+        ref = None
+
+        if digest:
+            with self.lock, self.conn:
+                row = self.conn.execute(
+                    'SELECT ref, created FROM media WHERE digest = ? AND network = ?',
+                    (digest, network)
+                ).fetchone()
+
+                if row and self.ttl > 0 and row[1] + self.ttl < now:
+                    self.conn.execute(
+                        'DELETE FROM media WHERE digest = ? AND network = ?',
+                        (digest, network)
+                    )
+
+                elif row:
+                    self.conn.execute(
+                        'UPDATE media SET used = ? WHERE digest = ? AND network = ?',
+                        (now, digest, network)
+                    )
+                    ref = json.loads(row[0])
+
+        self._count(network, ref is not None)
+
+        return ref
+
+    def put(self, digest, network, ref):
+        """Store the reference of an uploaded file.
+
+        Args:
+            digest (str): Hex SHA-256 digest of the content.
+            network (str): `tg` or `wa`.
+            ref: JSON serializable reference of the file in the network.
+        """
+        if not digest or ref is None:
+            return
+
+        now = time.time()
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO media (digest, network, ref, created, used)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (digest, network, json.dumps(ref), now, now)
+            )
+
+            self._evict(now)
+
+    def _evict(self, now):
+        """Remove expired entries and those past the size limit."""
+        if self.ttl > 0:
+            self.conn.execute('DELETE FROM media WHERE created < ?', (now - self.ttl,))
+
+        count = self.conn.execute('SELECT COUNT(*) FROM media').fetchone()[0]
+
+        if count > self.max_entries:
+            self.conn.execute(
+                'DELETE FROM media WHERE rowid IN'
+                ' (SELECT rowid FROM media ORDER BY used LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def _count(self, network, hit):
+        with self.lock:
+            self.counters['hits' if hit else 'misses'] += 1
+
+        MEDIA_CACHE_LOOKUPS.inc(network=network, result='hit' if hit else 'miss')
+
+    def stats(self):
+        """Obtain the number of entries, hits and misses.
+
+        Returns:
+            Dict with the `entries` in the cache and the number of `hits`
+            and `misses` since the bridge started.
+        """
+        with self.lock:
+            result = dict(self.counters)
+            result['entries'] = self.conn.execute('SELECT COUNT(*) FROM media').fetchone()[0]
+
+        return result
+
+
+MEDIA_CACHE = MediaCache(
+    SETTINGS['media_cache_path'],
+    max_entries=SETTINGS['media_cache_size'],
+    ttl=SETTINGS['media_cache_ttl']
+)
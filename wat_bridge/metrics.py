@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""In-process metrics exported in the Prometheus text format."""
+
+import bisect
+import functools
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+
+from wat_bridge.static import get_logger
+
+logger = get_logger('metrics')
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOOKUP_BUCKETS = (0.000001, 0.00001, 0.0001, 0.001, 0.01, 0.1)
+
+
+def _labels(names, values):
+    """Format a set of labels."""
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+             for n, v in zip(names, values)]
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join(pairs)
+
+
+def _number(value):
+    """Format a sample value."""
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base class of the metrics.
+
+    Metrics may have labels, which must be passed as keyword arguments to
+    the methods that update them.
+
+    Args:
+        name (str): Name of the metric.
+        doc (str): Description of the metric.
+        labels (tuple): Names of the labels.
+    """
+
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(n, '') for n in self.labels)
+
+    def samples(self):
+        """Obtain the samples of the metric.
+
+        Returns:
+            List of (suffix, label names, label values, value) tuples.
+        """
+        with self.lock:
+            return [('', self.labels, k, v) for k, v in sorted(self.values.items())]
+
+    def render(self):
+        """Render the metric in the Prometheus text format."""
+        lines = [
+            '# HELP %s %s' % (self.name, self.doc),
+            '# TYPE %s %s' % (self.name, self.kind)
+        ]
+
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (
+                self.name, suffix, _labels(names, values), _number(value)))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter."""
+        key = self._key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Obtain the current value of the counter."""
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Value that can go up and down.
+
+    If `func` is provided, it is called on every collection and its return
+    value is used as the value of the gauge (without labels).
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, labels=(), func=None):
+        super(Gauge, self).__init__(name, doc, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        """Set the value of the gauge."""
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.func is not None:
+            return [('', (), (), self.func())]
+
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    """Distribution of observed values over a set of buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record an observation."""
+        key = self._key(labels)
+
+        with self.lock:
+            counts = self.values.get(key)
+
+            if counts is None:
+                # Counts of each bucket (and +Inf), then sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Decorator that observes the execution time of a function."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+
+                try:
+                    return func(*args, **kwargs)
+
+                finally:
+                    self.observe(time.time() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+    def samples(self):
+        result = []
+        names = self.labels + ('le',)
+
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                total = 0
+
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    result.append(('_bucket', names, key + (le,), total))
+
+                result.append(('_sum', self.labels, key, counts[-1]))
+                result.append(('_count', self.labels, key, total))
+
+        return result
+
+
+class MetricsRegistry(object):
+    """Collection of metrics."""
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric to the registry.
+
+        Returns:
+            The registered metric.
+        """
+        with self.lock:
+            self.metrics.append(metric)
+
+        return metric
+
+    def counter(self, *args, **kwargs):
+        """Create and register a `Counter`."""
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        """Create and register a `Gauge`."""
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        """Create and register a `Histogram`."""
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        """Render every metric in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics)
+
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+# Metrics of the bridge
+METRICS = MetricsRegistry()
+
+SIGNALS = METRICS.counter(
+    'watbridge_signals_total',
+    'Messages handled by each relay signal.',
+    ('signal',)
+)
+BLACKLISTED = METRICS.counter(
+    'watbridge_blacklisted_total',
+    'Whatsapp messages dropped because the sender is blacklisted.'
+)
+FLOODED = METRICS.counter(
+    'watbridge_flooded_total',
+    'Whatsapp messages dropped because the sender exceeded the flood limit.'
+)
+RECEIPT_FRAMES_SAVED = METRICS.counter(
+    'watbridge_wa_receipt_frames_saved_total',
+    'Whatsapp receipts that were merged into a receipt for several messages.'
+)
+UNKNOWN_SENDERS = METRICS.counter(
+    'watbridge_unknown_senders_total',
+    'Whatsapp messages received from phones that are not in the contacts.'
+)
+SEND_FAILURES = METRICS.counter(
+    'watbridge_send_failures_total',
+    'Messages that could not be sent.',
+    ('network',)
+)
+TG_SENDS = METRICS.counter(
+    'watbridge_tg_sends_total',
+    'Telegram API calls made by the send scheduler, by outcome.',
+    ('result',)
+)
+WA_TO_TG_LATENCY = METRICS.histogram(
+    'watbridge_wa_to_tg_seconds',
+    'Time from receiving a Whatsapp message to delivering it to Telegram.'
+)
+TG_TO_WA_LATENCY = METRICS.histogram(
+    'watbridge_tg_to_wa_seconds',
+    'Time from receiving a Telegram message to handing it to the Whatsapp stack.'
+)
+DB_LOOKUP = METRICS.histogram(
+    'watbridge_db_lookup_seconds',
+    'Time spent in database lookups.',
+    ('function',),
+    buckets=LOOKUP_BUCKETS
+)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler that serves the metrics."""
+
+    def do_GET(self):
+        body = self.server.registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(host, port, registry=METRICS):
+    """Serve the metrics over HTTP in a background thread.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        registry (MetricsRegistry): Metrics to serve.
+
+    Returns:
+        HTTP server instance.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.registry = registry
+
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+
+    logger.info('serving metrics on %s:%d' % server.server_address)
+
+    return server
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Copy the contents of a database to another storage backend.
+
+Usage:
+
+    python -m wat_bridge.migrate [--from BACKEND] [--to BACKEND]
+        [--from-namespace NAME] [--to-namespace NAME] SOURCE DEST
+
+For instance, to convert an existing TinyDB file to SQLite:
+
+    python -m wat_bridge.migrate --from tinydb --to sqlite db.json db.sqlite
+
+Or to copy it into the namespace of a multi-account instance:
+
+    python -m wat_bridge.migrate --to-namespace work db.json db.sqlite
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+from wat_bridge.storage import BACKENDS, FIELDS, open_storage
+
+
+def find_conflicts(rows):
+    """Find elements that the SQLite backend would reject.
+
+    SQLite does not allow two elements with the same phone (unless one of
+    them is blacklisted and the other is not), name or group, while TinyDB
+    does.
+
+    Args:
+        rows (list): Tuples with the ID and the element of each row.
+
+    Returns:
+        List of strings describing each clashing element.
+    """
+    conflicts = []
+    seen = {}
+
+    for eid, element in rows:
+        keys = [('phone', (element.get('phone'), bool(element.get('blacklisted'))))]
+
+        if element.get('name') is not None:
+            keys.append(('name', element['name']))
+
+        if element.get('group') is not None:
+            keys.append(('group', element['group']))
+
+        for field, key in keys:
+            first = seen.setdefault((field, key), eid)
+
+            if first != eid:
+                conflicts.append('element %s has the same %s as element %s: %s' % (
+                    eid, field, first, element.get(field)))
+
+    return conflicts
+
+
+def migrate(source, dest):
+    """Copy every element from one storage to another.
+
+    The elements are written to the destination in a single batch.
+
+    Args:
+        source (Storage): Storage to read from.
+        dest (Storage): Storage to write to.
+
+    Returns:
+        Number of copied elements.
+    """
+    elements = [
+        dict((f, element.get(f)) for f in FIELDS)
+        for _, element in source.all()
+    ]
+
+    dest.insert_many(elements)
+
+    return len(elements)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Copy the wat-bridge database to another backend.')
+    parser.add_argument('--from', dest='source_backend', default='tinydb',
+                        choices=sorted(BACKENDS), help='backend of SOURCE')
+    parser.add_argument('--to', dest='dest_backend', default='sqlite',
+                        choices=sorted(BACKENDS), help='backend of DEST')
+    parser.add_argument('--from-namespace', dest='source_namespace',
+                        help='namespace (instance) to read from SOURCE')
+    parser.add_argument('--to-namespace', dest='dest_namespace',
+                        help='namespace (instance) to write to DEST')
+    parser.add_argument('source', help='path to the current database')
+    parser.add_argument('dest', help='path to the new database (must not '
+                        'exist, unless copying to a namespace)')
+
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.source):
+        sys.exit('Could not find source database')
+
+    if os.path.exists(args.dest) and not args.dest_namespace:
+        sys.exit('Destination database already exists')
+
+    source = open_storage(args.source_backend, args.source, args.source_namespace)
+
+    try:
+        if args.dest_backend == 'sqlite':
+            conflicts = find_conflicts(source.all())
+
+            if conflicts:
+                for conflict in conflicts:
+                    print(conflict, file=sys.stderr)
+
+                sys.exit('Source database has %d clashing elements, fix them '
+                         'before migrating' % len(conflicts))
+
+        count = _copy(source, args)
+
+    finally:
+        source.close()
+
+    print('Copied %d elements' % count)
+
+
+def _copy(source, args):
+    """Copy the source database to the destination given in the arguments.
+
+    A new database is written to a temporary file that is renamed once
+    complete, so that a failed migration does not leave it half written.
+    Copies to a namespace of an existing database rely on the batch being
+    written in a single transaction instead.
+    """
+    new_file = not os.path.exists(args.dest)
+    path = args.dest + '.tmp' if new_file else args.dest
+
+    if new_file:
+        _remove(path)
+
+    dest = open_storage(args.dest_backend, path, args.dest_namespace)
+    count = None
+
+    try:
+        if dest.all():
+            sys.exit('Destination namespace is not empty')
+
+        count = migrate(source, dest)
+
+    except Exception as e:
+        sys.exit('Could not copy the database: %s' % e)
+
+    finally:
+        # Also reached when exiting, which is not an `Exception`
+        dest.close()
+
+        if new_file and count is None:
+            _remove(path)
+
+    if new_file:
+        os.rename(path, args.dest)
+
+    return count
+
+
+def _remove(path):
+    """Remove a database file, along with the SQLite journal files."""
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Multi-account and split modes.
+
+The Whatsapp stack and the Telegram bot are built once per process, so every
+bridge instance defined in the configuration runs in its own process. In
+split mode, each instance runs in two processes instead: one for the
+Whatsapp side and one for the Telegram side. The supervisor starts them,
+restarts the ones that crash and stops them all when it is terminated.
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from wat_bridge.static import ROLES, _get_option, get_logger, read_config
+
+logger = get_logger('multi')
+
+
+def check_instances(names):
+    """Make sure the instances can run side by side.
+
+    The TinyDB backend rewrites the whole file on every write, so its file
+    cannot be shared between instances.
+
+    Args:
+        names (list): Names of the instances.
+    """
+    tinydb_paths = {}
+
+    for name in names:
+        parser = read_config(name)
+
+        if _get_option(parser, 'db', 'backend', 'tinydb') != 'tinydb':
+            continue
+
+        path = os.path.abspath(parser.get('db', 'path'))
+
+        if path in tinydb_paths:
+            sys.exit(
+                'Instances "%s" and "%s" share the TinyDB file %s, use the '
+                'sqlite backend or set a different path in [%s:db]'
+                % (tinydb_paths[path], name, path, name)
+            )
+
+        tinydb_paths[path] = name
+
+
+class Instance(object):
+    """Process running a bridge instance (or one side of it).
+
+    Args:
+        name (str): Name of the process, for the logs.
+        command (list): Command that launches the bridge.
+        env (dict): Variables added to the environment of the process.
+    """
+
+    def __init__(self, name, command, env):
+        self.name = name
+        self.command = command
+        self.env = env
+        self.process = None
+        self.started = 0
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update(self.env)
+
+        logger.info('starting process %s' % self.name)
+
+        self.process = subprocess.Popen(self.command, env=env)
+        self.started = time.time()
+        self.restart_at = None
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+
+class InstanceSupervisor(object):
+    """Keeps a process running for each instance.
+
+    Crashed instances are restarted after a delay that doubles with every
+    consecutive crash, up to `cap` seconds. An instance that ran for
+    `stable` seconds is considered healthy again. Instances that exit
+    cleanly are not restarted.
+
+    Args:
+        processes (dict): Environment variables of each process, by name.
+        command (list): Command that launches the bridge.
+        base (float): Seconds to wait before the first restart.
+        cap (float): Maximum seconds to wait before a restart.
+        stable (float): Seconds an instance must run to reset the delay.
+    """
+
+    def __init__(self, processes, command, base=1.0, cap=300.0, stable=30.0):
+        self.instances = [
+            Instance(name, command, processes[name]) for name in sorted(processes)
+        ]
+        self.base = base
+        self.cap = cap
+        self.stable = stable
+        self.stopping = False
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _check(self, instance):
+        """Restart the instance if needed."""
+        now = time.time()
+
+        if instance.restart_at is not None:
+            if now >= instance.restart_at:
+                instance.start()
+
+            return
+
+        if instance.process is None or instance.running():
+            return
+
+        code = instance.process.returncode
+
+        if code == 0:
+            logger.info('process %s finished' % instance.name)
+            instance.process = None
+            return
+
+        if now - instance.started >= self.stable:
+            instance.failures = 0
+
+        delay = min(self.cap, self.base * 2 ** instance.failures)
+        instance.failures += 1
+        instance.restart_at = now + delay
+
+        logger.error('process %s exited with code %d, restarting in %.1f s'
+                     % (instance.name, code, delay))
+
+    def run(self, poll_interval=1.0):
+        """Start the instances and supervise them until terminated."""
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+
+        for instance in self.instances:
+            instance.start()
+
+        while not self.stopping:
+            for instance in self.instances:
+                self._check(instance)
+
+            if not any(i.process or i.restart_at for i in self.instances):
+                break
+
+            time.sleep(poll_interval)
+
+        self.shutdown()
+
+    def shutdown(self, timeout=10.0):
+        """Terminate the instances, killing those that do not exit in time."""
+        running = [i for i in self.instances if i.running()]
+
+        for instance in running:
+            # Same as Ctrl+C, so that the bridge exits normally
+            instance.process.send_signal(signal.SIGINT)
+
+        deadline = time.time() + timeout
+
+        for instance in running:
+            while instance.running() and time.time() < deadline:
+                time.sleep(0.1)
+
+            if instance.running():
+                logger.warning('killing process %s' % instance.name)
+                instance.process.kill()
+                instance.process.wait()
+
+
+def supervise(names, split=False):
+    """Run every instance in its own process (or pair of processes).
+
+    Each process runs the same command as the current one, with the name of
+    its instance in the `WAT_INSTANCE` variable and, in split mode, the side
+    of the bridge in the `WAT_ROLE` variable.
+
+    Args:
+        names (list): Names of the instances, empty for a single bridge.
+        split (bool): Whether to run each side in a separate process.
+    """
+    check_instances(names)
+
+    parser = read_config()
+    processes = {}
+
+    for name in names or [None]:
+        for role in (ROLES if split else [None]):
+            env = {}
+
+            if name:
+                env['WAT_INSTANCE'] = name
+
+            if role:
+                env['WAT_ROLE'] = role
+
+            processes['/'.join(n for n in (name, role) if n)] = env
+
+    supervisor = InstanceSupervisor(
+        processes,
+        [sys.executable] + sys.argv,
+        base=_get_option(parser, 'reconnect', 'base', 1.0, 'getfloat'),
+        cap=_get_option(parser, 'reconnect', 'cap', 300.0, 'getfloat'),
+        stable=_get_option(parser, 'reconnect', 'stable', 30.0, 'getfloat')
+    )
+
+    supervisor.run()
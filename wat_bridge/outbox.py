@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Append-only log of messages waiting to be relayed."""
+
+import collections
+import json
+import os
+import threading
+import time
+
+from wat_bridge.static import get_logger
+
+logger = get_logger('outbox')
+
+
+class Outbox(object):
+    """Durable log of the messages being relayed.
+
+    Every message is appended to the log before it is relayed, and marked as
+    done once it has been delivered. Entries that were not marked as done
+    (e.g. because the process crashed) can be replayed on startup.
+
+    The log is a text file with one record per line:
+
+        +<id> <direction> <json payload>
+        -<id>
+
+    The first kind of record adds an entry, while the second one marks it as
+    done. The file is rewritten with only the pending entries after
+    `compact_every` entries have been marked as done.
+
+    Writes are flushed to the operating system right away, but `fsync()` is
+    only called every `fsync_batch` records or `fsync_interval` seconds,
+    whichever happens first.
+
+    Args:
+        path (str): Path to the log file.
+        fsync_batch (int): Records written between calls to `fsync()`.
+        fsync_interval (float): Maximum seconds a record may wait for
+            `fsync()`.
+        compact_every (int): Entries marked as done between compactions.
+    """
+
+    def __init__(self, path, fsync_batch=1, fsync_interval=1.0, compact_every=1000):
+        self.path = path
+        self.fsync_batch = max(fsync_batch, 1)
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.next_id = 1
+        self.unsynced = 0
+        self.synced_at = time.time()
+        self.done_count = 0
+
+        self._load()
+        self.log = open(self.path, 'a')
+
+    def _load(self):
+        """Read the pending entries from the log file."""
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # Incomplete write
+                    logger.warning('ignoring truncated outbox record')
+                    break
+
+                try:
+                    if line.startswith('+'):
+                        eid, direction, payload = line[1:].split(' ', 2)
+                        eid = int(eid)
+
+                        self.entries[eid] = (direction, json.loads(payload))
+                        self.next_id = max(self.next_id, eid + 1)
+
+                    elif line.startswith('-'):
+                        self.entries.pop(int(line[1:]), None)
+
+                except ValueError:
+                    logger.warning('ignoring invalid outbox record')
+
+        # Start from a compact file
+        self._rewrite()
+
+    def _write(self, record):
+        """Append a record to the log. Must be called with the lock held."""
+        self.log.write(record)
+        self.log.flush()
+        self.unsynced += 1
+
+        if self.unsynced >= self.fsync_batch:
+            self._sync()
+
+    def _sync(self):
+        os.fsync(self.log.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def _rewrite(self):
+        """Write the pending entries to a new log file."""
+        tmp_path = self.path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            for eid, (direction, payload) in self.entries.items():
+                f.write('+%d %s %s\n' % (eid, direction, json.dumps(payload)))
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp_path, self.path)
+
+    def start(self):
+        """Launch the thread that syncs records older than `fsync_interval`."""
+        if self.fsync_batch == 1 or not self.fsync_interval:
+            return
+
+        thread = threading.Thread(target=self._work, name='outbox')
+        thread.daemon = True
+        thread.start()
+
+    def _work(self):
+        while True:
+            time.sleep(self.fsync_interval)
+
+            with self.lock:
+                if self.unsynced and time.time() - self.synced_at >= self.fsync_interval:
+                    self._sync()
+
+    def append(self, direction, **payload):
+        """Add an entry to the log.
+
+        Args:
+            direction (str): Where the message is going (`tg` or `wa`).
+            **payload: JSON serializable data needed to relay the message.
+
+        Returns:
+            ID of the entry.
+        """
+        with self.lock:
+            eid = self.next_id
+            self.next_id += 1
+
+            self.entries[eid] = (direction, payload)
+            self._write('+%d %s %s\n' % (eid, direction, json.dumps(payload)))
+
+            return eid
+
+    def done(self, *eids):
+        """Mark entries as delivered.
+
+        Args:
+            *eids: IDs of the entries.
+        """
+        with self.lock:
+            for eid in eids:
+                if self.entries.pop(eid, None) is None:
+                    continue
+
+                self._write('-%d\n' % eid)
+                self.done_count += 1
+
+            if self.done_count >= self.compact_every:
+                self._compact()
+
+    def compact(self):
+        """Rewrite the log keeping only the pending entries."""
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        self.log.close()
+        self._rewrite()
+        self.log = open(self.path, 'a')
+
+        self.unsynced = 0
+        self.synced_at = time.time()
+        self.done_count = 0
+
+    def pending(self):
+        """Obtain the entries that have not been delivered.
+
+        Returns:
+            List of (id, direction, payload) tuples in the order they were
+            added.
+        """
+        with self.lock:
+            return [(eid, d, p) for eid, (d, p) in self.entries.items()]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Phone number normalisation and blacklist rules.
+
+Phones are stored and compared in a canonical form: the digits of the
+international number, country code included, without ``+`` or ``00``
+prefixes, separators or Whatsapp JID suffix.
+
+Blacklist rules can be:
+
+- an exact phone: ``491511234567``
+- a prefix, ending in ``*``: ``49*``
+- a range of prefixes of the same length: ``4915100..4915199``
+
+Rules are compiled into a `PhoneTrie`, so checking a phone costs one step per
+digit regardless of the number of rules.
+
+Whatsapp groups are identified by their full JID (``<id>@g.us``) instead.
+"""
+
+import re
+
+# Characters commonly used to format phone numbers
+_SEPARATORS = re.compile(r'[\s\-().]')
+
+# Suffix of Whatsapp group JIDs
+GROUP_SUFFIX = '@g.us'
+
+# Local part of a group JID: either <creator>-<timestamp> or a single number
+_GROUP_ID = re.compile(r'^\d+(-\d+)?$')
+
+
+def normalize(phone):
+    """Convert a phone number to its canonical form.
+
+    Args:
+        phone (str): Phone number, optionally with a leading ``+`` or ``00``,
+            separators or the ``@s.whatsapp.net`` suffix.
+
+    Returns:
+        String with the digits of the number, or `None` if not valid.
+    """
+    if not phone:
+        return None
+
+    phone = _SEPARATORS.sub('', phone.split('@', 1)[0])
+
+    if phone.startswith('+'):
+        phone = phone[1:]
+
+    elif phone.startswith('00'):
+        phone = phone[2:]
+
+    if not phone.isdigit():
+        return None
+
+    return phone
+
+
+def group_jid(group):
+    """Convert a Whatsapp group id to its full JID.
+
+    Args:
+        group (str): Group id, with or without the ``@g.us`` suffix.
+
+    Returns:
+        JID of the group, or `None` if not valid.
+    """
+    group = (group or '').strip()
+
+    if group.endswith(GROUP_SUFFIX):
+        group = group[:-len(GROUP_SUFFIX)]
+
+    if not _GROUP_ID.match(group):
+        return None
+
+    return group + GROUP_SUFFIX
+
+
+def is_group(jid):
+    """Check whether a stored phone is actually a Whatsapp group JID."""
+    return bool(jid) and jid.endswith(GROUP_SUFFIX)
+
+
+def parse_rule(rule):
+    """Convert a blacklist rule to its canonical form.
+
+    Args:
+        rule (str): Exact phone, prefix ending in ``*`` or ``lo..hi`` range.
+
+    Returns:
+        Canonical rule string, or `None` if not valid.
+    """
+    rule = (rule or '').strip()
+
+    if rule.endswith('*'):
+        prefix = normalize(rule[:-1])
+        return prefix + '*' if prefix else None
+
+    if '..' in rule:
+        lo, _, hi = rule.partition('..')
+        lo, hi = normalize(lo), normalize(hi)
+
+        if not lo or not hi or len(lo) != len(hi) or lo > hi:
+            return None
+
+        return '%s..%s' % (lo, hi)
+
+    return normalize(rule)
+
+
+def compile_rule(rule):
+    """Obtain the trie entries matching a canonical rule.
+
+    Args:
+        rule (str): Canonical rule, as returned by `parse_rule()`.
+
+    Returns:
+        List of (digits, is_prefix) tuples.
+    """
+    if rule.endswith('*'):
+        return [(rule[:-1], True)]
+
+    if '..' in rule:
+        lo, hi = rule.split('..')
+        return [(p, True) for p in range_prefixes(lo, hi)]
+
+    return [(rule, False)]
+
+
+def range_prefixes(lo, hi):
+    """Obtain the smallest set of prefixes covering a range.
+
+    For instance, ``range_prefixes('120', '139')`` is ``['12', '13']`` and
+    ``range_prefixes('4915100', '4915199')`` is ``['49151']``: no prefix is
+    ever listed along with its nine siblings, their parent is used instead
+    (except for a range covering every number of its length).
+
+    Args:
+        lo (str): First prefix of the range.
+        hi (str): Last prefix of the range, same length as `lo`.
+
+    Returns:
+        List of prefixes.
+    """
+    if lo == hi:
+        return [lo]
+
+    if lo[0] == hi[0]:
+        if lo[1:] == '0' * (len(lo) - 1) and hi[1:] == '9' * (len(hi) - 1):
+            # Every number starting with this digit
+            return [lo[0]]
+
+        return [lo[0] + p for p in range_prefixes(lo[1:], hi[1:])]
+
+    rest = len(lo) - 1
+    result = []
+
+    # Numbers starting with the first digit of `lo`
+    if lo[1:] == '0' * rest:
+        result.append(lo[0])
+    else:
+        result.extend(lo[0] + p for p in range_prefixes(lo[1:], '9' * rest))
+
+    # Whole digits in between
+    result.extend(str(d) for d in range(int(lo[0]) + 1, int(hi[0])))
+
+    # Numbers starting with the first digit of `hi`
+    if hi[1:] == '9' * rest:
+        result.append(hi[0])
+    else:
+        result.extend(hi[0] + p for p in range_prefixes('0' * rest, hi[1:]))
+
+    return result
+
+
+class _Node(object):
+    __slots__ = ('children', 'prefix', 'exact')
+
+    def __init__(self):
+        self.children = {}
+
+        # Number of rules matching any phone below / exactly this node
+        self.prefix = 0
+        self.exact = 0
+
+
+class PhoneTrie(object):
+    """Digit trie of blacklist rules.
+
+    Nodes count the rules that end in them, so overlapping rules can be
+    added and removed independently. The trie is not thread safe, callers
+    are expected to hold their own lock.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+
+    def clear(self):
+        """Remove every rule."""
+        self.root = _Node()
+
+    def add(self, rule):
+        """Add a canonical rule."""
+        for digits, is_prefix in compile_rule(rule):
+            node = self.root
+
+            for digit in digits:
+                node = node.children.setdefault(digit, _Node())
+
+            if is_prefix:
+                node.prefix += 1
+            else:
+                node.exact += 1
+
+    def remove(self, rule):
+        """Remove a canonical rule previously added."""
+        for digits, is_prefix in compile_rule(rule):
+            path = [self.root]
+
+            for digit in digits:
+                node = path[-1].children.get(digit)
+
+                if node is None:
+                    break
+
+                path.append(node)
+
+            else:
+                node = path[-1]
+
+                if is_prefix:
+                    node.prefix = max(node.prefix - 1, 0)
+                else:
+                    node.exact = max(node.exact - 1, 0)
+
+                # Prune nodes left without rules
+                for i in range(len(digits), 0, -1):
+                    node = path[i]
+
+                    if node.children or node.prefix or node.exact:
+                        break
+
+                    del path[i - 1].children[digits[i - 1]]
+
+    def match(self, phone):
+        """Check whether a canonical phone matches any rule.
+
+        Args:
+            phone (str): Phone in canonical form.
+
+        Returns:
+            True or False
+        """
+        node = self.root
+
+        for digit in phone:
+            if node.prefix:
+                return True
+
+            node = node.children.get(digit)
+
+            if node is None:
+                return False
+
+        return bool(node.prefix or node.exact)
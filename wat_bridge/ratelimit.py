@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Rate limiting primitives."""
+
+import collections
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    Tokens are refilled continuously at `rate` tokens per second, up to a
+    maximum of `burst` tokens.
+
+    Args:
+        rate (float): Tokens added per second. A rate of 0 disables the
+            limit.
+        burst (int): Capacity of the bucket.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, tokens=1):
+        """Obtain the time to wait until the tokens are available.
+
+        Returns:
+            Seconds to wait, 0 if the tokens can be consumed right away.
+        """
+        if self.rate <= 0:
+            return 0
+
+        with self.lock:
+            self._refill(time.time())
+
+            if self.tokens >= tokens:
+                return 0
+
+            return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens=1):
+        """Try to consume tokens from the bucket.
+
+        Returns:
+            True if the tokens were consumed, False otherwise.
+        """
+        if self.rate <= 0:
+            return True
+
+        with self.lock:
+            self._refill(time.time())
+
+            if self.tokens < tokens:
+                return False
+
+            self.tokens -= tokens
+            return True
+
+    def reserve(self, tokens=1):
+        """Consume tokens even if the bucket goes into debt.
+
+        Returns:
+            Seconds the caller has to wait before the tokens are actually
+            available.
+        """
+        if self.rate <= 0:
+            return 0
+
+        with self.lock:
+            self._refill(time.time())
+            self.tokens -= tokens
+
+            if self.tokens >= 0:
+                return 0
+
+            return -self.tokens / self.rate
+
+
+class KeyedBuckets(object):
+    """Collection of token buckets indexed by key.
+
+    Buckets that have not been used for `idle` seconds are discarded so that
+    memory does not grow with the number of distinct keys.
+
+    Args:
+        rate (float): Rate of each bucket.
+        burst (int): Capacity of each bucket.
+        idle (float): Seconds after which an unused bucket is discarded.
+    """
+
+    def __init__(self, rate, burst=1, idle=600):
+        self.rate = rate
+        self.burst = burst
+        self.idle = idle
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Obtain the bucket for a key, creating it if needed."""
+        now = time.time()
+
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+
+            # Most recently used buckets are kept at the end
+            self.buckets[key] = bucket
+            bucket.used = now
+
+            # Expire idle buckets
+            while self.buckets:
+                oldest = next(iter(self.buckets.values()))
+
+                if now - oldest.used < self.idle:
+                    break
+
+                self.buckets.popitem(last=False)
+
+            return bucket
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class FloodGuard(object):
+    """Sliding window limit on the messages received from each sender.
+
+    A sender that sends more than `limit` messages within `window` seconds
+    is banned for `ban` seconds, during which its messages are dropped.
+
+    Each sender keeps at most `limit` timestamps, and senders that have not
+    sent anything in the last `window` seconds are forgotten. At most
+    `max_senders` senders are tracked (and banned), the least recently seen
+    ones being discarded first, so memory is bounded regardless of the
+    number of distinct senders.
+
+    Args:
+        limit (int): Messages allowed within the window. A limit of 0
+            disables the guard.
+        window (float): Length of the window in seconds.
+        ban (float): Seconds a flooding sender is banned for.
+        max_senders (int): Maximum number of senders tracked.
+    """
+
+    # Results of `hit()`
+    ALLOWED = 'allowed'
+    FLOODED = 'flooded'
+    BANNED = 'banned'
+
+    def __init__(self, limit, window=60, ban=3600, max_senders=10000):
+        self.limit = limit
+        self.window = window
+        self.ban = ban
+        self.max_senders = max_senders
+
+        # sender -> deque of timestamps, least recently seen first
+        self.senders = collections.OrderedDict()
+
+        # sender -> end of ban, in order of expiration
+        self.banned = collections.OrderedDict()
+
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.senders:
+            stamps = next(iter(self.senders.values()))
+
+            if now - stamps[-1] < self.window and len(self.senders) < self.max_senders:
+                break
+
+            self.senders.popitem(last=False)
+
+        while self.banned:
+            until = next(iter(self.banned.values()))
+
+            if until > now and len(self.banned) < self.max_senders:
+                break
+
+            self.banned.popitem(last=False)
+
+    def hit(self, sender):
+        """Record a message from a sender.
+
+        Returns:
+            `ALLOWED` if the message can be relayed, `FLOODED` if the sender
+            has just been banned, or `BANNED` if it was already banned.
+        """
+        if self.limit <= 0:
+            return self.ALLOWED
+
+        now = time.time()
+
+        with self.lock:
+            self._expire(now)
+
+            if sender in self.banned:
+                return self.BANNED
+
+            stamps = self.senders.pop(sender, None)
+
+            if stamps is None:
+                stamps = collections.deque(maxlen=self.limit)
+
+            if len(stamps) == self.limit and now - stamps[0] < self.window:
+                # Limit reached within the window
+                self.banned[sender] = now + self.ban
+                return self.FLOODED
+
+            stamps.append(now)
+            self.senders[sender] = stamps
+
+            return self.ALLOWED
+
+    def unban(self, sender):
+        """Lift the ban of a sender."""
+        with self.lock:
+            self.banned.pop(sender, None)
+
+    def banned_count(self):
+        """Obtain the number of senders currently banned."""
+        with self.lock:
+            self._expire(time.time())
+
+            return len(self.banned)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Reconnection policy shared by the listeners."""
+
+import random
+import threading
+import time
+
+from wat_bridge.metrics import METRICS
+from wat_bridge.static import get_logger
+from wat_bridge.tgsend import retry_after
+
+logger = get_logger('reconnect')
+
+# Kinds of failures
+TRANSIENT = 'transient'
+AUTH = 'auth'
+RATE_LIMIT = 'rate_limit'
+
+RECONNECTS = METRICS.counter(
+    'watbridge_reconnects_total',
+    'Connection failures of each listener, by kind.',
+    ('listener', 'kind')
+)
+RECONNECT_TIME = METRICS.histogram(
+    'watbridge_reconnect_seconds',
+    'Time from a connection failure until the listener is connected again.',
+    ('listener',)
+)
+CONNECTED_SINCE = METRICS.gauge(
+    'watbridge_connected_since_timestamp_seconds',
+    'Time the listener connected (uptime is the difference with the current time), 0 when disconnected.',
+    ('listener',)
+)
+
+
+def classify(exc):
+    """Classify a connection failure.
+
+    Args:
+        exc (Exception): Exception raised by the listener.
+
+    Returns:
+        One of `TRANSIENT`, `AUTH` or `RATE_LIMIT`.
+    """
+    if exc.__class__.__name__ == 'AuthError':
+        # Raised by yowsup when the credentials are rejected
+        return AUTH
+
+    result = getattr(exc, 'result', None)
+    status = getattr(result, 'status_code', None)
+
+    if status == 429:
+        return RATE_LIMIT
+
+    if status in (401, 403, 404):
+        # Telegram answers 401 or 404 when the token is not valid
+        return AUTH
+
+    return TRANSIENT
+
+
+class ReconnectSupervisor(object):
+    """Run a listener forever, reconnecting when it fails.
+
+    After a connection that was up for at least `stable` seconds fails, the
+    first retry is immediate. Further retries wait an exponentially growing
+    delay (with jitter) capped at `cap` seconds. Rate limit failures wait at
+    least as much as the server asked, and authentication failures always
+    wait `cap` seconds so that the account is not hammered with logins.
+
+    Args:
+        name (str): Name of the listener.
+        base (float): Delay of the first non-immediate retry, in seconds.
+        cap (float): Maximum delay between retries, in seconds.
+        stable (float): Seconds a connection must be up for the backoff to
+            start over when it fails.
+    """
+
+    def __init__(self, name, base=1, cap=300, stable=30):
+        self.name = name
+        self.base = base
+        self.cap = cap
+        self.stable = stable
+
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.failed_at = None
+        self.connected_at = None
+        self.reconnects = 0
+
+        CONNECTED_SINCE.set(0, listener=name)
+
+    def mark_connected(self):
+        """Record that the listener is connected."""
+        with self.lock:
+            if self.connected_at is not None:
+                return
+
+            now = time.time()
+            self.connected_at = now
+            CONNECTED_SINCE.set(now, listener=self.name)
+
+            if self.failed_at is not None:
+                RECONNECT_TIME.observe(now - self.failed_at, listener=self.name)
+                logger.info('%s reconnected after %.2f s' % (self.name, now - self.failed_at))
+                self.failed_at = None
+
+    def uptime(self):
+        """Obtain the seconds the listener has been connected."""
+        connected_at = self.connected_at
+
+        if connected_at is None:
+            return 0
+
+        return time.time() - connected_at
+
+    def delay(self, kind, exc=None):
+        """Obtain the time to wait before the next attempt.
+
+        Must be called after updating the number of failures.
+        """
+        backoff = min(self.cap, self.base * 2 ** max(self.failures - 2, 0))
+        backoff = random.uniform(backoff / 2.0, backoff)
+
+        if kind == AUTH:
+            return self.cap
+
+        if kind == RATE_LIMIT:
+            return max(retry_after(exc) or 0, backoff)
+
+        if self.failures == 1:
+            # Fast path for short blips
+            return 0
+
+        return backoff
+
+    def failed(self, exc):
+        """Record a connection failure.
+
+        Args:
+            exc (Exception): Exception raised by the listener.
+
+        Returns:
+            Seconds to wait before reconnecting.
+        """
+        kind = classify(exc)
+        now = time.time()
+
+        with self.lock:
+            if self.connected_at is not None and now - self.connected_at >= self.stable:
+                # The connection was healthy, start over
+                self.failures = 0
+
+            if self.failed_at is None:
+                self.failed_at = now
+
+            self.connected_at = None
+            self.failures += 1
+            self.reconnects += 1
+
+            delay = self.delay(kind, exc)
+
+        RECONNECTS.inc(listener=self.name, kind=kind)
+        CONNECTED_SINCE.set(0, listener=self.name)
+
+        logger.error('%s failed (%s): %s' % (self.name, kind, exc))
+
+        return delay
+
+    def run(self, connect, connected_on_start=True):
+        """Call `connect` forever.
+
+        Args:
+            connect: Function that connects and blocks while the connection
+                is up. It may return or raise an exception when the
+                connection is lost.
+            connected_on_start (bool): Whether the listener is considered
+                connected as soon as `connect` is called. Otherwise,
+                `mark_connected()` must be called by the listener.
+        """
+        while True:
+            if connected_on_start:
+                self.mark_connected()
+
+            try:
+                connect()
+                exc = Exception('connection closed')
+
+            except Exception as e:
+                exc = e
+
+            delay = self.failed(exc)
+
+            if delay:
+                logger.info('%s reconnecting in %.1f s' % (self.name, delay))
+                time.sleep(delay)
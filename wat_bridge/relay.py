@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Delivery queues used to decouple the listeners from message relaying."""
+
+import binascii
+import collections
+import json
+import os
+import threading
+import time
+
+from wat_bridge.metrics import METRICS
+from wat_bridge.outbox import Outbox
+from wat_bridge.static import SETTINGS, SIGNAL_TG, get_logger
+
+logger = get_logger('relay')
+
+# Overflow policies
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_SPILL = 'spill'
+
+
+class _Shard(object):
+    """Queue drained by a single worker thread.
+
+    Every key is always assigned to the same shard, which guarantees that
+    items sharing a key are delivered in the order they were queued.
+    """
+
+    def __init__(self, index, maxsize, spill_path):
+        self.index = index
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+
+        # Spill file state
+        self.spill_path = spill_path
+        self.spilled = 0
+        self.spill_offset = 0
+
+        if spill_path and os.path.isfile(spill_path):
+            # Items left over from a previous run are replayed from the
+            # outbox instead
+            os.remove(spill_path)
+
+        # Counters
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def spill(self, item):
+        """Append an item to the spill file of the shard."""
+        with open(self.spill_path, 'a') as f:
+            f.write(json.dumps(item) + '\n')
+
+        self.spilled += 1
+
+    def unspill(self):
+        """Move up to `maxsize` spilled items back to memory."""
+        with open(self.spill_path, 'r') as f:
+            f.seek(self.spill_offset)
+
+            while self.spilled and len(self.items) < self.maxsize:
+                line = f.readline()
+
+                if not line:
+                    break
+
+                self.items.append(json.loads(line))
+                self.spilled -= 1
+
+            self.spill_offset = f.tell()
+
+        if not self.spilled:
+            # Everything was read back, start over
+            os.remove(self.spill_path)
+            self.spill_offset = 0
+
+
+class DeliveryQueue(object):
+    """Bounded queue drained by a pool of worker threads.
+
+    Items are assigned to workers by key (e.g. the phone of the sender), so
+    that delivery is parallel across keys but ordered for each key.
+
+    An item whose delivery fails is retried by its worker (which keeps the
+    order of the items behind it) up to `retries` times, waiting an
+    exponentially growing delay capped at `retry_cap` seconds. If it still
+    fails, it is passed to `on_fail`. Errors with a true `transient`
+    attribute (e.g. the other process of the split mode being restarted)
+    are retried for as long as needed.
+
+    When the queue of a worker is full, the overflow policy decides what
+    happens with new items:
+
+        - `block`: the caller waits until there is room in the queue
+        - `drop_oldest`: the oldest queued item is discarded (and passed to
+            `on_drop`, so that it is not delivered later either)
+        - `spill`: the item is appended to a file on disk and read back once
+            the worker catches up
+
+    Args:
+        name (str): Name of the queue, used for logging.
+        handler: Function called with the keyword arguments of each item.
+        workers (int): Number of worker threads.
+        maxsize (int): Maximum number of in-memory items per worker.
+        overflow (str): Overflow policy.
+        spill_path (str): Base path for the spill files.
+        on_drop: Function called with the keyword arguments of each item
+            discarded by the `drop_oldest` policy.
+        retries (int): Times a failed delivery is retried.
+        retry_base (float): Seconds to wait before the first retry.
+        retry_cap (float): Maximum seconds to wait between retries.
+        on_fail: Function called with the exception and the keyword
+            arguments of each item that could not be delivered.
+    """
+
+    def __init__(self, name, handler, workers=1, maxsize=1000,
+            overflow=OVERFLOW_BLOCK, spill_path=None, on_drop=None,
+            retries=0, retry_base=1.0, retry_cap=60.0, on_fail=None):
+        self.name = name
+        self.handler = handler
+        self.overflow = overflow
+        self.on_drop = on_drop
+        self.retries = retries
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.on_fail = on_fail
+
+        self.shards = [
+            _Shard(i, maxsize, '%s.%d' % (spill_path, i) if spill_path else None)
+            for i in range(max(workers, 1))
+        ]
+
+        self.threads = []
+
+    def start(self):
+        """Launch the worker threads."""
+        for shard in self.shards:
+            thread = threading.Thread(
+                target=self._work,
+                args=(shard,),
+                name='%s-%d' % (self.name, shard.index)
+            )
+            thread.daemon = True
+            thread.start()
+
+            self.threads.append(thread)
+
+    def put(self, key, **kwargs):
+        """Queue an item for delivery.
+
+        Args:
+            key: Key used to preserve ordering between items.
+            **kwargs: Arguments to pass to the handler.
+        """
+        shard = self.shards[hash(key) % len(self.shards)]
+
+        with shard.cond:
+            if shard.spilled:
+                # Keep ordering with items already in the spill file
+                shard.spill(kwargs)
+
+            elif len(shard.items) >= shard.maxsize:
+                if self.overflow == OVERFLOW_SPILL and shard.spill_path:
+                    shard.spill(kwargs)
+
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    dropped = shard.items.popleft()
+                    shard.dropped += 1
+                    shard.items.append(kwargs)
+
+                    logger.warning('%s queue full, dropped oldest item' % self.name)
+
+                    if self.on_drop:
+                        self.on_drop(**dropped)
+
+                else:
+                    while len(shard.items) >= shard.maxsize:
+                        shard.cond.wait()
+
+                    shard.items.append(kwargs)
+
+            else:
+                shard.items.append(kwargs)
+
+            shard.cond.notify_all()
+
+    def depth(self):
+        """Obtain the number of items pending delivery.
+
+        Returns:
+            Integer with the number of in-memory and spilled items.
+        """
+        return sum(len(s.items) + s.spilled for s in self.shards)
+
+    def stats(self):
+        """Obtain statistics for each worker of the queue.
+
+        Returns:
+            List of dicts with the `queued`, `spilled`, `delivered`,
+            `dropped` and `failed` counts of each worker.
+        """
+        return [
+            {
+                'queued': len(s.items),
+                'spilled': s.spilled,
+                'delivered': s.delivered,
+                'dropped': s.dropped,
+                'failed': s.failed
+            }
+            for s in self.shards
+        ]
+
+    def _work(self, shard):
+        """Deliver the items of a shard forever."""
+        while True:
+            with shard.cond:
+                while not shard.items and not shard.spilled:
+                    shard.cond.wait()
+
+                if not shard.items:
+                    shard.unspill()
+
+                item = shard.items.popleft()
+                shard.cond.notify_all()
+
+            self._deliver(shard, item)
+
+    def retry_delay(self, exc, attempt):
+        """Obtain the time to wait before retrying a failed delivery.
+
+        Args:
+            exc (Exception): Exception raised by the handler.
+            attempt (int): Number of the failed attempt, starting at 0.
+
+        Returns:
+            Seconds to wait, or `None` if the item must not be retried.
+        """
+        if attempt >= self.retries and not getattr(exc, 'transient', False):
+            return None
+
+        return min(self.retry_cap, self.retry_base * 2 ** min(attempt, 32))
+
+    def _deliver(self, shard, item):
+        """Call the handler for an item, retrying it if it fails."""
+        attempt = 0
+
+        while True:
+            try:
+                self.handler(**item)
+                shard.delivered += 1
+                return
+
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+
+                if delay is None:
+                    shard.failed += 1
+                    logger.error('%s delivery failed, giving up: %s' % (self.name, e))
+
+                    if self.on_fail:
+                        self.on_fail(e, **item)
+
+                    return
+
+                logger.warning('%s delivery failed, retrying in %.1f s: %s' % (
+                    self.name, delay, e))
+
+                attempt += 1
+                time.sleep(delay)
+
+
+class Coalescer(object):
+    """Buffer that merges consecutive messages from the same sender.
+
+    Messages are kept in the buffer until `window` seconds have passed since
+    the first one, until adding a message would exceed `max_size`
+    characters or until a message from a different sender arrives. The
+    buffered messages are then joined with newlines and passed to the sink
+    as a single message.
+
+    Any extra keyword arguments given when adding a message are collected
+    and passed to the sink as a list of dicts, one per buffered message.
+
+    Args:
+        sink: Function called with the key, the merged message and the list
+            of extra arguments.
+        window (float): Seconds to wait for more messages. A window of 0
+            disables coalescing.
+        max_size (int): Maximum number of characters of a merged message.
+    """
+
+    def __init__(self, sink, window=0, max_size=3000):
+        self.sink = sink
+        self.window = window
+        self.max_size = max_size
+
+        self.key = None
+        self.messages = []
+        self.extra = []
+        self.size = 0
+        self.deadline = None
+        self.cond = threading.Condition()
+
+    def start(self):
+        """Launch the thread that flushes the buffer when the window ends."""
+        if not self.window:
+            return
+
+        thread = threading.Thread(target=self._work, name='coalescer')
+        thread.daemon = True
+        thread.start()
+
+    def add(self, key, message, **kwargs):
+        """Add a message to the buffer.
+
+        Args:
+            key: Sender of the message.
+            message (str): Text of the message.
+            **kwargs: Extra arguments to pass to the sink.
+        """
+        if not self.window:
+            self.sink(key, message, [kwargs])
+            return
+
+        with self.cond:
+            if self.messages and (key != self.key
+                    or self.size + len(message) + 1 > self.max_size):
+                self._flush()
+
+            if not self.messages:
+                self.key = key
+                self.deadline = time.time() + self.window
+                self.cond.notify_all()
+
+            self.messages.append(message)
+            self.extra.append(kwargs)
+            self.size += len(message) + 1
+
+    def flush(self):
+        """Pass the buffered messages to the sink right away."""
+        with self.cond:
+            self._flush()
+
+    def _flush(self):
+        # Called with the lock held, so that merged messages from the same
+        # sender reach the sink in order
+        if not self.messages:
+            return
+
+        key, message, extra = self.key, '\n'.join(self.messages), self.extra
+
+        self.key = None
+        self.messages = []
+        self.extra = []
+        self.size = 0
+        self.deadline = None
+
+        self.sink(key, message, extra)
+
+    def _work(self):
+        """Flush the buffer whenever its window ends."""
+        with self.cond:
+            while True:
+                if self.deadline is None:
+                    self.cond.wait()
+                    continue
+
+                remaining = self.deadline - time.time()
+
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+
+                self._flush()
+
+
+def _deliver_tg(**kwargs):
+    """Relay a queued WhatsApp message to Telegram.
+
+    Once delivered, the message is marked as done in the outbox. Its outbox
+    entries are its key in the bus of the split mode, so that a retry does
+    not relay it twice.
+    """
+    entries = kwargs.pop('entries', None) or []
+
+    if entries:
+        kwargs['key'] = '%s:%s' % (RUN_ID, ','.join(str(e) for e in entries))
+
+    SIGNAL_TG.send('wabot', **kwargs)
+
+    OUTBOX.done(*entries)
+
+
+def _drop_tg(**kwargs):
+    """Forget a message discarded because the Telegram queue was full.
+
+    The message is marked as done in the outbox, otherwise it would be
+    relayed anyway on the next start.
+    """
+    OUTBOX.done(*(kwargs.get('entries') or []))
+
+
+def _fail_tg(error, **kwargs):
+    """Give up on a message that could not be delivered to Telegram.
+
+    The message is marked as done in the outbox and the owner is told about
+    it (which may fail as well if Telegram is not available).
+    """
+    OUTBOX.done(*(kwargs.get('entries') or []))
+
+    try:
+        SIGNAL_TG.send(
+            'wabot',
+            notice='Could not relay a message from %s to Telegram: %s' % (
+                kwargs.get('phone'), error)
+        )
+
+    except Exception as e:
+        logger.error('could not notify the owner: %s' % e)
+
+
+# Outbox entry IDs are reused after a restart, this tells them apart
+RUN_ID = binascii.hexlify(os.urandom(8)).decode('ascii')
+
+# Log of messages being relayed, not used by the Telegram process of the
+# split mode
+OUTBOX = None
+
+if SETTINGS['relay_outbox_path']:
+    OUTBOX = Outbox(
+        SETTINGS['relay_outbox_path'],
+        fsync_batch=SETTINGS['relay_fsync_batch'],
+        fsync_interval=SETTINGS['relay_fsync_interval'],
+        compact_every=SETTINGS['relay_compact_every']
+    )
+
+
+# Queue for messages going to Telegram
+TG_QUEUE = DeliveryQueue(
+    'tg',
+    _deliver_tg,
+    workers=SETTINGS['relay_workers'],
+    maxsize=SETTINGS['relay_queue_size'],
+    overflow=SETTINGS['relay_overflow'],
+    spill_path=SETTINGS['relay_spill_path'],
+    on_drop=_drop_tg,
+    retries=SETTINGS['relay_retries'],
+    retry_base=SETTINGS['relay_retry_base'],
+    retry_cap=SETTINGS['relay_retry_cap'],
+    on_fail=_fail_tg
+)
+
+METRICS.gauge(
+    'watbridge_tg_queue_depth',
+    'Messages waiting to be delivered to Telegram.',
+    func=TG_QUEUE.depth
+)
+
+
+def _queue_tg(phone, message, extra):
+    """Queue a (possibly merged) message for delivery to Telegram."""
+    received = [e['received'] for e in extra if e.get('received')]
+
+    TG_QUEUE.put(
+        phone,
+        phone=phone,
+        message=message,
+        received=min(received) if received else None,
+        entries=[e['entry'] for e in extra if e.get('entry')]
+    )
+
+
+# Buffer merging bursts of messages from the same Whatsapp sender
+TG_COALESCER = Coalescer(
+    _queue_tg,
+    window=SETTINGS['relay_coalesce_window'],
+    max_size=SETTINGS['relay_coalesce_max_size']
+)
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Runtime that drives the whole bridge from a single event loop.
+
+This is an alternative to the listener threads started by `watbridge.py`:
+
+- The sockets of the yowsup stack (asyncore dispatchers) are watched by the
+  selector of an asyncio event loop, so the stack and the Whatsapp send
+  queue run in the loop thread.
+- Telegram updates are polled with non-blocking HTTP requests, and the bot
+  handlers are called from the loop thread.
+- Messages sent through `tgsender` are performed as tasks of the loop, so
+  that many of them can be in flight at the same time. Other bot calls
+  (e.g. editing a message or sending a document) still block, so they are
+  performed in the default executor of the loop.
+
+Requires Python 3.5 or newer.
+"""
+
+import asyncio
+import asyncore
+import functools
+import json
+import ssl
+import threading
+
+import requests
+from six.moves.urllib.parse import urlencode, urlsplit
+from telebot import apihelper, types
+
+from wat_bridge.listeners import TG_SUPERVISOR, WA_SUPERVISOR, tg_listener
+from wat_bridge.metrics import METRICS
+from wat_bridge.static import SETTINGS, get_logger
+from wat_bridge.tg import tgbot, tgsender
+from wat_bridge.wa import WA_QUEUE, WA_RECEIPTS, WA_STACK, wabot, _connect_signal
+
+logger = get_logger('runtime')
+
+
+class Response(object):
+    """HTTP response, with the attributes of `requests` used by the retry logic."""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class HttpClient(object):
+    """Minimal asynchronous HTTP/1.1 client for the Bot API.
+
+    Connections are kept alive and reused by later requests to the same
+    host.
+
+    Args:
+        max_connections (int): Maximum number of simultaneous requests.
+        timeout (float): Default seconds to wait for a response.
+    """
+
+    def __init__(self, max_connections=10, timeout=60.0):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.slots = None
+        self.idle = {}
+        self.ssl_context = ssl.create_default_context()
+
+    async def post(self, url, fields, timeout=None):
+        """Post a form.
+
+        Args:
+            url (str): URL to post to.
+            fields (dict): Form fields.
+            timeout (float): Seconds to wait for the response.
+
+        Returns:
+            `Response`.
+
+        Raises:
+            ConnectionError: if the request could not be completed.
+        """
+        if self.slots is None:
+            # Created lazily so that it belongs to the running loop
+            self.slots = asyncio.Semaphore(self.max_connections)
+
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        key = (secure, parts.hostname, parts.port or (443 if secure else 80))
+
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        body = urlencode(fields).encode('utf-8')
+
+        host = parts.hostname
+        if parts.port:
+            host += ':%d' % parts.port
+
+        head = (
+            'POST %s HTTP/1.1\r\n'
+            'Host: %s\r\n'
+            'Content-Type: application/x-www-form-urlencoded\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: keep-alive\r\n\r\n' % (path, host, len(body))
+        ).encode('latin-1')
+
+        async with self.slots:
+            try:
+                return await asyncio.wait_for(
+                    self._exchange(key, head + body), timeout or self.timeout)
+
+            except asyncio.TimeoutError:
+                raise ConnectionError('timed out waiting for %s' % parts.hostname)
+
+    async def _exchange(self, key, request):
+        """Send a request, retrying once if a reused connection was stale."""
+        for attempt in (0, 1):
+            reader, writer, reused = await self._connect(key)
+
+            try:
+                writer.write(request)
+                await writer.drain()
+
+                status, headers, content = await self._read_response(reader)
+
+            except (OSError, asyncio.IncompleteReadError) as e:
+                writer.close()
+
+                if reused and attempt == 0:
+                    continue
+
+                raise ConnectionError(str(e))
+
+            except BaseException:
+                # Cancelled (e.g. timed out), the connection is in an
+                # unknown state
+                writer.close()
+                raise
+
+            if headers.get('connection', '').lower() == 'close':
+                writer.close()
+
+            else:
+                self.idle.setdefault(key, []).append((reader, writer))
+
+            return Response(status, content)
+
+    async def _connect(self, key):
+        """Obtain an idle connection or open a new one."""
+        idle = self.idle.get(key, [])
+
+        while idle:
+            reader, writer = idle.pop()
+
+            if not reader.at_eof():
+                return reader, writer, True
+
+            writer.close()
+
+        secure, host, port = key
+
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self.ssl_context if secure else None)
+
+        return reader, writer, False
+
+    async def _read_response(self, reader):
+        """Read the status, headers and body of a response."""
+        line = await reader.readline()
+
+        if not line:
+            raise ConnectionError('connection closed by the server')
+
+        status = int(line.split()[1])
+        headers = {}
+
+        while True:
+            line = await reader.readline()
+
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            content = b''
+
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+
+                if size == 0:
+                    # Skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+
+                    break
+
+                content += await reader.readexactly(size)
+                await reader.readexactly(2)
+
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+
+        else:
+            content = await reader.read()
+            headers['connection'] = 'close'
+
+        return status, headers, content
+
+
+class AsyncTransport(object):
+    """Performs the requests of `TgSender` as tasks of the event loop.
+
+    Requests from the loop thread are sent in the background and return
+    `None`, while requests from other threads wait for the result. Messages
+    to the same chat are sent one after the other, in order.
+
+    Blocking bot calls are handed to the default executor of the loop, with
+    the same ordering, pacing and retries as requests.
+
+    Args:
+        runtime (Runtime): Runtime owning the loop.
+        sender (TgSender): Sender with the rate limits and retry policy.
+    """
+
+    def __init__(self, runtime, sender):
+        self.runtime = runtime
+        self.sender = sender
+        self.tails = {}
+        self.inflight = 0
+
+    def request(self, chat_id, method, params):
+        """Perform a Bot API request, see `TgSender.request()`."""
+        return self._submit(self._send(chat_id, lambda: self._api(method, params)))
+
+    def call(self, chat_id, func, args, kwargs):
+        """Perform a blocking bot call, see `TgSender.call()`."""
+        run = functools.partial(func, *args, **kwargs)
+
+        return self._submit(
+            self._send(chat_id, lambda: self.runtime.loop.run_in_executor(None, run)))
+
+    def defer(self, func, args, kwargs):
+        """Run a blocking function, see `TgSender.defer()`."""
+        run = functools.partial(func, *args, **kwargs)
+
+        if not self.runtime.in_loop():
+            return run()
+
+        future = self.runtime.loop.run_in_executor(None, run)
+        future.add_done_callback(self._log_failure)
+
+    def _submit(self, coro):
+        """Run a coroutine in the background, or wait for it outside the loop."""
+        if self.runtime.in_loop():
+            task = self.runtime.loop.create_task(coro)
+            task.add_done_callback(self._log_failure)
+            return None
+
+        return asyncio.run_coroutine_threadsafe(coro, self.runtime.loop).result()
+
+    def _log_failure(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error('Telegram call failed: %s' % task.exception())
+
+    async def _api(self, method, params):
+        return types.Message.de_json(await self.runtime.api(method, params))
+
+    async def _send(self, chat_id, perform):
+        # Wait for the previous message to the same chat
+        previous = self.tails.get(chat_id)
+        current = asyncio.Future()
+        self.tails[chat_id] = current
+
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+
+            return await self._attempt(chat_id, perform)
+
+        finally:
+            current.set_result(None)
+
+            if self.tails.get(chat_id) is current:
+                del self.tails[chat_id]
+
+    async def _attempt(self, chat_id, perform):
+        """Perform a call, retrying it according to the sender policy.
+
+        Args:
+            chat_id (int): Chat the call sends to.
+            perform: Function without arguments returning an awaitable with
+                the result of the call.
+        """
+        attempt = 0
+
+        while True:
+            delay = self.sender.reserve(chat_id)
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.inflight += 1
+
+            try:
+                result = await perform()
+                self.sender._count('sent')
+
+                return result
+
+            except (apihelper.ApiException, ConnectionError,
+                    requests.exceptions.RequestException) as e:
+                delay = self.sender.retry_delay(e, attempt)
+
+                if delay is None:
+                    raise
+
+            finally:
+                self.inflight -= 1
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+class Runtime(object):
+    """Event loop running the bridge.
+
+    Args:
+        wa (bool): Whether to run the Whatsapp side.
+        tg (bool): Whether to run the Telegram side.
+    """
+
+    def __init__(self, wa=True, tg=True):
+        self.wa = wa
+        self.tg = tg
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.client = HttpClient(max_connections=SETTINGS['tg_pool_size'])
+        self.transport = AsyncTransport(self, tgsender)
+
+        # File descriptors of the yowsup sockets being watched
+        self.readers = set()
+        self.writers = set()
+
+        METRICS.gauge(
+            'watbridge_tg_inflight_requests',
+            'Telegram requests being performed by the event loop.',
+            func=lambda: self.transport.inflight
+        )
+
+    def in_loop(self):
+        """Check whether the caller runs in the loop thread."""
+        return threading.current_thread() is self.thread
+
+    def run(self):
+        """Run the bridge until it is interrupted."""
+        asyncio.set_event_loop(self.loop)
+        self.thread = threading.current_thread()
+
+        tgsender.transport = self.transport
+
+        tasks = []
+
+        if self.wa:
+            WA_QUEUE.wakeup = lambda: self.loop.call_soon_threadsafe(self.wa_tick)
+            tasks.append(self.run_wa())
+
+        if self.tg:
+            tasks.append(self.run_tg())
+
+        try:
+            self.loop.run_until_complete(asyncio.gather(*tasks))
+
+        finally:
+            WA_QUEUE.wakeup = None
+            tgsender.transport = None
+
+    async def api(self, method, params, timeout=None):
+        """Perform a Bot API request.
+
+        Returns:
+            The `result` field of the response.
+
+        Raises:
+            ApiException: if Telegram returned an error.
+            ConnectionError: if the request could not be completed.
+        """
+        url = apihelper.API_URL.format(tgbot.token, method)
+        response = await self.client.post(url, params, timeout)
+
+        try:
+            result = response.json()
+
+        except ValueError:
+            result = None
+
+        if response.status_code != 200 or not result or not result.get('ok'):
+            raise apihelper.ApiException(
+                'The server returned HTTP %d. Response body:\n[%s]'
+                % (response.status_code, response.text),
+                method,
+                response
+            )
+
+        return result['result']
+
+    # Telegram
+
+    async def run_tg(self):
+        """Poll Telegram for updates and call the bot handlers."""
+        if SETTINGS['tg_mode'] == 'webhook':
+            # The webhook server keeps its own thread, its handlers still
+            # send messages through the loop
+            await self.loop.run_in_executor(None, tg_listener)
+            return
+
+        params = {'timeout': 20}
+
+        while True:
+            try:
+                updates = await self.api('getUpdates', params, timeout=30)
+
+                TG_SUPERVISOR.mark_connected()
+
+                if updates:
+                    params['offset'] = updates[-1]['update_id'] + 1
+                    tgbot.process_new_updates([types.Update.de_json(u) for u in updates])
+
+            except Exception as e:
+                await asyncio.sleep(TG_SUPERVISOR.failed(e))
+
+    # Whatsapp
+
+    async def run_wa(self):
+        """Keep the Whatsapp connection open."""
+        while True:
+            try:
+                if not asyncore.socket_map:
+                    logger.info('Start Whatsapp connection')
+                    WA_STACK.broadcastEvent(_connect_signal)
+
+                while asyncore.socket_map:
+                    self.wa_tick()
+                    await asyncio.sleep(SETTINGS['wa_poll_interval'])
+
+                raise ConnectionError('Whatsapp connection closed')
+
+            except Exception as e:
+                self.sync_sockets()
+                await asyncio.sleep(WA_SUPERVISOR.failed(e))
+
+    def wa_tick(self):
+        """Send queued messages and update the watched sockets."""
+        if wabot.connected:
+            WA_SUPERVISOR.mark_connected()
+
+        WA_QUEUE.drain(wabot)
+        WA_RECEIPTS.flush(wabot)
+        wabot.expire_uploads()
+        self.sync_sockets()
+
+    def sync_sockets(self):
+        """Watch the yowsup sockets according to their current state.
+
+        Like `asyncore.poll()`, a socket is watched for reading or writing
+        depending on the `readable()` and `writable()` methods of its
+        dispatcher, which change over time.
+        """
+        sockets = dict(asyncore.socket_map)
+
+        for fd in list(self.readers):
+            if fd not in sockets or not sockets[fd].readable():
+                self.loop.remove_reader(fd)
+                self.readers.discard(fd)
+
+        for fd in list(self.writers):
+            if fd not in sockets or not sockets[fd].writable():
+                self.loop.remove_writer(fd)
+                self.writers.discard(fd)
+
+        for fd, dispatcher in sockets.items():
+            if fd not in self.readers and dispatcher.readable():
+                self.loop.add_reader(fd, self._on_socket, asyncore.read, dispatcher)
+                self.readers.add(fd)
+
+            if fd not in self.writers and dispatcher.writable():
+                self.loop.add_writer(fd, self._on_socket, asyncore.write, dispatcher)
+                self.writers.add(fd)
+
+    def _on_socket(self, handler, dispatcher):
+        handler(dispatcher)
+        self.sync_sockets()
@@ -27,12 +27,21 @@
 
 """Signal handlers."""
 
+import os
 import sys
+import threading
+import time
 
 from wat_bridge.static import SETTINGS, get_logger
-from wat_bridge.helper import get_contact, get_phone, db_get_group
-from wat_bridge.tg import tgbot
-from wat_bridge.wa import wabot
+from wat_bridge.helper import get_contact, get_phone, db_get_group, db_get_wa_group
+from wat_bridge.media import TRANSFERS, MediaTooLarge, download_tg, \
+        download_wa, file_digest, send_tg_ref, temp_path, tg_file_id, \
+        upload_tg
+from wat_bridge.mediacache import MEDIA_CACHE
+from wat_bridge.metrics import SIGNALS, UNKNOWN_SENDERS, WA_TO_TG_LATENCY
+from wat_bridge.relay import OUTBOX, TG_QUEUE
+from wat_bridge.tg import tgbot, tgsender
+from wat_bridge.wa import FLOOD_GUARD, WA_QUEUE, WA_RECEIPTS
 from telebot import util as tgutil
 
 logger = get_logger('signals')
@@ -48,10 +57,34 @@ def to_tg_handler(sender, **kwargs):
 
     Args:
         phone (str): Phone number that sent the message.
-        message (str): The message received
+        message (str): The message received (or caption of the media)
+        received (float): Time the message was received from Whatsapp
+        media (dict): Media file to relay, as returned by
+            `wat_bridge.media.wa_media_info()`
+        notice (str): Message from the bridge to send to the owner instead
+        wa_group (str): JID of the Whatsapp group the message was sent to,
+            `phone` being the participant that sent it
+        notify (str): Name the participant chose for itself in Whatsapp
     """
     phone = kwargs.get('phone')
     message = kwargs.get('message', '')
+    received = kwargs.get('received')
+    media = kwargs.get('media')
+    notice = kwargs.get('notice')
+
+    SIGNALS.inc(signal='TO_TG')
+
+    if notice:
+        # Message from the bridge itself
+        tgsender.send_message(SETTINGS['owner'], notice)
+        return
+
+    if kwargs.get('wa_group'):
+        chat_id, output = wa_group_output(
+            kwargs['wa_group'], phone, kwargs.get('notify'), message)
+
+        deliver_tg(chat_id, output, media, received)
+        return
 
     # Check if known contact
     contact = get_contact(phone)
@@ -66,6 +99,7 @@ def to_tg_handler(sender, **kwargs):
         output += message
 
         logger.info('received message from unknown number: %s' % phone)
+        UNKNOWN_SENDERS.inc()
 
     else:
         group = db_get_group(contact)
@@ -81,9 +115,195 @@ def to_tg_handler(sender, **kwargs):
 
         logger.info('received message from %s' % contact)
 
-    # Deliver message through Telegram
-    for chunk in tgutil.split_string(output, 3000):
-        tgbot.send_message(chat_id, chunk)
+    deliver_tg(chat_id, output, media, received)
+
+
+def wa_group_output(jid, phone, notify, message):
+    """Build the Telegram message for a message sent to a Whatsapp group.
+
+    The group is looked up by JID, participants are not looked up in the
+    contacts, and their name is taken from the message itself.
+
+    Args:
+        jid (str): JID of the Whatsapp group.
+        phone (str): Phone of the participant.
+        notify (str): Name of the participant, may be `None`.
+        message (str): The message received.
+
+    Returns:
+        Tuple with the Telegram chat to send the message to and its text.
+    """
+    author = '%s (%s)' % (notify, phone) if notify else phone
+    group = db_get_wa_group(jid)
+
+    if group and group[1]:
+        # Bound to a Telegram group
+        return group[1], '%s:\n%s' % (author, message)
+
+    if group:
+        output = 'Message from group #%s\n' % group[0]
+    else:
+        output = 'Message from #unknown group\n'
+        output += 'Group: %s\n' % jid
+
+        logger.info('received message from unknown group: %s' % jid)
+
+    output += 'Participant: %s\n' % author
+    output += '---------\n'
+    output += message
+
+    return SETTINGS['owner'], output
+
+
+def deliver_tg(chat_id, output, media=None, received=None):
+    """Send a relayed message through Telegram.
+
+    Args:
+        chat_id (int): Chat to send the message to.
+        output (str): Text of the message (or caption of the media).
+        media (dict): Media file to relay.
+        received (float): Time the message was received from Whatsapp.
+    """
+    if media:
+        relay_wa_media(chat_id, media, output)
+
+    else:
+        for chunk in tgutil.split_string(output, 3000):
+            tgsender.send_message(chat_id, chunk)
+
+    if received:
+        WA_TO_TG_LATENCY.observe(time.time() - received)
+
+
+def relay_wa_media(chat_id, media, caption):
+    """Stream a Whatsapp media file to a Telegram chat.
+
+    Files that were already uploaded are sent by reference instead.
+
+    Args:
+        chat_id (int): Chat to send the file to.
+        media (dict): Media information.
+        caption (str): Caption of the file.
+    """
+    if send_cached_tg(chat_id, media.get('digest'), media, caption):
+        return
+
+    with TRANSFERS:
+        try:
+            spool = download_wa(media)
+
+        except MediaTooLarge:
+            logger.info('media file is too large, sending notice')
+            tgsender.send_message(
+                chat_id,
+                caption + '\n[%s file too large to relay]' % media['type']
+            )
+            return
+
+        def upload():
+            # Retries must send the whole file again
+            spool.rewind()
+            return upload_tg(tgbot.token, chat_id, spool, media, caption)
+
+        try:
+            digest = spool.digest()
+
+            # Whatsapp does not always include the hash of the file
+            if not media.get('digest') and send_cached_tg(chat_id, digest, media, caption):
+                return
+
+            sent = tgsender.call(chat_id, upload)
+            MEDIA_CACHE.put(digest, 'tg', tg_file_id(sent, media['type']))
+
+        finally:
+            spool.close()
+
+
+def send_cached_tg(chat_id, digest, media, caption):
+    """Send a file to Telegram using the media cache.
+
+    Args:
+        chat_id (int): Chat to send the file to.
+        digest (str): Digest of the file.
+        media (dict): Media information.
+        caption (str): Caption of the file.
+
+    Returns:
+        `True` if the file was sent, `False` if it has to be uploaded.
+    """
+    file_id = MEDIA_CACHE.get(digest, 'tg')
+
+    if not file_id:
+        return False
+
+    try:
+        tgsender.call(chat_id, send_tg_ref, tgbot.token, chat_id, file_id, media, caption)
+
+    except Exception as e:
+        logger.warning('could not send cached file, uploading it: %s' % e)
+        return False
+
+    return True
+
+
+def start_wa_media(phone, message, media, entry=None, received=None):
+    """Download a Telegram file and queue it for Whatsapp.
+
+    The download runs in its own thread, and the file is queued once it is
+    complete. The transfer slot is released by the send queue after the
+    upload.
+
+    Args:
+        phone (str): Phone to send the file to.
+        message (str): Caption of the file.
+        media (dict): Telegram `file_id` and `type` of the file.
+        entry (int): ID of the message in the outbox.
+        received (float): Time the message was received from Telegram.
+    """
+    def worker():
+        TRANSFERS.acquire()
+        path = temp_path()
+
+        try:
+            download_tg(tgbot, media['file_id'], path)
+            digest = file_digest(path)
+
+            if media['type'] != 'audio':
+                # Voice notes cannot be sent back as audio files
+                MEDIA_CACHE.put(digest, 'tg', media['file_id'])
+
+            queued = WA_QUEUE.put(
+                phone,
+                message,
+                received,
+                entry,
+                media={'path': path, 'type': media['type'], 'digest': digest}
+            )
+
+        except Exception as e:
+            logger.error('could not download media for %s: %s' % (phone, e))
+            queued = None
+
+        if not queued:
+            TRANSFERS.release()
+
+            try:
+                os.remove(path)
+
+            except OSError:
+                pass
+
+            if entry:
+                OUTBOX.done(entry)
+
+            tgsender.send_message(
+                SETTINGS['owner'],
+                'Could not relay %s file to %s' % (media['type'], phone)
+            )
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
 
 
 def to_wa_handler(sender, **kwargs):
@@ -91,25 +311,99 @@ def to_wa_handler(sender, **kwargs):
 
     This will involve sending messages through the Whatsapp bot.
 
+    Messages are not sent right away, but queued for the Whatsapp listener.
+
     Args:
         contact (str): Name of the contact to send the message to.
-        message (str): The message to send
+        message (str): The message to send (or caption of the media)
+        received (float): Time the message was received from Telegram
+        media (dict): Telegram `file_id` and `type` of the media to send
+
+    Returns:
+        Position of the message in the send queue or `None` if it could not
+        be queued.
     """
     contact = kwargs.get('contact')
     message = kwargs.get('message')
+    media = kwargs.get('media')
+
+    SIGNALS.inc(signal='TO_WA')
 
     # Check if known contact
     phone = get_phone(contact)
 
     if not phone:
         # Abort
-        tgbot.send_message(
+        tgsender.send_message(
             SETTINGS['owner'],
             'Unknown contact: "%s"' % contact
         )
 
         return
 
-    logger.info('sending message to %s (%s)' % (contact, phone))
+    logger.info('queueing message to %s (%s)' % (contact, phone))
+
+    if media:
+        entry = OUTBOX.append('wa', phone=phone, message=message, media=media)
+        start_wa_media(phone, message, media, entry, kwargs.get('received'))
+
+        return
+
+    entry = OUTBOX.append('wa', phone=phone, message=message)
+    position = WA_QUEUE.put(phone, message, kwargs.get('received'), entry)
+
+    if not position:
+        OUTBOX.done(entry)
+        tgsender.send_message(
+            SETTINGS['owner'],
+            'Whatsapp send queue is full, message to "%s" was not sent' % contact
+        )
+
+    return position
+
+
+def queues_handler(sender, **kwargs):
+    """Report the state of the message queues.
+
+    Returns:
+        Dict with the number of messages waiting to be delivered to
+        Telegram (`tg_depth`) and Whatsapp (`wa_depth`), and the age in
+        seconds of the oldest message for Whatsapp (`wa_oldest_age`), as
+        well as the number of senders banned for flooding (`flood_banned`)
+        and of receipts saved by merging them (`receipts_saved`).
+    """
+    return {
+        'tg_depth': TG_QUEUE.depth(),
+        'wa_depth': WA_QUEUE.depth(),
+        'wa_oldest_age': WA_QUEUE.oldest_age(),
+        'flood_banned': FLOOD_GUARD.banned_count(),
+        'receipts_saved': WA_RECEIPTS.frames_saved
+    }
+
+
+def replay_outbox():
+    """Queue again the messages that were not relayed in a previous run."""
+    pending = OUTBOX.pending()
+
+    if pending:
+        logger.info('replaying %d messages from the outbox' % len(pending))
+
+    for entry, direction, payload in pending:
+        if direction == 'tg':
+            TG_QUEUE.put(
+                payload.get('wa_group') or payload['phone'],
+                phone=payload['phone'],
+                message=payload['message'],
+                received=payload.get('received'),
+                media=payload.get('media'),
+                wa_group=payload.get('wa_group'),
+                notify=payload.get('notify'),
+                entries=[entry]
+            )
+
+        elif direction == 'wa' and payload.get('media'):
+            start_wa_media(payload['phone'], payload['message'], payload['media'], entry)
 
-    wabot.send_msg(phone=phone, message=message)
+        elif direction == 'wa':
+            if not WA_QUEUE.put(payload['phone'], payload['message'], entry=entry):
+                logger.error('could not replay message to %s, queue is full' % payload['phone'])
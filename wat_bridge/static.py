@@ -28,23 +28,27 @@
 """Static elements."""
 
 from six.moves import configparser
-from tinydb import TinyDB, Query
-from tinydb_smartcache import SmartCacheTable
 import blinker
 import logging
 import os
 import sys
 
+from wat_bridge.storage import BACKENDS, NAMESPACE_RE, open_storage
+
 # Main settings
 SETTINGS = {}
 
 # Database
 DB = None
-CONTACT = Query()
 
 # Signals
 SIGNAL_TG = blinker.signal('TO_TG')
 SIGNAL_WA = blinker.signal('TO_WA')
+SIGNAL_DB = blinker.signal('DB_CHANGED')
+SIGNAL_QUEUES = blinker.signal('QUEUES')
+
+# Processes of the split mode
+ROLES = ('wa', 'tg')
 
 def get_logger(name):
     """ Get a logger with the given name. """
@@ -57,15 +61,73 @@ def get_logger(name):
     handler.setLevel(logging.DEBUG)
 
     # Formatting
-    formatter = logging.Formatter('[%(levelname)s] %(asctime)s - %(name)s[%(funcName)s]: %(message)s')
+    fmt = '[%(levelname)s] %(asctime)s - %(name)s[%(funcName)s]: %(message)s'
+
+    # Tell apart the output of each process in multi-account and split modes
+    process = '/'.join(v for v in (os.getenv('WAT_INSTANCE'), os.getenv('WAT_ROLE')) if v)
+    if process:
+        fmt = process + ' ' + fmt
+
+    formatter = logging.Formatter(fmt)
 
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
     return logger
 
-def init_bridge():
-    """Parse the configuration file and set relevant variables."""
+def _get_option(parser, section, option, default=None, getter='get'):
+    """Obtain an optional setting from the configuration file.
+
+    Args:
+        parser: Configuration parser.
+        section (str): Section of the file.
+        option (str): Name of the option.
+        default: Value to return if the option is not present.
+        getter (str): Name of the parser method used to read the value
+            (e.g. `getint`).
+
+    Returns:
+        Value of the option or `default`.
+    """
+    if not parser.has_option(section, option):
+        return default
+
+    return getattr(parser, getter)(section, option)
+
+def get_instances(parser):
+    """Obtain the names of the bridge instances defined in the configuration.
+
+    Args:
+        parser: Configuration parser.
+
+    Returns:
+        List of names, empty if the configuration defines a single bridge.
+    """
+    value = _get_option(parser, 'bridge', 'instances', '')
+    names = [name.strip() for name in value.split(',') if name.strip()]
+
+    for name in names:
+        if not NAMESPACE_RE.match(name):
+            sys.exit('Invalid instance name: %s' % name)
+
+    if len(set(names)) != len(names):
+        sys.exit('Duplicated instance names')
+
+    return names
+
+def read_config(instance=None):
+    """Read the configuration file given in the `WAT_CONF` variable.
+
+    The sections of an instance are named after the regular sections with
+    the name of the instance as prefix (e.g. `[work:wa]`), and their options
+    take precedence over those in the regular sections.
+
+    Args:
+        instance (str): Name of the instance to read the settings of.
+
+    Returns:
+        Configuration parser.
+    """
     conf_path = os.path.abspath(os.getenv('WAT_CONF', ''))
 
     if not conf_path or not os.path.isfile(conf_path):
@@ -74,15 +136,214 @@ def init_bridge():
     parser = configparser.ConfigParser()
     parser.read(conf_path)
 
+    if not instance:
+        return parser
+
+    if instance not in get_instances(parser):
+        sys.exit('Unknown instance: %s' % instance)
+
+    prefix = instance + ':'
+
+    for section in parser.sections():
+        if not section.startswith(prefix):
+            continue
+
+        target = section[len(prefix):]
+
+        if not parser.has_section(target):
+            parser.add_section(target)
+
+        for option, value in parser.items(section, raw=True):
+            parser.set(target, option, value)
+
+    return parser
+
+def _instance_port(parser, section, option, default, per_role=False):
+    """Obtain a port that must be different for each process.
+
+    Ports set in the regular sections are shifted by the position of the
+    instance, unless the instance sets its own. Ports opened by both
+    processes of the split mode (`per_role`) are shifted by one more in the
+    Telegram process.
+    """
+    port = _get_option(parser, section, option, default, 'getint')
+
+    if not port:
+        return port
+
+    instance = SETTINGS['instance']
+
+    if instance and not parser.has_option(instance + ':' + section, option):
+        step = 2 if per_role and SETTINGS['split'] else 1
+        port += get_instances(parser).index(instance) * step
+
+    if per_role and SETTINGS['role'] == 'tg':
+        port += 1
+
+    return port
+
+def init_bridge():
+    """Parse the configuration file and set relevant variables.
+
+    In multi-account mode, the settings are those of the instance given in
+    the `WAT_INSTANCE` variable. In split mode, the `WAT_ROLE` variable tells
+    which side of the bridge the process runs. Without them, only the names
+    of the instances and the mode are read, as the process will supervise
+    the others.
+    """
+    SETTINGS['instance'] = os.getenv('WAT_INSTANCE') or None
+    SETTINGS['role'] = os.getenv('WAT_ROLE') or None
+
+    parser = read_config(SETTINGS['instance'])
+
+    SETTINGS['instances'] = get_instances(parser)
+    SETTINGS['split'] = _get_option(parser, 'bridge', 'split', False, 'getboolean')
+
+    if SETTINGS['role'] and SETTINGS['role'] not in ROLES:
+        sys.exit('Unknown process role: %s' % SETTINGS['role'])
+
+    if SETTINGS['instances'] and not SETTINGS['instance']:
+        return
+
+    if SETTINGS['split'] and not SETTINGS['role']:
+        return
+
+    # Files of each instance must not clash
+    db_path = parser.get('db', 'path')
+    if SETTINGS['instance']:
+        base_path = '%s.%s' % (db_path, SETTINGS['instance'])
+    else:
+        base_path = db_path
+
+    # Bus between the processes of the split mode
+    SETTINGS['bus_path'] = _get_option(parser, 'bridge', 'bus_path', base_path + '.bus')
+    SETTINGS['bus_timeout'] = _get_option(parser, 'bridge', 'bus_timeout', 30.0, 'getfloat')
+    SETTINGS['bus_reply_timeout'] = _get_option(parser, 'bridge', 'bus_reply_timeout', 300.0, 'getfloat')
+
+    # Threads or a single event loop
+    SETTINGS['runtime'] = _get_option(parser, 'bridge', 'runtime', 'threads')
+
+    if SETTINGS['runtime'] not in ('threads', 'asyncio'):
+        sys.exit('Unknown runtime: %s' % SETTINGS['runtime'])
+
+    if SETTINGS['runtime'] == 'asyncio' and sys.version_info < (3, 5):
+        sys.exit('The asyncio runtime requires Python 3.5 or newer')
+
     # Whatsapp settings
     SETTINGS['wa_phone'] = parser.get('wa', 'phone')
     SETTINGS['wa_password'] = parser.get('wa', 'password')
+    SETTINGS['wa_poll_interval'] = _get_option(parser, 'wa', 'poll_interval', 0.1, 'getfloat')
+    SETTINGS['wa_queue_size'] = _get_option(parser, 'wa', 'queue_size', 500, 'getint')
+    SETTINGS['wa_send_rate'] = _get_option(parser, 'wa', 'send_rate', 1.0, 'getfloat')
+    SETTINGS['wa_send_burst'] = _get_option(parser, 'wa', 'send_burst', 5, 'getint')
+    SETTINGS['wa_recipient_rate'] = _get_option(parser, 'wa', 'recipient_rate', 0.2, 'getfloat')
+    SETTINGS['wa_recipient_burst'] = _get_option(parser, 'wa', 'recipient_burst', 3, 'getint')
+    SETTINGS['wa_receipt'] = _get_option(parser, 'wa', 'receipt', 'read')
+    SETTINGS['wa_receipt_window'] = _get_option(parser, 'wa', 'receipt_window', 0, 'getfloat')
+    SETTINGS['wa_receipt_max_ids'] = _get_option(parser, 'wa', 'receipt_max_ids', 50, 'getint')
+
+    if SETTINGS['wa_receipt'] not in ('read', 'delivered'):
+        sys.exit('Unknown receipt type: %s' % SETTINGS['wa_receipt'])
 
     # Telegram settings
     SETTINGS['owner'] = parser.getint('tg', 'owner')
     SETTINGS['tg_token'] = parser.get('tg', 'token')
+    SETTINGS['tg_rate'] = _get_option(parser, 'tg', 'rate', 30.0, 'getfloat')
+    SETTINGS['tg_chat_rate'] = _get_option(parser, 'tg', 'chat_rate', 1.0, 'getfloat')
+    SETTINGS['tg_group_rate'] = _get_option(parser, 'tg', 'group_rate', 20 / 60.0, 'getfloat')
+    SETTINGS['tg_retries'] = _get_option(parser, 'tg', 'retries', 3, 'getint')
+    SETTINGS['tg_pool_size'] = _get_option(parser, 'tg', 'pool_size', 10, 'getint')
+    SETTINGS['tg_connect_timeout'] = _get_option(parser, 'tg', 'connect_timeout', 3.5, 'getfloat')
+    SETTINGS['tg_read_timeout'] = _get_option(parser, 'tg', 'read_timeout', 30.0, 'getfloat')
+    SETTINGS['tg_http_retries'] = _get_option(parser, 'tg', 'http_retries', 2, 'getint')
+    SETTINGS['tg_mode'] = _get_option(parser, 'tg', 'mode', 'polling')
+    SETTINGS['tg_webhook_url'] = _get_option(parser, 'tg', 'webhook_url')
+    SETTINGS['tg_webhook_listen'] = _get_option(parser, 'tg', 'webhook_listen', '127.0.0.1')
+    SETTINGS['tg_webhook_port'] = _instance_port(parser, 'tg', 'webhook_port', 8443)
+    SETTINGS['tg_webhook_path'] = _get_option(parser, 'tg', 'webhook_path', '/telegram')
+    SETTINGS['tg_webhook_secret'] = _get_option(parser, 'tg', 'webhook_secret')
+
+    if SETTINGS['tg_mode'] not in ('polling', 'webhook'):
+        sys.exit('Unknown Telegram mode: %s' % SETTINGS['tg_mode'])
+
+    if SETTINGS['tg_mode'] == 'webhook' and not SETTINGS['tg_webhook_url']:
+        sys.exit('Telegram webhook mode requires a webhook_url')
+
+    # Relay settings
+    SETTINGS['relay_workers'] = _get_option(parser, 'relay', 'workers', 2, 'getint')
+    SETTINGS['relay_queue_size'] = _get_option(parser, 'relay', 'queue_size', 1000, 'getint')
+    SETTINGS['relay_overflow'] = _get_option(parser, 'relay', 'overflow', 'block')
+    SETTINGS['relay_spill_path'] = _get_option(
+        parser, 'relay', 'spill_path', base_path + '.spill')
+
+    SETTINGS['relay_outbox_path'] = _get_option(
+        parser, 'relay', 'outbox_path', base_path + '.outbox')
+    SETTINGS['relay_fsync_batch'] = _get_option(parser, 'relay', 'fsync_batch', 1, 'getint')
+    SETTINGS['relay_fsync_interval'] = _get_option(parser, 'relay', 'fsync_interval', 1.0, 'getfloat')
+    SETTINGS['relay_compact_every'] = _get_option(parser, 'relay', 'compact_every', 1000, 'getint')
+    SETTINGS['relay_coalesce_window'] = _get_option(parser, 'relay', 'coalesce_window', 0, 'getfloat')
+    SETTINGS['relay_coalesce_max_size'] = _get_option(parser, 'relay', 'coalesce_max_size', 3000, 'getint')
+    SETTINGS['relay_retries'] = _get_option(parser, 'relay', 'retries', 3, 'getint')
+    SETTINGS['relay_retry_base'] = _get_option(parser, 'relay', 'retry_base', 2.0, 'getfloat')
+    SETTINGS['relay_retry_cap'] = _get_option(parser, 'relay', 'retry_cap', 60.0, 'getfloat')
+
+    if SETTINGS['relay_overflow'] not in ('block', 'drop_oldest', 'spill'):
+        sys.exit('Unknown relay overflow policy: %s' % SETTINGS['relay_overflow'])
+
+    if SETTINGS['role'] == 'tg':
+        # Only the Whatsapp process delivers to Telegram, and its spill
+        # files must not be cleaned up by the other process. The outbox is
+        # only written by the Whatsapp process as well, opening it here
+        # would replace the file it is appending to
+        SETTINGS['relay_spill_path'] = None
+        SETTINGS['relay_outbox_path'] = None
+
+    # Flood control settings
+    SETTINGS['flood_limit'] = _get_option(parser, 'flood', 'limit', 30, 'getint')
+    SETTINGS['flood_window'] = _get_option(parser, 'flood', 'window', 60.0, 'getfloat')
+    SETTINGS['flood_ban'] = _get_option(parser, 'flood', 'ban', 3600.0, 'getfloat')
+    SETTINGS['flood_max_senders'] = _get_option(parser, 'flood', 'max_senders', 10000, 'getint')
+
+    # Media settings
+    SETTINGS['media_enabled'] = _get_option(parser, 'media', 'enabled', True, 'getboolean')
+    SETTINGS['media_max_transfers'] = _get_option(parser, 'media', 'max_transfers', 2, 'getint')
+    SETTINGS['media_spool_threshold'] = _get_option(parser, 'media', 'spool_threshold', 1024 * 1024, 'getint')
+    SETTINGS['media_max_size'] = _get_option(parser, 'media', 'max_size', 50 * 1024 * 1024, 'getint')
+    SETTINGS['media_chunk_size'] = _get_option(parser, 'media', 'chunk_size', 64 * 1024, 'getint')
+    SETTINGS['media_timeout'] = _get_option(parser, 'media', 'timeout', 60.0, 'getfloat')
+    SETTINGS['media_upload_timeout'] = _get_option(parser, 'media', 'upload_timeout', 300.0, 'getfloat')
+    SETTINGS['media_tmp_dir'] = _get_option(parser, 'media', 'tmp_dir')
+    SETTINGS['media_cache_path'] = _get_option(
+        parser, 'media', 'cache_path', base_path + '.media')
+    SETTINGS['media_cache_size'] = _get_option(parser, 'media', 'cache_size', 10000, 'getint')
+    SETTINGS['media_cache_ttl'] = _get_option(parser, 'media', 'cache_ttl', 7 * 24 * 3600.0, 'getfloat')
+
+    # Deduplication settings
+    SETTINGS['dedup_enabled'] = _get_option(parser, 'dedup', 'enabled', True, 'getboolean')
+    SETTINGS['dedup_ttl'] = _get_option(parser, 'dedup', 'ttl', 24 * 3600.0, 'getfloat')
+    SETTINGS['dedup_size'] = _get_option(parser, 'dedup', 'size', 10000, 'getint')
+    SETTINGS['dedup_path'] = _get_option(
+        parser, 'dedup', 'path',
+        base_path + '.dedup' + ('.' + SETTINGS['role'] if SETTINGS['role'] else ''))
+
+    if not _get_option(parser, 'dedup', 'persist', True, 'getboolean'):
+        SETTINGS['dedup_path'] = None
+
+    # Reconnection settings
+    SETTINGS['reconnect_base'] = _get_option(parser, 'reconnect', 'base', 1.0, 'getfloat')
+    SETTINGS['reconnect_cap'] = _get_option(parser, 'reconnect', 'cap', 300.0, 'getfloat')
+    SETTINGS['reconnect_stable'] = _get_option(parser, 'reconnect', 'stable', 30.0, 'getfloat')
+
+    # Metrics
+    SETTINGS['metrics_listen'] = _get_option(parser, 'metrics', 'listen', '127.0.0.1')
+    SETTINGS['metrics_port'] = _instance_port(parser, 'metrics', 'port', None, per_role=True)
+
+    # Database
+    SETTINGS['db_backend'] = _get_option(parser, 'db', 'backend', 'tinydb')
+    SETTINGS['db_path'] = db_path
+
+    if SETTINGS['db_backend'] not in BACKENDS:
+        sys.exit('Unknown database backend: %s' % SETTINGS['db_backend'])
 
-    # TinyDB
     global DB
-    DB = TinyDB(parser.get('db', 'path'))
-    DB.table_class = SmartCacheTable
+    DB = open_storage(SETTINGS['db_backend'], db_path, SETTINGS['instance'])
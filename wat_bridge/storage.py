@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Storage backends for contacts and blacklisted phones."""
+
+import re
+import sqlite3
+import threading
+
+from tinydb import TinyDB
+
+# Fields of every element
+FIELDS = ('name', 'phone', 'blacklisted', 'group')
+
+# Valid namespace names (used in table names)
+NAMESPACE_RE = re.compile(r'^\w+$')
+
+
+class Storage(object):
+    """Interface implemented by the storage backends.
+
+    Elements are dicts with the keys in `FIELDS` and are identified by an
+    integer ID assigned by the backend.
+    """
+
+    def all(self):
+        """Obtain every element.
+
+        Returns:
+            List of (ID, element) tuples in insertion order.
+        """
+        raise NotImplementedError
+
+    def insert(self, element):
+        """Insert an element.
+
+        Returns:
+            ID of the inserted element.
+        """
+        return self.insert_many([element])[0]
+
+    def insert_many(self, elements):
+        """Insert several elements in a single write.
+
+        Returns:
+            List with the IDs of the inserted elements.
+        """
+        raise NotImplementedError
+
+    def update(self, fields, eids):
+        """Update some fields of the given elements."""
+        raise NotImplementedError
+
+    def remove(self, eids):
+        """Remove the given elements."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the backend."""
+        pass
+
+
+class TinyDBStorage(Storage):
+    """Backend storing the elements in a TinyDB JSON file.
+
+    Note that TinyDB rewrites the whole file on every write, so the file
+    cannot be shared between processes.
+
+    Args:
+        path (str): Path to the database file.
+        namespace (str): Table holding the elements, the default table is
+            used if not given.
+    """
+
+    def __init__(self, path, namespace=None):
+        self.db = TinyDB(path)
+        self.table = self.db.table(namespace) if namespace else self.db
+
+    def all(self):
+        return [(e.eid, dict(e)) for e in sorted(self.table.all(), key=lambda e: e.eid)]
+
+    def insert(self, element):
+        return self.table.insert(element)
+
+    def insert_many(self, elements):
+        return self.table.insert_multiple(elements)
+
+    def update(self, fields, eids):
+        self.table.update(fields, eids=eids)
+
+    def remove(self, eids):
+        self.table.remove(eids=eids)
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteStorage(Storage):
+    """Backend storing the elements in a SQLite database.
+
+    The database uses write-ahead logging and has unique indexes on the
+    phone (for contacts and blacklisted phones separately), the name and
+    the group, so that each write only touches the affected rows.
+
+    Several processes may share the same file, each namespace is stored in
+    its own table.
+
+    Args:
+        path (str): Path to the database file.
+        namespace (str): Suffix of the table holding the elements.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS {table} ('
+        '    id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        '    name TEXT,'
+        '    phone TEXT NOT NULL,'
+        '    blacklisted INTEGER NOT NULL DEFAULT 0,'
+        '    grp INTEGER'
+        ')',
+        'CREATE UNIQUE INDEX IF NOT EXISTS {table}_phone'
+        '    ON {table} (phone, blacklisted)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS {table}_name'
+        '    ON {table} (name) WHERE name IS NOT NULL',
+        'CREATE UNIQUE INDEX IF NOT EXISTS {table}_grp'
+        '    ON {table} (grp) WHERE grp IS NOT NULL',
+    )
+
+    def __init__(self, path, namespace=None):
+        self.table = 'contacts_%s' % namespace if namespace else 'contacts'
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+
+            with self.conn:
+                for statement in self.SCHEMA:
+                    self.conn.execute(statement.format(table=self.table))
+
+    @staticmethod
+    def _row(element):
+        return (
+            element.get('name'),
+            element['phone'],
+            1 if element.get('blacklisted') else 0,
+            element.get('group')
+        )
+
+    def all(self):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, name, phone, blacklisted, grp FROM %s ORDER BY id' % self.table
+            ).fetchall()
+
+        return [
+            (r[0], {'name': r[1], 'phone': r[2], 'blacklisted': bool(r[3]), 'group': r[4]})
+            for r in rows
+        ]
+
+    def insert_many(self, elements):
+        eids = []
+
+        with self.lock, self.conn:
+            for element in elements:
+                cursor = self.conn.execute(
+                    'INSERT INTO %s (name, phone, blacklisted, grp) VALUES (?, ?, ?, ?)' % self.table,
+                    self._row(element)
+                )
+
+                eids.append(cursor.lastrowid)
+
+        return eids
+
+    def update(self, fields, eids):
+        columns = {'name': 'name', 'phone': 'phone', 'blacklisted': 'blacklisted', 'group': 'grp'}
+        names = [f for f in fields if f in columns]
+
+        if not names or not eids:
+            return
+
+        assignments = ', '.join('%s = ?' % columns[f] for f in names)
+        values = [fields[f] for f in names]
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'UPDATE %s SET %s WHERE id = ?' % (self.table, assignments),
+                [values + [eid] for eid in eids]
+            )
+
+    def remove(self, eids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM %s WHERE id = ?' % self.table,
+                [(eid,) for eid in eids]
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Available backends
+BACKENDS = {
+    'tinydb': TinyDBStorage,
+    'sqlite': SQLiteStorage
+}
+
+
+def open_storage(backend, path, namespace=None):
+    """Open a storage backend.
+
+    Args:
+        backend (str): Name of the backend (see `BACKENDS`).
+        path (str): Path to the database file.
+        namespace (str): Keeps the elements apart from those of other
+            namespaces in the same file (letters, digits and underscores).
+
+    Returns:
+        Storage instance.
+
+    Raises:
+        ValueError: if the backend does not exist or the namespace is not
+            valid.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown database backend: %s' % backend)
+
+    if namespace and not NAMESPACE_RE.match(namespace):
+        raise ValueError('Invalid namespace: %s' % namespace)
+
+    return BACKENDS[backend](path, namespace)
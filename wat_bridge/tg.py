@@ -27,23 +27,85 @@
 
 """Code for the Telegram side of the bridge."""
 
+import io
 import telebot
+import time
 
-from wat_bridge.static import SETTINGS, SIGNAL_WA, get_logger
+from wat_bridge.static import SETTINGS, SIGNAL_QUEUES, SIGNAL_WA, get_logger
+from wat_bridge.dedup import is_duplicate
 from wat_bridge.helper import db_add_contact, db_rm_contact, \
-        db_add_blacklist, db_rm_blacklist, db_list_contacts, \
-        get_blacklist, get_contact, get_phone, is_blacklisted, \
-        db_get_group, db_set_group, db_get_contact_by_group, safe_cast
+        db_add_blacklist, db_rm_blacklist, \
+        get_contact, get_phone, is_blacklist_rule, \
+        db_get_group, db_set_group, db_get_contact_by_group, safe_cast, \
+        db_import_contacts, contacts_from_csv, contacts_to_csv, db_page, \
+        db_add_wa_group, db_get_wa_group
+from wat_bridge.media import MediaTooLarge, read_tg
+from wat_bridge.mediacache import MEDIA_CACHE
+from wat_bridge.phones import group_jid, normalize, parse_rule
+from wat_bridge.tgsend import TgSender
+from wat_bridge.tgsession import TG_SESSION
 
 logger = get_logger('tg')
 
+# Maximum size of a CSV file accepted by /import
+IMPORT_MAX_SIZE = 1024 * 1024
+
+# Maximum number of skipped rows listed in the reply to /import
+IMPORT_MAX_CONFLICTS = 20
+
+# Entries shown in each page of /contacts and /blacklist
+PAGE_SIZE = 20
+
+# Telegram limits callback data to 64 bytes, the filter is sent along
+PAGE_MAX_FILTER = 32
+
+# Listing kinds as sent in callback data
+PAGE_KINDS = {'c': 'contacts', 'b': 'blacklist'}
+
+
+class BridgeBot(telebot.TeleBot):
+    """Telegram bot that ignores updates it already processed.
+
+    Updates may be received again after restarting the polling loop or when
+    Telegram retries a webhook request. They are identified by their
+    `update_id` and, for messages, by their chat and `message_id`.
+    """
+
+    def process_new_updates(self, updates):
+        updates = [u for u in updates if not _is_duplicate_update(u)]
+
+        if updates:
+            super(BridgeBot, self).process_new_updates(updates)
+
+
+def _is_duplicate_update(update):
+    if is_duplicate('tg', 'update', update.update_id):
+        return True
+
+    message = getattr(update, 'message', None)
+
+    return bool(message) and is_duplicate('tg', message.chat.id, message.message_id)
+
+
 # Telegram bot
-tgbot = telebot.TeleBot(
+tgbot = BridgeBot(
     SETTINGS['tg_token'],
     threaded=False,
     skip_pending=False
 )
 
+# Reuse connections for every request made by the bot
+TG_SESSION.install()
+
+# Every message sent by the bot goes through the scheduler
+tgsender = TgSender(
+    tgbot,
+    rate=SETTINGS['tg_rate'],
+    chat_rate=SETTINGS['tg_chat_rate'],
+    group_rate=SETTINGS['tg_group_rate'],
+    retries=SETTINGS['tg_retries']
+)
+
 # Create handlers
 
 @tgbot.message_handler(commands=['start', 'help'])
@@ -58,18 +120,27 @@ def start(message):
                 '   /help -> shows this help message\n'
                 '   /add <name> <phone> -> add a new contact to database\n'
                 '   /bind <name> <group id> -> bind a contact to a group\n'
-                '   /contacts -> list contacts\n'
+                '   /bindgroup <name> <whatsapp group id> <group id> -> bind a'
+                ' Whatsapp group to a group\n'
+                '   /contacts [filter] -> list contacts\n'
+                '   /export -> download contacts as a CSV file\n'
+                '   /import -> add contacts from a CSV file (send it with'
+                ' this caption or reply to it)\n'
                 '   /blacklist -> show blacklisted Whatsapp phones\n'
+                '   /blacklist list <filter> -> search blacklisted phones\n'
                 '   /blacklist <phone> -> blacklist a phone number\n'
+                '   /blacklist <prefix>* -> blacklist every phone with a prefix\n'
+                '   /blacklist <first>..<last> -> blacklist a range of prefixes\n'
                 '   /rm <name> -> remove a contact from database\n'
                 '   /send <name> <message> -> send message to Whatsapp contact\n'
+                '   /status -> show pending messages\n'
                 '   /unbind <name> -> unbind a contact from his group\n'
-                '   /unblacklist <phone> -> unblacklist a phone number\n\n'
+                '   /unblacklist <phone or rule> -> unblacklist a phone number\n\n'
                 'Note that blacklisting a phone number will make the bot ignore'
                 ' any Whatsapp messages that come from that number.'
                )
 
-    tgbot.reply_to(message, response)
+    tgsender.reply_to(message, response)
 
 @tgbot.message_handler(commands=['me'])
 def me(message):
@@ -78,7 +149,7 @@ def me(message):
     Args:
         message: Received Telegram message.
     """
-    tgbot.reply_to(message, message.chat.id)
+    tgsender.reply_to(message, message.chat.id)
 
 @tgbot.message_handler(commands=['add'])
 def add_contact(message):
@@ -92,7 +163,7 @@ def add_contact(message):
         message: Received Telegram message.
     """
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'You are not the owner of this bot')
+        tgsender.reply_to(message, 'You are not the owner of this bot')
         return
 
     # Get name and phone
@@ -100,18 +171,24 @@ def add_contact(message):
     name, phone = args.split(maxsplit=1)
 
     if not name or not phone:
-        tgbot.reply_to(message, 'Syntax: /add <name> <phone>')
+        tgsender.reply_to(message, 'Syntax: /add <name> <phone>')
+        return
+
+    phone = normalize(phone)
+
+    if not phone:
+        tgsender.reply_to(message, 'Invalid phone number')
         return
 
     # Check if it already exists
     if get_contact(phone) or get_phone(name):
-        tgbot.reply_to(message, 'A contact with those details already exists')
+        tgsender.reply_to(message, 'A contact with those details already exists')
         return
 
     # Add to database
     db_add_contact(name, phone)
 
-    tgbot.reply_to(message, 'Contact added')
+    tgsender.reply_to(message, 'Contact added')
 
 @tgbot.message_handler(commands=['bind'])
 def bind(message):
@@ -125,7 +202,7 @@ def bind(message):
         message: Received Telegram message.
     """
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'You are not the owner of this bot')
+        tgsender.reply_to(message, 'You are not the owner of this bot')
         return
 
     # Get name and phone
@@ -133,29 +210,84 @@ def bind(message):
     name, group_id = args.split(maxsplit=1)
 
     if not name or not group_id:
-        tgbot.reply_to(message, 'Syntax: /bind <name> <group id>')
+        tgsender.reply_to(message, 'Syntax: /bind <name> <group id>')
         return
 
     group_id = safe_cast(group_id, int)
     if not group_id:
-        tgbot.reply_to(message, 'Group id has to be a number')
+        tgsender.reply_to(message, 'Group id has to be a number')
         return
 
     # Ensure contact exists
     if not get_phone(name):
-        tgbot.reply_to(message, 'No contact found with that name')
+        tgsender.reply_to(message, 'No contact found with that name')
         return
 
     # Check if it already exists
     current = db_get_contact_by_group(group_id)
     if current:
-        tgbot.reply_to(message, 'This group is already bound to ' + current)
+        tgsender.reply_to(message, 'This group is already bound to ' + current)
         return
 
     # Add to database
     db_set_group(name, group_id)
 
-    tgbot.reply_to(message, 'Bound to group')
+    tgsender.reply_to(message, 'Bound to group')
+
+@tgbot.message_handler(commands=['bindgroup'])
+def bind_group(message):
+    """Bind a Whatsapp group to a Telegram group.
+
+    Message has the following format:
+
+        /bindgroup <name> <whatsapp group id> <group id>
+
+    The Whatsapp group id is shown in the messages relayed from groups that
+    are not bound yet. The group can be removed with `/rm <name>`.
+
+    Args:
+        message: Received Telegram message.
+    """
+    if message.chat.id != SETTINGS['owner']:
+        tgsender.reply_to(message, 'You are not the owner of this bot')
+        return
+
+    args = (telebot.util.extract_arguments(message.text) or '').split()
+
+    if len(args) != 3:
+        tgsender.reply_to(message, 'Syntax: /bindgroup <name> <whatsapp group id> <group id>')
+        return
+
+    name, jid, group_id = args
+
+    jid = group_jid(jid)
+    if not jid:
+        tgsender.reply_to(message, 'Invalid Whatsapp group id')
+        return
+
+    group_id = safe_cast(group_id, int)
+    if not group_id:
+        tgsender.reply_to(message, 'Group id has to be a number')
+        return
+
+    # Check if it already exists
+    if get_phone(name):
+        tgsender.reply_to(message, 'A contact with that name already exists')
+        return
+
+    if db_get_wa_group(jid):
+        tgsender.reply_to(message, 'That Whatsapp group is already bound')
+        return
+
+    current = db_get_contact_by_group(group_id)
+    if current:
+        tgsender.reply_to(message, 'This group is already bound to ' + current)
+        return
+
+    # Add to database
+    db_add_wa_group(name, jid, group_id)
+
+    tgsender.reply_to(message, 'Bound to group')
 
 @tgbot.message_handler(commands=['unbind'])
 def unbind(message):
@@ -169,31 +301,31 @@ def unbind(message):
         message: Received Telegram message.
     """
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'You are not the owner of this bot')
+        tgsender.reply_to(message, 'You are not the owner of this bot')
         return
 
     # Get name and phone
     name = telebot.util.extract_arguments(message.text)
 
     if not name:
-        tgbot.reply_to(message, 'Syntax: /unbind <name>')
+        tgsender.reply_to(message, 'Syntax: /unbind <name>')
         return
 
     # Ensure contact exists
     if not get_phone(name):
-        tgbot.reply_to(message, 'No contact found with that name')
+        tgsender.reply_to(message, 'No contact found with that name')
         return
 
     # Check if it already exists
     group = db_get_group(name)
     if not group:
-        tgbot.reply_to(message, 'Contact was not bound to a group')
+        tgsender.reply_to(message, 'Contact was not bound to a group')
         return
 
     # Add to database
     db_set_group(name, None)
 
-    tgbot.reply_to(message, 'Unbound from group')
+    tgsender.reply_to(message, 'Unbound from group')
 
 @tgbot.message_handler(commands=['blacklist'])
 def blacklist(message):
@@ -202,7 +334,10 @@ def blacklist(message):
     Message has the following format:
 
         /blacklist
+        /blacklist list [filter]
         /blacklist <phone>
+        /blacklist <prefix>*
+        /blacklist <first>..<last>
 
     Note that if no phone is provided, a list of blacklisted phone is returned.
 
@@ -210,32 +345,32 @@ def blacklist(message):
         message: Received Telegram message.
     """
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'you are not the owner of this bot')
+        tgsender.reply_to(message, 'you are not the owner of this bot')
         return
 
     # Get phone
     phone = telebot.util.extract_arguments(message.text)
 
-    if not phone:
+    if not phone or phone.split()[0] == 'list':
         # Return list
-        blacklist = get_blacklist()
+        send_page(message, 'b', phone.partition(' ')[2].strip() if phone else '')
+        return
 
-        response = 'Blacklisted phones:\n\n'
-        for b in blacklist:
-            response += '- %s\n' % b
+    rule = parse_rule(phone)
 
-        tgbot.reply_to(message, response)
+    if not rule:
+        tgsender.reply_to(message, 'Syntax: /blacklist <phone>, <prefix>* or <first>..<last>')
         return
 
     # Blacklist a phone
-    if is_blacklisted(phone):
+    if is_blacklist_rule(rule):
         # Already blacklisted
-        tgbot.reply_to(message, 'That phone is already blacklisted')
+        tgsender.reply_to(message, 'That phone is already blacklisted')
         return
 
-    db_add_blacklist(phone)
+    db_add_blacklist(rule)
 
-    tgbot.reply_to(message, 'Phone has been blacklisted')
+    tgsender.reply_to(message, 'Phone has been blacklisted')
 
 @tgbot.message_handler(commands=['contacts'])
 def list_contacts(message):
@@ -243,25 +378,223 @@ def list_contacts(message):
 
     Message has the following format:
 
-        /contacts
+        /contacts [filter]
+
+    Args:
+        message: Received Telegram message.
+    """
+    if message.chat.id != SETTINGS['owner']:
+        tgsender.reply_to(message, 'you are not the owner of this bot')
+        return
+
+    send_page(message, 'c', telebot.util.extract_arguments(message.text))
+
+@tgbot.callback_query_handler(func=lambda call: (call.data or '').startswith('page:'))
+def turn_page(call):
+    """Show another page of a listing by editing its message.
+
+    Callback data has the following format:
+
+        page:<kind>:<direction>:<cursor>:<filter>
+
+    Args:
+        call: Received callback query.
+    """
+    if call.from_user.id != SETTINGS['owner']:
+        tgsender.call(
+            call.from_user.id,
+            tgbot.answer_callback_query,
+            call.id,
+            'you are not the owner of this bot'
+        )
+        return
+
+    _, kind, direction, cursor, query = call.data.split(':', 4)
+
+    text, markup = render_page(
+        kind, query, cursor=safe_cast(cursor, int), backwards=direction == 'p')
+
+    chat_id = call.message.chat.id
+
+    try:
+        tgsender.call(chat_id, _show_page, call, text, markup)
+
+    except telebot.apihelper.ApiException as e:
+        logger.error('could not edit listing: %s' % e)
+
+def _show_page(call, text, markup):
+    """Replace a listing with another page and answer the callback query."""
+    try:
+        tgbot.edit_message_text(
+            text,
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            reply_markup=markup
+        )
+
+    except telebot.apihelper.ApiException as e:
+        if 'message is not modified' not in str(e):
+            raise
+
+        # Pressing a button twice leaves the message unchanged
+        logger.debug('could not edit listing: %s' % e)
+
+    tgbot.answer_callback_query(call.id)
+
+def send_page(message, kind, query):
+    """Reply with the first page of a listing.
+
+    Args:
+        message: Received Telegram message.
+        kind (str): Listing to show, key of `PAGE_KINDS`.
+        query (str): Prefix of the names and phones to show, may be empty.
+    """
+    query = (query or '').strip()
+
+    if len(query.encode('utf-8')) > PAGE_MAX_FILTER:
+        tgsender.reply_to(message, 'Filter cannot be longer than %d bytes' % PAGE_MAX_FILTER)
+        return
+
+    text, markup = render_page(kind, query)
+
+    chat_id = message.chat.id
+    tgsender.call(
+        chat_id,
+        tgbot.send_message,
+        chat_id,
+        text,
+        reply_to_message_id=message.message_id,
+        reply_markup=markup
+    )
+
+def render_page(kind, query, cursor=None, backwards=False):
+    """Build the text and navigation buttons of a listing page.
+
+    Args:
+        kind (str): Listing to show, key of `PAGE_KINDS`.
+        query (str): Prefix of the names and phones to show, may be empty.
+        cursor (int): ID of the entry the page is relative to.
+        backwards (bool): Whether to show the page before the cursor.
+
+    Returns:
+        Tuple with the text and the inline keyboard (or `None`).
+    """
+    rows, before, after = db_page(
+        PAGE_KINDS[kind], PAGE_SIZE, cursor=cursor, backwards=backwards, query=query)
+
+    if kind == 'c':
+        lines = ['Contacts:']
+
+        for _, name, phone, group in rows:
+            if group:
+                lines.append('- %s (%s) -> group %s' % (name, phone, group))
+            else:
+                lines.append('- %s (%s)' % (name, phone))
+
+    else:
+        lines = ['Blacklisted phones:', '']
+        lines.extend('- %s' % phone for _, _, phone, _ in rows)
+
+    if not rows:
+        lines.append('(none)')
+
+    if not before and not after:
+        return '\n'.join(lines), None
+
+    buttons = []
+
+    if before:
+        buttons.append(telebot.types.InlineKeyboardButton(
+            '< prev', callback_data='page:%s:p:%d:%s' % (kind, rows[0][0], query)))
+
+    if after:
+        buttons.append(telebot.types.InlineKeyboardButton(
+            'next >', callback_data='page:%s:n:%d:%s' % (kind, rows[-1][0], query)))
+
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.row(*buttons)
+
+    return '\n'.join(lines), markup
+
+@tgbot.message_handler(commands=['export'])
+def export_contacts(message):
+    """Send the stored contacts as a CSV file.
+
+    Message has the following format:
+
+        /export
 
     Args:
         message: Received Telegram message.
     """
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'you are not the owner of this bot')
+        tgsender.reply_to(message, 'you are not the owner of this bot')
         return
 
-    contacts = db_list_contacts()
+    document = io.BytesIO(contacts_to_csv())
+    document.name = 'contacts.csv'
+
+    tgsender.call(message.chat.id, tgbot.send_document, message.chat.id, document)
+
+@tgbot.message_handler(
+    func=lambda message: (getattr(message, 'caption', None) or '').startswith('/import'),
+    content_types=['document'])
+@tgbot.message_handler(commands=['import'])
+def import_contacts(message):
+    """Add the contacts found in a CSV file to the database.
+
+    The file contains `name,phone[,group]` rows and is either sent with
+    `/import` as caption or replied to with `/import`. Every valid row is
+    stored in a single write, rows that conflict with existing contacts are
+    skipped and reported back.
+
+    Args:
+        message: Received Telegram message.
+    """
+    if message.chat.id != SETTINGS['owner']:
+        tgsender.reply_to(message, 'you are not the owner of this bot')
+        return
+
+    document = getattr(message, 'document', None)
+
+    if not document and message.reply_to_message:
+        document = getattr(message.reply_to_message, 'document', None)
+
+    if not document:
+        tgsender.reply_to(message, 'Syntax: /import (as caption of a CSV file or replying to one)')
+        return
+
+    # Downloading the file blocks
+    tgsender.defer(_import_file, message, document)
+
+def _import_file(message, document):
+    """Download a CSV file and import its contacts."""
+    try:
+        rows = contacts_from_csv(read_tg(tgbot, document.file_id, IMPORT_MAX_SIZE))
+
+    except MediaTooLarge:
+        tgsender.reply_to(message, 'File is too large')
+        return
+
+    except Exception as e:
+        logger.error('could not read contacts file: %s' % e)
+        tgsender.reply_to(message, 'Could not read the CSV file')
+        return
+
+    added, conflicts = db_import_contacts(rows)
+
+    response = 'Added %d contacts' % added
+
+    if conflicts:
+        response += ', skipped %d rows:\n' % len(conflicts)
 
-    response = 'Contacts:\n'
-    for c in contacts:
-        response += '- %s (%s)' % (c[0], c[1])
-        if c[2]:
-            response += ' -> group %s' % c[2]
-        response += '\n'
+        for line, reason in conflicts[:IMPORT_MAX_CONFLICTS]:
+            response += '- line %d: %s\n' % (line, reason)
 
-    tgbot.reply_to(message, response)
+        if len(conflicts) > IMPORT_MAX_CONFLICTS:
+            response += '...\n'
+
+    tgsender.reply_to(message, response)
 
 @tgbot.message_handler(commands=['rm'])
 def rm_contact(message):
@@ -275,25 +608,25 @@ def rm_contact(message):
         message: Received Telegram message.
     """
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'you are not the owner of this bot')
+        tgsender.reply_to(message, 'you are not the owner of this bot')
         return
 
     # Get name
     name = telebot.util.extract_arguments(message.text)
 
     if not name:
-        tgbot.reply_to(message, 'Syntax: /rm <name>')
+        tgsender.reply_to(message, 'Syntax: /rm <name>')
         return
 
     # Check if it already exists
     if not get_phone(name):
-        tgbot.reply_to(message, 'No contact found with that name')
+        tgsender.reply_to(message, 'No contact found with that name')
         return
 
     # Add to database
     db_rm_contact(name)
 
-    tgbot.reply_to(message, 'Contact removed')
+    tgsender.reply_to(message, 'Contact removed')
 
 @tgbot.message_handler(commands=['send'])
 def relay_wa(message):
@@ -306,8 +639,10 @@ def relay_wa(message):
     Args:
         message: Received Telegram message.
     """
+    received = time.time()
+
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'you are not the owner of this bot')
+        tgsender.reply_to(message, 'you are not the owner of this bot')
         return
 
     # Get name and message
@@ -315,12 +650,57 @@ def relay_wa(message):
     name, text = args.split(maxsplit=1)
 
     if not name or not text:
-        tgbot.reply_to(message, 'Syntax: /send <name> <message>')
+        tgsender.reply_to(message, 'Syntax: /send <name> <message>')
         return
 
     # Relay
     logger.info('relaying message to Whatsapp')
-    SIGNAL_WA.send('tgbot', contact=name, message=text)
+    result = SIGNAL_WA.send('tgbot', contact=name, message=text, received=received)
+
+    for _, position in result:
+        if position:
+            tgsender.reply_to(message, 'Message queued (position %d)' % position)
+
+@tgbot.message_handler(commands=['status'])
+def status(message):
+    """Show the state of the message queues.
+
+    Message has the following format:
+
+        /status
+
+    Args:
+        message: Received Telegram message.
+    """
+    if message.chat.id != SETTINGS['owner']:
+        tgsender.reply_to(message, 'you are not the owner of this bot')
+        return
+
+    response = ''
+
+    # The queues may live in another process
+    for _, queues in SIGNAL_QUEUES.send('tgbot'):
+        if queues:
+            response += 'Pending messages to Telegram: %(tg_depth)d\n' % queues
+            response += 'Pending messages to Whatsapp: %(wa_depth)d\n' % queues
+            response += 'Oldest Whatsapp message: %(wa_oldest_age).1f s\n' % queues
+            response += 'Phones banned for flooding: %d\n' % queues.get('flood_banned', 0)
+            response += 'Whatsapp receipts saved: %d\n' % queues.get('receipts_saved', 0)
+
+    stats = tgsender.stats()
+    response += ('Telegram sends: %(sent)d sent, %(throttled)d throttled, '
+                 '%(rate_limited)d rate limited, %(retried)d retried, '
+                 '%(failed)d failed\n' % stats)
+
+    stats = TG_SESSION.stats()
+    response += ('Telegram connections: %(new)d opened, %(reused)d requests '
+                 'reused one\n' % stats)
+
+    stats = MEDIA_CACHE.stats()
+    response += ('Media cache: %(entries)d files, %(hits)d hits, '
+                 '%(misses)d misses\n' % stats)
+
+    tgsender.reply_to(message, response)
 
 @tgbot.message_handler(commands=['unblacklist'])
 def unblacklist(message):
@@ -334,7 +714,7 @@ def unblacklist(message):
         message: Received Telegram message.
     """
     if message.chat.id != SETTINGS['owner']:
-        tgbot.reply_to(message, 'you are not the owner of this bot')
+        tgsender.reply_to(message, 'you are not the owner of this bot')
         return
 
     # Get phone
@@ -342,18 +722,20 @@ def unblacklist(message):
 
     if not phone:
         # Return list
-        tgbot.reply_to(message, 'Syntax: /unblacklist <phone>')
+        tgsender.reply_to(message, 'Syntax: /unblacklist <phone>')
         return
 
+    rule = parse_rule(phone)
+
     # Unblacklist a phone
-    if not is_blacklisted(phone):
+    if not rule or not is_blacklist_rule(rule):
         # Not blacklisted
-        tgbot.reply_to(message, 'That phone is not blacklisted')
+        tgsender.reply_to(message, 'That phone is not blacklisted')
         return
 
-    db_rm_blacklist(phone)
+    db_rm_blacklist(rule)
 
-    tgbot.reply_to(message, 'Phone has been unblacklisted')
+    tgsender.reply_to(message, 'Phone has been unblacklisted')
 
 @tgbot.message_handler(func=lambda message: message.chat.type in ['group', 'supergroup'])
 def relay_group_wa(message):
@@ -362,18 +744,71 @@ def relay_group_wa(message):
     Args:
         message: Received Telegram message.
     """
+    received = time.time()
+
     cid = message.chat.id
     uid = message.from_user.id
 
     if uid != SETTINGS['owner']:
-        tgbot.reply_to(message, 'you are not the owner of this bot')
+        tgsender.reply_to(message, 'you are not the owner of this bot')
         return
 
     name = db_get_contact_by_group(group=cid)
     if not name:
-        tgbot.reply_to(message, 'no user is mapped to this group')
+        tgsender.reply_to(message, 'no user is mapped to this group')
         return
 
     # Relay
     logger.info('relaying message to Whatsapp')
-    SIGNAL_WA.send('tgbot', contact=name, message=message.text)
+    SIGNAL_WA.send('tgbot', contact=name, message=message.text, received=received)
+
+@tgbot.message_handler(
+    func=lambda message: SETTINGS['media_enabled']
+        and message.chat.type in ['group', 'supergroup'],
+    content_types=['photo', 'video', 'audio', 'voice', 'document'])
+def relay_group_media_wa(message):
+    """ Send a file received in a bound group to the correspondending contact through Whatsapp.
+
+    Args:
+        message: Received Telegram message.
+    """
+    received = time.time()
+
+    cid = message.chat.id
+    uid = message.from_user.id
+
+    if uid != SETTINGS['owner']:
+        tgsender.reply_to(message, 'you are not the owner of this bot')
+        return
+
+    name = db_get_contact_by_group(group=cid)
+    if not name:
+        tgsender.reply_to(message, 'no user is mapped to this group')
+        return
+
+    if message.content_type == 'photo':
+        # Use the largest size available
+        media = {'file_id': message.photo[-1].file_id, 'type': 'image'}
+
+    elif message.content_type == 'video':
+        media = {'file_id': message.video.file_id, 'type': 'video'}
+
+    elif message.content_type in ['audio', 'voice']:
+        media = {
+            'file_id': getattr(message, message.content_type).file_id,
+            'type': 'audio'
+        }
+
+    else:
+        tgsender.reply_to(message, 'documents cannot be sent to Whatsapp')
+        return
+
+    # Relay
+    logger.info('relaying %s to Whatsapp' % media['type'])
+    SIGNAL_WA.send(
+        'tgbot',
+        contact=name,
+        message=getattr(message, 'caption', None) or '',
+        media=media,
+        received=received
+    )
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Rate limited sending of Telegram messages."""
+
+import random
+import threading
+import time
+
+import requests
+from telebot import apihelper, types
+from telebot.apihelper import ApiException
+
+from wat_bridge.metrics import SEND_FAILURES, TG_SENDS
+from wat_bridge.ratelimit import KeyedBuckets, TokenBucket
+from wat_bridge.static import get_logger
+
+logger = get_logger('tgsend')
+
+
+def retry_after(exc):
+    """Obtain the retry delay requested by Telegram.
+
+    Args:
+        exc (ApiException): Exception raised by the API call.
+
+    Returns:
+        Seconds to wait, or `None` if the request was not rate limited.
+    """
+    result = getattr(exc, 'result', None)
+
+    if result is None or result.status_code != 429:
+        return None
+
+    try:
+        return float(result.json()['parameters']['retry_after'])
+
+    except (ValueError, KeyError, TypeError):
+        return 1.0
+
+
+def is_transient(exc):
+    """Check if a failed API call may succeed if retried.
+
+    Args:
+        exc (Exception): Exception raised by the API call.
+
+    Returns:
+        True or False
+    """
+    if isinstance(exc, requests.exceptions.RequestException):
+        return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    if isinstance(exc, EnvironmentError):
+        # Socket errors of other transports
+        return True
+
+    result = getattr(exc, 'result', None)
+
+    return result is not None and result.status_code >= 500
+
+
+class TgSender(object):
+    """Scheduler for every message sent through the Telegram bot.
+
+    Calls are paced with a global token bucket and a token bucket per chat
+    (groups and private chats have different limits). If Telegram answers
+    with HTTP 429, the call is retried after the delay it requested; other
+    transient errors are retried with exponential backoff and jitter.
+
+    Calls block the calling thread until they are done, unless a transport
+    that performs them in the background is set in `transport`.
+
+    Args:
+        bot: Telegram bot used to perform the calls.
+        rate (float): Global messages per second.
+        chat_rate (float): Messages per second in a private chat.
+        group_rate (float): Messages per second in a group chat.
+        retries (int): Maximum number of retries of a call.
+        backoff (float): Base delay for retries, in seconds.
+    """
+
+    def __init__(self, bot, rate=30, chat_rate=1, group_rate=20 / 60.0,
+            retries=3, backoff=0.5):
+        self.bot = bot
+        self.retries = retries
+        self.transport = None
+        self.backoff = backoff
+
+        self.bucket = TokenBucket(rate, rate)
+        self.chats = KeyedBuckets(chat_rate, 1)
+        self.groups = KeyedBuckets(group_rate, 3)
+
+        self.lock = threading.Lock()
+        self.counters = {
+            'sent': 0,
+            'throttled': 0,
+            'rate_limited': 0,
+            'retried': 0,
+            'failed': 0
+        }
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+        TG_SENDS.inc(result=name)
+
+        if name == 'failed':
+            SEND_FAILURES.inc(network='telegram')
+
+    def reserve(self, chat_id):
+        """Reserve a slot for a new message to the chat.
+
+        Returns:
+            Seconds to wait before sending the message.
+        """
+        buckets = self.groups if int(chat_id) < 0 else self.chats
+        delay = max(self.bucket.reserve(), buckets.get(chat_id).reserve())
+
+        if delay > 0:
+            self._count('throttled')
+
+        return delay
+
+    def _wait(self, chat_id):
+        """Block until the rate limits allow a new message to the chat."""
+        delay = self.reserve(chat_id)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def retry_delay(self, exc, attempt):
+        """Decide whether a failed call is retried.
+
+        Args:
+            exc (Exception): Exception raised by the call.
+            attempt (int): Number of the failed attempt, starting at 0.
+
+        Returns:
+            Seconds to wait before retrying, or `None` if the call must not
+            be retried.
+        """
+        delay = retry_after(exc)
+
+        if delay is not None:
+            self._count('rate_limited')
+            logger.warning('rate limited by Telegram, retrying in %.1f s' % delay)
+
+        elif is_transient(exc):
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+
+        else:
+            self._count('failed')
+            return None
+
+        if attempt >= self.retries:
+            self._count('failed')
+            return None
+
+        self._count('retried')
+
+        return delay
+
+    def call(self, chat_id, func, *args, **kwargs):
+        """Perform an API call that sends something to a chat.
+
+        Args:
+            chat_id (int): Chat the call sends to.
+            func: Bot method to call.
+            *args: Positional arguments of the method.
+            **kwargs: Keyword arguments of the method.
+
+        If a transport is set, the call is handed to it instead of being
+        performed in the calling thread.
+
+        Returns:
+            Result of the call, or `None` if the transport performs it in the
+            background.
+
+        Raises:
+            Exception raised by the last attempt if it was not successful.
+        """
+        if self.transport is not None:
+            return self.transport.call(chat_id, func, args, kwargs)
+
+        attempt = 0
+
+        while True:
+            self._wait(chat_id)
+
+            try:
+                result = func(*args, **kwargs)
+                self._count('sent')
+
+                return result
+
+            except (ApiException, requests.exceptions.RequestException) as e:
+                delay = self.retry_delay(e, attempt)
+
+                if delay is None:
+                    raise
+
+                attempt += 1
+                time.sleep(delay)
+
+    def request(self, chat_id, method, params):
+        """Perform a Bot API request that sends a message to a chat.
+
+        If a transport is set, the request is handed to it instead of being
+        performed in the calling thread.
+
+        Args:
+            chat_id (int): Chat the request sends to.
+            method (str): Name of the API method (e.g. `sendMessage`).
+            params (dict): Parameters of the method; objects with a
+                `to_json()` method (such as keyboards) are serialized.
+
+        Returns:
+            The sent message, or `None` if the transport sends it in the
+            background.
+        """
+        params = dict(
+            (key, value.to_json() if hasattr(value, 'to_json') else value)
+            for key, value in params.items()
+            if value is not None
+        )
+
+        if self.transport is not None:
+            return self.transport.request(chat_id, method, params)
+
+        return self.call(chat_id, self._post, method, params)
+
+    def defer(self, func, *args, **kwargs):
+        """Run a blocking function that talks to Telegram.
+
+        If a transport is set, the function may run in the background (e.g.
+        so that it does not block an event loop), otherwise it runs in the
+        calling thread. Exceptions are logged in the background.
+
+        Args:
+            func: Function to run.
+            *args: Positional arguments of the function.
+            **kwargs: Keyword arguments of the function.
+        """
+        if self.transport is not None:
+            return self.transport.defer(func, args, kwargs)
+
+        return func(*args, **kwargs)
+
+    def _post(self, method, params):
+        result = apihelper._make_request(self.bot.token, method, params=params, method='post')
+
+        return types.Message.de_json(result)
+
+    def send_message(self, chat_id, text, **kwargs):
+        """Send a text message. See `TeleBot.send_message()`."""
+        kwargs['chat_id'] = chat_id
+        kwargs['text'] = text
+
+        return self.request(chat_id, 'sendMessage', kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        """Reply to a message. See `TeleBot.reply_to()`."""
+        kwargs['reply_to_message_id'] = message.message_id
+
+        return self.send_message(message.chat.id, text, **kwargs)
+
+    def stats(self):
+        """Obtain a copy of the counters.
+
+        Returns:
+            Dict with the number of `sent`, `throttled` (delayed by the
+            local rate limits), `rate_limited` (HTTP 429), `retried` and
+            `failed` calls.
+        """
+        with self.lock:
+            return dict(self.counters)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Shared HTTP session for the Telegram Bot API.
+
+pyTelegramBotAPI opens a new connection (and TLS handshake) for every API
+call. The session defined here keeps a bounded pool of connections alive and
+is installed in place of the request function of the library, so that every
+call made by the bot reuses them.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from telebot import apihelper
+
+from wat_bridge.metrics import METRICS
+from wat_bridge.static import SETTINGS, get_logger
+
+logger = get_logger('tgsession')
+
+
+class TgSession(object):
+    """Pool of keep-alive connections to the Bot API.
+
+    Connection failures are retried before the request is sent, and server
+    errors (502, 503 and 504) are retried only for idempotent methods, so
+    that messages are never sent twice. Rate limits and other errors are
+    left to `TgSender`.
+
+    Args:
+        pool_size (int): Maximum number of connections kept per host. When
+            every connection is busy, requests wait for one to be free.
+        connect_timeout (float): Seconds to wait for a connection.
+        read_timeout (float): Seconds to wait for a response.
+        retries (int): Maximum number of retries of a request.
+        backoff (float): Base delay between retries, in seconds.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=3.5, read_timeout=30.0,
+            retries=2, backoff=0.3):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False
+        )
+
+        self.adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def make_request(self, token, method_name, method='get', params=None,
+            files=None, base_url=None):
+        """Perform a Bot API request.
+
+        Same signature as `telebot.apihelper._make_request()`. The URL of the
+        API is read from `apihelper.API_URL` on every call unless given.
+
+        Returns:
+            The `result` field of the response.
+        """
+        url = (base_url or apihelper.API_URL).format(token, method_name)
+        read_timeout = self.read_timeout
+
+        if params and 'timeout' in params:
+            # Long polling
+            read_timeout = params['timeout'] + 10
+
+        result = self.session.request(
+            method,
+            url,
+            params=params,
+            files=files,
+            timeout=(self.connect_timeout, read_timeout)
+        )
+
+        return apihelper._check_result(method_name, result)['result']
+
+    def install(self):
+        """Use the session for every request made by pyTelegramBotAPI."""
+        apihelper._make_request = self.make_request
+
+    def stats(self):
+        """Obtain the number of new and reused connections.
+
+        Returns:
+            Dict with the number of `requests` performed, the `new`
+            connections opened and the number of requests that `reused` an
+            open connection.
+        """
+        requests_count = 0
+        new = 0
+
+        pools = self.adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools.get(key)
+
+            if pool is not None:
+                requests_count += pool.num_requests
+                new += pool.num_connections
+
+        return {'requests': requests_count, 'new': new, 'reused': requests_count - new}
+
+
+# Session shared by every Telegram request
+TG_SESSION = TgSession(
+    pool_size=SETTINGS['tg_pool_size'],
+    connect_timeout=SETTINGS['tg_connect_timeout'],
+    read_timeout=SETTINGS['tg_read_timeout'],
+    retries=SETTINGS['tg_http_retries']
+)
+
+METRICS.gauge(
+    'watbridge_tg_http_new_connections',
+    'Connections opened to the Telegram API.',
+    func=lambda: TG_SESSION.stats()['new']
+)
+METRICS.gauge(
+    'watbridge_tg_http_reused_connections',
+    'Telegram API requests that reused an open connection.',
+    func=lambda: TG_SESSION.stats()['reused']
+)
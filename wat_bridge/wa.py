@@ -33,49 +33,449 @@ from yowsup.layers.network import YowNetworkLayer
 from yowsup.layers.protocol_messages.protocolentities import TextMessageProtocolEntity
 from yowsup.layers.protocol_receipts.protocolentities import OutgoingReceiptProtocolEntity
 from yowsup.layers.protocol_acks.protocolentities import OutgoingAckProtocolEntity
+from yowsup.layers.protocol_media.mediauploader import MediaUploader
+from yowsup.layers.protocol_media.protocolentities import \
+        AudioDownloadableMediaMessageProtocolEntity, \
+        ImageDownloadableMediaMessageProtocolEntity, \
+        RequestUploadIqProtocolEntity, \
+        VideoDownloadableMediaMessageProtocolEntity
 from yowsup.stacks import YowStackBuilder
 
-from wat_bridge.static import SETTINGS, SIGNAL_TG, get_logger
+import collections
+import itertools
+import os
+import threading
+import time
+
+from wat_bridge.static import SETTINGS, get_logger
+from wat_bridge.dedup import mark_relayed, was_relayed
 from wat_bridge.helper import is_blacklisted
+from wat_bridge.phones import is_group, normalize
+from wat_bridge.media import TRANSFERS, wa_media_info
+from wat_bridge.mediacache import MEDIA_CACHE
+from wat_bridge.metrics import METRICS, BLACKLISTED, FLOODED, RECEIPT_FRAMES_SAVED, \
+        SEND_FAILURES, TG_TO_WA_LATENCY
+from wat_bridge.ratelimit import FloodGuard, KeyedBuckets, TokenBucket
+from wat_bridge.relay import OUTBOX, TG_COALESCER, TG_QUEUE
 
 logger = get_logger('wa')
 
+
+class WaSendQueue(object):
+    """Queue of messages waiting to be sent through Whatsapp.
+
+    Messages can be queued from any thread, but they are only handed to the
+    yowsup layer from the thread running the stack loop (see `drain()`).
+
+    Sending is paced with a global token bucket and a token bucket per
+    recipient. Messages for the same recipient are always sent in order.
+
+    A message that cannot be sent is put back in the queue and retried up
+    to `retries` times, waiting an exponentially growing delay capped at
+    `retry_cap` seconds. Messages that still fail, and media files that
+    cannot be uploaded, are given up: they are marked as done in the outbox
+    and the owner is told about them.
+
+    Args:
+        maxsize (int): Maximum number of pending messages.
+        rate (float): Global messages per second.
+        burst (int): Global burst size.
+        recipient_rate (float): Messages per second for each recipient.
+        recipient_burst (int): Burst size for each recipient.
+        retries (int): Times a message that could not be sent is retried.
+        retry_base (float): Seconds to wait before the first retry.
+        retry_cap (float): Maximum seconds to wait between retries.
+
+    The loop may set `wakeup` to a function without arguments that is called
+    whenever there is something new to do, instead of waiting for the next
+    poll.
+    """
+
+    def __init__(self, maxsize, rate, burst, recipient_rate, recipient_burst,
+            retries=0, retry_base=1.0, retry_cap=60.0):
+        self.maxsize = maxsize
+        self.retries = retries
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.items = collections.deque()
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+        self.wakeup = None
+
+        self.bucket = TokenBucket(rate, burst)
+        self.recipients = KeyedBuckets(recipient_rate, recipient_burst)
+
+    def put(self, phone, message, received=None, entry=None, media=None):
+        """Queue a message.
+
+        Args:
+            phone (str): Phone (or group JID) to send the message to.
+            message (str): Message (or media caption) to send.
+            received (float): Time the message was received from Telegram,
+                used to measure the relay latency.
+            entry (int): ID of the message in the outbox, marked as done
+                once the message is sent.
+            media (dict): Media file to send, with its `path` and `type`.
+                The file is removed and a slot of `TRANSFERS` is released
+                once the upload finishes.
+
+        Returns:
+            Position of the message in the queue, or `None` if the queue is
+            full.
+        """
+        with self.lock:
+            if len(self.items) >= self.maxsize:
+                return None
+
+            now = time.time()
+
+            # The last two fields are the number of failed attempts and the
+            # time before which the message must not be retried
+            self.items.append((phone, message, now, received or now, entry, media, 0, 0))
+            position = len(self.items)
+
+        if self.wakeup:
+            self.wakeup()
+
+        return position
+
+    def call_soon(self, func):
+        """Schedule a function to be called from the stack loop thread.
+
+        Args:
+            func: Function without arguments.
+        """
+        self.calls.append(func)
+
+        if self.wakeup:
+            self.wakeup()
+
+    def depth(self):
+        """Obtain the number of pending messages."""
+        return len(self.items)
+
+    def oldest_age(self):
+        """Obtain the age of the oldest pending message.
+
+        Returns:
+            Seconds since the oldest message was queued, 0 if empty.
+        """
+        with self.lock:
+            if not self.items:
+                return 0
+
+            return time.time() - self.items[0][2]
+
+    def drain(self, layer):
+        """Send as many queued messages as the rate limits allow.
+
+        Must be called from the thread running the yowsup stack loop.
+
+        Args:
+            layer (WaLayer): Layer used to send the messages.
+
+        Returns:
+            Number of messages sent.
+        """
+        while self.calls:
+            self.calls.popleft()()
+
+        now = time.time()
+
+        with self.lock:
+            ready = []
+            blocked = set()
+            pending = collections.deque()
+
+            while self.items and not self.bucket.delay():
+                item = self.items.popleft()
+                phone = item[0]
+
+                if phone in blocked or item[7] > now \
+                        or not self.recipients.get(phone).consume():
+                    # Keep order for this recipient
+                    blocked.add(phone)
+                    pending.append(item)
+                    continue
+
+                self.bucket.consume()
+                ready.append(item)
+
+            pending.extend(self.items)
+            self.items = pending
+
+        retry = []
+        failed = set()
+
+        for item in ready:
+            phone, message, _, received, entry, media, attempt, _ = item
+
+            if phone in failed:
+                # Keep order behind a message that is going to be retried
+                retry.append(item)
+                continue
+
+            if media:
+                layer.send_media(
+                    phone, media, message,
+                    lambda ok, phone=phone, received=received, entry=entry, media=media:
+                        self._media_done(ok, phone, received, entry, media)
+                )
+                continue
+
+            try:
+                layer.send_msg(phone=phone, message=message)
+
+            except Exception as e:
+                SEND_FAILURES.inc(network='whatsapp')
+
+                if attempt >= self.retries:
+                    logger.error('could not send message to %s, giving up: %s' % (phone, e))
+                    self._give_up(phone, entry, 'message')
+                    continue
+
+                delay = min(self.retry_cap, self.retry_base * 2 ** attempt)
+                logger.warning('could not send message to %s, retrying in %.1f s: %s' % (
+                    phone, delay, e))
+
+                failed.add(phone)
+                retry.append(item[:6] + (attempt + 1, time.time() + delay))
+                continue
+
+            TG_TO_WA_LATENCY.observe(time.time() - received)
+
+            if entry:
+                OUTBOX.done(entry)
+
+        if retry:
+            with self.lock:
+                self.items.extendleft(reversed(retry))
+
+        return len(ready) - len(retry)
+
+    def _give_up(self, phone, entry, what):
+        """Forget a message that could not be sent and tell the owner."""
+        if entry:
+            OUTBOX.done(entry)
+
+        TG_QUEUE.put(
+            phone,
+            notice='Could not send %s to %s through Whatsapp' % (what, phone)
+        )
+
+    def _media_done(self, ok, phone, received, entry, media):
+        """Clean up after a media upload."""
+        try:
+            os.remove(media['path'])
+
+        except OSError:
+            pass
+
+        TRANSFERS.release()
+
+        if not ok:
+            SEND_FAILURES.inc(network='whatsapp')
+            self._give_up(phone, entry, '%s file' % media['type'])
+            return
+
+        TG_TO_WA_LATENCY.observe(time.time() - received)
+
+        if entry:
+            OUTBOX.done(entry)
+
+
+class ReceiptBatcher(object):
+    """Merge the receipts of incoming messages.
+
+    Instead of sending a receipt for every message, the ids of the messages
+    received from the same chat (and participant) are collected for up to
+    `window` seconds and acknowledged with a single receipt.
+
+    Like `WaSendQueue.drain()`, every method must be called from the thread
+    running the stack loop.
+
+    Args:
+        read (bool): Whether to mark the messages as read, or only as
+            delivered.
+        window (float): Seconds to wait for more messages. A window of 0
+            sends every receipt right away.
+        max_ids (int): Maximum number of messages in a receipt.
+    """
+
+    def __init__(self, read=True, window=0, max_ids=50):
+        self.read = read
+        self.window = window
+        self.max_ids = max(max_ids, 1)
+
+        # (jid, participant) -> (time of first message, [message ids])
+        self.pending = collections.OrderedDict()
+
+        self.frames_saved = 0
+
+    def add(self, layer, message_id, jid, participant=None):
+        """Acknowledge a message.
+
+        Args:
+            layer (WaLayer): Layer used to send the receipts.
+            message_id (str): ID of the message.
+            jid (str): JID the message came from.
+            participant (str): Sender of the message in a group.
+        """
+        key = (jid, participant)
+
+        if key not in self.pending:
+            self.pending[key] = (time.time(), [])
+
+        ids = self.pending[key][1]
+        ids.append(message_id)
+
+        if self.window <= 0 or len(ids) >= self.max_ids:
+            self._send(layer, key)
+
+    def flush(self, layer, force=False):
+        """Send the receipts whose window has ended.
+
+        Args:
+            layer (WaLayer): Layer used to send the receipts.
+            force (bool): Send every pending receipt.
+        """
+        now = time.time()
+
+        while self.pending:
+            key, (first, _) = next(iter(self.pending.items()))
+
+            if not force and now - first < self.window:
+                break
+
+            self._send(layer, key)
+
+    def _send(self, layer, key):
+        _, ids = self.pending.pop(key)
+        jid, participant = key
+
+        layer.toLower(OutgoingReceiptProtocolEntity(ids, jid, self.read, participant))
+
+        if len(ids) > 1:
+            self.frames_saved += len(ids) - 1
+            RECEIPT_FRAMES_SAVED.inc(len(ids) - 1)
+
+
 class WaLayer(YowInterfaceLayer):
     """Defines the yowsup layer for interacting with Whatsapp."""
 
+    def __init__(self):
+        super(WaLayer, self).__init__()
+
+        # Whether the connection is authenticated
+        self.connected = False
+
+        # Media uploads waiting for an answer, by id: (deadline, callback)
+        self.uploads = {}
+        self.upload_ids = itertools.count()
+
+    def onEvent(self, layerEvent):
+        """Received an event from the stack."""
+        if layerEvent.getName() == YowNetworkLayer.EVENT_STATE_DISCONNECTED:
+            logger.info('disconnected from Whatsapp')
+            self.connected = False
+
+            # Answers for these will never arrive
+            self.expire_uploads(force=True)
+
+        return super(WaLayer, self).onEvent(layerEvent)
+
+    @ProtocolEntityCallback('success')
+    def on_success(self, entity):
+        """Logged in to Whatsapp."""
+        logger.info('connected to Whatsapp')
+        self.connected = True
+
+    @ProtocolEntityCallback('failure')
+    def on_failure(self, entity):
+        """Login to Whatsapp failed."""
+        logger.error('could not log in to Whatsapp: %s' % entity.getReason())
+        self.connected = False
+
     @ProtocolEntityCallback('message')
     def on_message(self, message):
         """Received a message."""
+        received = time.time()
+
+        if was_relayed('wa', message.getFrom(), message.getId()):
+            # Delivered again after reconnecting, only acknowledge it
+            WA_RECEIPTS.add(self, message.getId(), message.getFrom(), message.getParticipant())
+            return
+
         # Parse information
-        sender = message.getFrom(full=False)
+        group = None
+        notify = None
+
+        if message.isGroupMessage():
+            # The sender is the participant, the message belongs to the group
+            group = message.getFrom()
+            sender = message.getParticipant(False)
+            notify = message.getNotify()
+
+        else:
+            sender = message.getFrom(full=False)
+
+        sender = normalize(sender) or sender
 
         logger.debug('received message from %s' % sender)
 
-        # Send receipt
-        receipt = OutgoingReceiptProtocolEntity(
-            message.getId(),
-            message.getFrom(),
-            'read',
-            message.getParticipant()
-        )
+        entry = None
+        media = None
 
-        self.toLower(receipt)
+        if message.getType() == 'media' and SETTINGS['media_enabled']:
+            media = wa_media_info(message)
 
-        # Ignore non-text messages
-        if message.getType() != 'text':
-            logger.info('not a text message, ignoring')
-            return
+        if message.getType() != 'text' and not media:
+            # Ignore unsupported messages
+            logger.info('not a text or media message, ignoring')
 
-        # Do stuff
-        if is_blacklisted(sender):
+        elif is_blacklisted(sender):
             logger.debug('phone is blacklisted: %s' % sender)
-            return
+            BLACKLISTED.inc()
+
+        elif is_flooding(sender):
+            logger.debug('phone is flooding: %s' % sender)
+            FLOODED.inc()
+
+        else:
+            # Store the message before sending the receipt, Whatsapp will
+            # not deliver it again
+            if media:
+                body = getattr(message, 'getCaption', lambda: None)() or ''
+            else:
+                body = message.getBody()
 
-        body = message.getBody()
+            entry = OUTBOX.append('tg', phone=sender, message=body,
+                                  received=received, media=media,
+                                  wa_group=group, notify=notify)
 
-        # Relay to Telegram
+        # Remembered only once stored, a message lost before is relayed when
+        # delivered again
+        mark_relayed('wa', message.getFrom(), message.getId())
+
+        # Send receipt
+        WA_RECEIPTS.add(self, message.getId(), message.getFrom(), message.getParticipant())
+
+        if not entry:
+            return
+
+        # Relay to Telegram without blocking the yowsup loop
         logger.info('relaying message to Telegram')
-        SIGNAL_TG.send('wabot', phone=sender, message=body)
+
+        if media or group:
+            # Media and group messages are not merged, but must keep their
+            # order with the messages that are buffered
+            TG_COALESCER.flush()
+            TG_QUEUE.put(group or sender, phone=sender, message=body, media=media,
+                         wa_group=group, notify=notify, received=received,
+                         entries=[entry])
+            return
+
+        TG_COALESCER.add(sender, body, received=received, entry=entry)
 
     @ProtocolEntityCallback('receipt')
     def on_receipt(self, entity):
@@ -96,7 +496,7 @@ class WaLayer(YowInterfaceLayer):
         """Send a message.
 
         Arguments:
-            phone (str): Phone to send the message to.
+            phone (str): Phone (or group JID) to send the message to.
             message (str): Message to send
         """
         phone = kwargs.get('phone')
@@ -110,12 +510,184 @@ class WaLayer(YowInterfaceLayer):
 
         entity = TextMessageProtocolEntity(
             message,
-            to='%s@s.whatsapp.net' % phone
+            to=_jid(phone)
         )
 
         # self.ackQueue.append(entity.getId())
         self.toLower(entity)
 
+    def send_media(self, phone, media, caption, callback):
+        """Upload a media file and send it.
+
+        The upload runs in the background, `callback` is called from the
+        stack loop thread with `True` or `False` once it finishes.
+
+        Arguments:
+            phone (str): Phone (or group JID) to send the file to.
+            media (dict): File to send, with its `path`, `type` (`image`,
+                `video` or `audio`) and `digest`.
+            caption (str): Caption of the file.
+            callback: Function called with the result of the upload.
+
+        If neither the server nor the uploader answer within the configured
+        `upload_timeout`, the upload is considered failed (see
+        `expire_uploads()`). `callback` is called only once.
+        """
+        jid = _jid(phone)
+        path = media['path']
+        media_type = media['type']
+        upload_id = next(self.upload_ids)
+
+        def finish(ok):
+            if self.uploads.pop(upload_id, None):
+                callback(ok)
+
+        self.uploads[upload_id] = (time.time() + SETTINGS['media_upload_timeout'], callback)
+
+        def on_uploaded(url, ip=None, cached=False):
+            if upload_id not in self.uploads:
+                # Expired, the file is gone
+                return
+
+            try:
+                self._send_media_message(jid, path, media_type, url, ip, caption)
+
+                if not cached:
+                    MEDIA_CACHE.put(media.get('digest'), 'wa', {'url': url, 'ip': ip})
+
+                finish(True)
+
+            except Exception as e:
+                logger.error('could not send media to %s: %s' % (phone, e))
+                finish(False)
+
+        def on_error(*args):
+            logger.error('could not upload media for %s' % phone)
+            finish(False)
+
+        def on_request_success(result, request):
+            if result.isDuplicate():
+                # The server already has the file
+                on_uploaded(result.getUrl(), result.getIp())
+                return
+
+            # The uploader runs in its own thread, its callbacks are moved
+            # back to the stack loop thread
+            try:
+                uploader = MediaUploader(
+                    jid,
+                    self.getOwnJid(),
+                    path,
+                    result.getUrl(),
+                    result.getResumeOffset(),
+                    lambda _path, _jid, url: WA_QUEUE.call_soon(lambda: on_uploaded(url)),
+                    lambda *args: WA_QUEUE.call_soon(on_error),
+                    None,
+                    True
+                )
+                uploader.start()
+
+            except Exception as e:
+                logger.error('could not start upload for %s: %s' % (phone, e))
+                finish(False)
+
+        if media_type not in MEDIA_ENTITIES:
+            logger.error('unsupported media type for Whatsapp: %s' % media_type)
+            finish(False)
+            return
+
+        cached = MEDIA_CACHE.get(media.get('digest'), 'wa')
+        if cached:
+            # Already uploaded, no need to ask the server
+            on_uploaded(cached['url'], cached.get('ip'), cached=True)
+            return
+
+        try:
+            request = RequestUploadIqProtocolEntity(media_type, filePath=path)
+            self._sendIq(request, on_request_success, on_error)
+
+        except Exception as e:
+            logger.error('could not request upload for %s: %s' % (phone, e))
+            finish(False)
+
+    def expire_uploads(self, force=False):
+        """Fail the media uploads that did not finish in time.
+
+        The callback of each expired upload is called with `False`, which
+        releases its transfer slot and removes its file. A late answer for
+        an expired upload is ignored.
+
+        Must be called from the thread running the stack loop.
+
+        Args:
+            force (bool): Fail every pending upload (e.g. when the
+                connection is lost).
+        """
+        now = time.time()
+
+        for upload_id, (deadline, callback) in list(self.uploads.items()):
+            if force or deadline <= now:
+                logger.warning('media upload timed out')
+                del self.uploads[upload_id]
+                callback(False)
+
+    def _send_media_message(self, jid, path, media_type, url, ip, caption):
+        """Send the message for an uploaded media file."""
+        entity_class = MEDIA_ENTITIES[media_type]
+
+        if media_type == 'audio' or not caption:
+            entity = entity_class.fromFilePath(path, url, ip, jid)
+
+        else:
+            entity = entity_class.fromFilePath(path, url, ip, jid, caption=caption)
+
+        self.toLower(entity)
+
+
+def _jid(phone):
+    """Obtain the JID of a phone, group JIDs are used as they are."""
+    if is_group(phone):
+        return phone
+
+    return '%s@s.whatsapp.net' % phone
+
+
+def is_flooding(sender):
+    """Check whether a sender went over the flood limit.
+
+    The first time a sender is banned, the owner is told about it through
+    the Telegram queue.
+
+    Args:
+        sender (str): Phone that sent the message.
+
+    Returns:
+        True if the message must be dropped.
+    """
+    result = FLOOD_GUARD.hit(sender)
+
+    if result == FloodGuard.FLOODED:
+        logger.warning('temporarily blacklisted %s for flooding' % sender)
+
+        notice = ('Phone %s sent more than %d messages in %d seconds and has '
+                  'been blacklisted for %d minutes' % (
+                      sender,
+                      FLOOD_GUARD.limit,
+                      FLOOD_GUARD.window,
+                      FLOOD_GUARD.ban / 60))
+
+        TG_QUEUE.put(sender, notice=notice)
+
+    return result != FloodGuard.ALLOWED
+
+
+# Entities used to send each type of media
+MEDIA_ENTITIES = {
+    'image': ImageDownloadableMediaMessageProtocolEntity,
+    'video': VideoDownloadableMediaMessageProtocolEntity,
+    'audio': AudioDownloadableMediaMessageProtocolEntity
+}
+
 
 # Prepare stack
 wabot = WaLayer()
@@ -131,3 +703,41 @@ WA_STACK = (
 )
 
 WA_STACK.setCredentials((SETTINGS['wa_phone'], SETTINGS['wa_password']))
+
+# Receipts of incoming messages
+WA_RECEIPTS = ReceiptBatcher(
+    read=SETTINGS['wa_receipt'] == 'read',
+    window=SETTINGS['wa_receipt_window'],
+    max_ids=SETTINGS['wa_receipt_max_ids']
+)
+
+# Inbound flood control
+FLOOD_GUARD = FloodGuard(
+    SETTINGS['flood_limit'],
+    window=SETTINGS['flood_window'],
+    ban=SETTINGS['flood_ban'],
+    max_senders=SETTINGS['flood_max_senders']
+)
+
+# Outbound messages
+WA_QUEUE = WaSendQueue(
+    SETTINGS['wa_queue_size'],
+    SETTINGS['wa_send_rate'],
+    SETTINGS['wa_send_burst'],
+    SETTINGS['wa_recipient_rate'],
+    SETTINGS['wa_recipient_burst'],
+    retries=SETTINGS['relay_retries'],
+    retry_base=SETTINGS['relay_retry_base'],
+    retry_cap=SETTINGS['relay_retry_cap']
+)
+
+METRICS.gauge(
+    'watbridge_wa_queue_depth',
+    'Messages waiting to be sent through Whatsapp.',
+    func=WA_QUEUE.depth
+)
+METRICS.gauge(
+    'watbridge_wa_queue_oldest_seconds',
+    'Age of the oldest message waiting to be sent through Whatsapp.',
+    func=WA_QUEUE.oldest_age
+)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# wat-bridge
+# https://github.com/rmed/wat-bridge
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Embedded HTTP server used to receive Telegram updates through a webhook."""
+
+import hmac
+import json
+
+from six.moves import BaseHTTPServer
+from telebot import apihelper, types
+
+from wat_bridge.static import SETTINGS, get_logger
+
+logger = get_logger('webhook')
+
+# Header sent by Telegram with the secret token of the webhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler that feeds received updates to the bot.
+
+    Requests are only accepted on the configured path and, if the server
+    has a secret, when they include the expected secret token header.
+    """
+
+    def do_POST(self):
+        """Received an update."""
+        if self.path != self.server.path:
+            self.send_error(404)
+            return
+
+        if self.server.secret and not _same_secret(
+                self.headers.get(SECRET_HEADER) or '', self.server.secret):
+            logger.warning('rejected update with invalid secret token')
+            self.send_error(403)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        try:
+            update = types.Update.de_json(json.loads(body.decode('utf-8')))
+
+        except (ValueError, KeyError) as e:
+            logger.error('invalid update: %s' % e)
+            self.send_error(400)
+            return
+
+        # Answer before processing so that Telegram does not resend the
+        # update if a handler is slow or fails
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+        self.server.bot.process_new_updates([update])
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def _same_secret(received, expected):
+    """Compare secret tokens in constant time."""
+    return hmac.compare_digest(received.encode('utf-8'), expected.encode('utf-8'))
+
+
+def make_server(bot, host, port, path='/', secret=None):
+    """Create the HTTP server for the webhook.
+
+    Updates are processed one at a time, in the order they are received.
+
+    Args:
+        bot: Telegram bot that processes the updates.
+        host (str): Address to listen on.
+        port (int): Port to listen on (0 picks a free port).
+        path (str): Path where updates are received.
+        secret (str): Secret token expected in the requests.
+
+    Returns:
+        HTTP server instance, not started.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), WebhookHandler)
+    server.bot = bot
+    server.path = path
+    server.secret = secret
+
+    return server
+
+
+def set_webhook(bot, url, secret=None):
+    """Register the webhook URL with Telegram.
+
+    Args:
+        bot: Telegram bot.
+        url (str): Public URL of the webhook.
+        secret (str): Secret token Telegram should send in each request.
+    """
+    params = {'url': url}
+
+    if secret:
+        params['secret_token'] = secret
+
+    return apihelper._make_request(bot.token, 'setWebhook', params=params, method='post')
+
+
+def serve_webhook(bot):
+    """Register the webhook and serve updates until an error occurs.
+
+    Args:
+        bot: Telegram bot that processes the updates.
+    """
+    server = make_server(
+        bot,
+        SETTINGS['tg_webhook_listen'],
+        SETTINGS['tg_webhook_port'],
+        SETTINGS['tg_webhook_path'],
+        SETTINGS['tg_webhook_secret']
+    )
+
+    try:
+        set_webhook(bot, SETTINGS['tg_webhook_url'], SETTINGS['tg_webhook_secret'])
+
+        logger.info('listening for updates on %s:%d' % server.server_address)
+        server.serve_forever()
+
+    finally:
+        server.server_close()
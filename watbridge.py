@@ -30,15 +30,28 @@
 from __future__ import print_function
 
 import signal
+import sys
 import threading
 
-from wat_bridge.static import SIGNAL_TG, SIGNAL_WA, init_bridge
+from wat_bridge.static import SETTINGS, SIGNAL_QUEUES, SIGNAL_TG, \
+        SIGNAL_WA, init_bridge
 
 # Parse config file
 init_bridge()
 
+if (SETTINGS['instances'] and not SETTINGS['instance']) \
+        or (SETTINGS['split'] and not SETTINGS['role']):
+    # Multi-account or split mode, run the bridge in child processes
+    from wat_bridge.multi import supervise
+
+    supervise(SETTINGS['instances'], SETTINGS['split'])
+    sys.exit(0)
+
 from wat_bridge.listeners import tg_listener, wa_listener
-from wat_bridge.signals import sigint_handler, to_tg_handler, to_wa_handler
+from wat_bridge.metrics import serve_metrics
+from wat_bridge.relay import OUTBOX, TG_COALESCER, TG_QUEUE
+from wat_bridge.signals import sigint_handler, to_tg_handler, to_wa_handler, \
+        queues_handler, replay_outbox
 
 
 if __name__ == '__main__':
@@ -46,15 +59,50 @@ if __name__ == '__main__':
     signal.signal(signal.SIGINT, sigint_handler)
     print('Press Ctrl+C to exit')
 
-    SIGNAL_TG.connect(to_tg_handler)
-    SIGNAL_WA.connect(to_wa_handler)
+    # In split mode, this process runs only one side of the bridge and the
+    # signals for the other side go through the bus
+    role = SETTINGS['role']
+
+    if role != 'wa':
+        SIGNAL_TG.connect(to_tg_handler)
+
+    if role != 'tg':
+        SIGNAL_WA.connect(to_wa_handler)
+        SIGNAL_QUEUES.connect(queues_handler)
+
+    if role:
+        from wat_bridge.bus import start_bus
+        start_bus(role)
+
+    if SETTINGS['metrics_port']:
+        serve_metrics(SETTINGS['metrics_listen'], SETTINGS['metrics_port'])
+
+    if role != 'tg':
+        # Start delivery workers
+        TG_QUEUE.start()
+        TG_COALESCER.start()
+        OUTBOX.start()
+
+        # Relay messages left over from a previous run
+        replay_outbox()
+
+    if SETTINGS['runtime'] == 'asyncio':
+        # Both sides run in the event loop of this thread
+        from wat_bridge.runtime import Runtime
+        Runtime(wa=role != 'tg', tg=role != 'wa').run()
+
+    else:
+        threads = []
+
+        if role != 'tg':
+            threads.append(threading.Thread(target=wa_listener))
 
-    # Launch threads and wait for them
-    tg_thread = threading.Thread(target=tg_listener)
-    wa_thread = threading.Thread(target=wa_listener)
+        if role != 'wa':
+            threads.append(threading.Thread(target=tg_listener))
 
-    tg_thread.start()
-    wa_thread.start()
+        # Launch threads and wait for them
+        for thread in threads:
+            thread.start()
 
-    tg_thread.join()
-    wa_thread.join()
+        for thread in threads:
+            thread.join()